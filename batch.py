@@ -0,0 +1,413 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from dotenv import load_dotenv
+
+# dists以下のモジュールは読み込み時に環境変数から設定を読むため、先に.envを読み込む
+load_dotenv()
+
+from dists.AdaptiveSampling import AdaptiveStopper, MeanConfidenceInterval
+from dists.BackendPool import BackendPool
+from dists.GeneratePersona import COMMENT_MODES, Character
+from dists.Metrics import METRICS_TEXTFILE, run_metrics
+from dists.ModelCascade import cascade_stats, stage_models
+from dists.ModelRegistry import model_registry
+from dists.PanelRefinement import EvaluatePanel, RevisePlan, StageMemo
+from dists.PersonaDiversity import DUPLICATE_THRESHOLD, PersonaIndex
+from dists.PersonaLibrary import persona_library
+from dists.PersonaPipeline import RunPersonaPipelines
+from dists.PlanRevisons import SuggestBusinessPlan
+from dists.ResponseCache import CACHE_MODES, CacheMissError, response_cache
+from dists.ResultExport import EXPORT_FORMATS, StreamingExporter
+from dists.RetryPolicy import BackendUnavailableError
+from dists.StructuredOutput import structured_output_stats
+from dists.VariantComparison import CompareVariants, PairedComparison, RememberVariantRecords, VariantLabel
+
+REQUIRED_FIELDS = ("service_title", "service_req", "gender", "count")
+
+def read_jobs(path, defaults):
+    # ジョブ定義を1行ずつ読み込む（ファイル全体は読み込まない）
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                spec = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"{path}:{line_number}: JSONとして読み込めないため読み飛ばします: {e}", file=sys.stderr)
+                continue
+            missing = [field for field in REQUIRED_FIELDS if field not in spec]
+            if "age_range" not in spec and ("age_range_start" not in spec or "age_range_end" not in spec):
+                missing.append("age_range")
+            if missing:
+                print(f"{path}:{line_number}: 必要な項目がないため読み飛ばします: {', '.join(missing)}", file=sys.stderr)
+                continue
+            try:
+                yield normalize_job(spec, defaults)
+            except ValueError as e:
+                print(f"{path}:{line_number}: {e}", file=sys.stderr)
+
+def normalize_job(spec, defaults):
+    if "age_range" in spec:
+        age_range_start, age_range_end = spec["age_range"]
+    else:
+        age_range_start, age_range_end = spec["age_range_start"], spec["age_range_end"]
+    backend = spec.get("backend", "local")
+    if backend not in ("local", "gemini"):
+        raise ValueError(f"不明なバックエンドです: {backend}")
+    comment_mode = spec.get("comment_mode", defaults["comment_mode"])
+    if comment_mode not in COMMENT_MODES:
+        raise ValueError(f"不明なコメント生成モードです: {comment_mode}")
+
+    job = {
+        "service_title": spec["service_title"],
+        "service_req": spec["service_req"],
+        "gender": spec["gender"],
+        "age_range_start": str(age_range_start),
+        "age_range_end": str(age_range_end),
+        "count": int(spec["count"]),
+        "backend": backend,
+        "comment_mode": comment_mode,
+        "fused": bool(spec.get("fused", defaults["fused"])),
+    }
+    # 目標の精度を指定した場合、countは最大人数になる（指定しないジョブのjob_idは変えない）
+    target_half_width = spec.get("target_half_width", defaults["target_half_width"])
+    if target_half_width is not None:
+        if float(target_half_width) <= 0:
+            raise ValueError(f"target_half_widthは正の数を指定してください: {target_half_width}")
+        job["target_half_width"] = float(target_half_width)
+    # 改良後のサービス要件を同じ人物で再評価する回数（0のジョブのjob_idは変えない）
+    rounds = int(spec.get("rounds", defaults["rounds"]))
+    if rounds < 0:
+        raise ValueError(f"roundsは0以上を指定してください: {rounds}")
+    if rounds:
+        job["rounds"] = rounds
+    # 同じ人物のパネルで比べる、service_req以外のサービス要件（指定しないジョブのjob_idは変えない）
+    variants = spec.get("variants", [])
+    if not isinstance(variants, list) or not all(isinstance(variant, str) and variant.strip() for variant in variants):
+        raise ValueError("variantsはサービス要件の文字列のリストを指定してください")
+    if variants:
+        job["variants"] = variants
+    # job_idがなければ内容から決める（再開時に同じジョブを同じIDで識別するため）
+    job["job_id"] = spec.get("job_id") or hashlib.sha1(json.dumps(job, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    # 保存済みの人物を使うかは実行時の選択のため、job_idには含めない
+    job["use_library"] = bool(spec.get("use_library", defaults["use_library"]))
+    return job
+
+def load_checkpoint(path):
+    # 出力済みの結果から、完了した人物・サービス改良案・再評価のラウンド・他の案の評価と比較を集める
+    personas = {}
+    plans = {}
+    rounds = {}
+    variants = {}
+    comparisons = {}
+    if not os.path.exists(path):
+        return personas, plans, rounds, variants, comparisons
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中で停止した最終行は無視する
+                continue
+            if record.get("type") in ("persona", "duplicate"):
+                personas.setdefault(record["job_id"], {})[record["index"]] = record
+            elif record.get("type") == "plan":
+                plans[record["job_id"]] = record["revised_service_req"]
+            elif record.get("type") == "round":
+                rounds.setdefault(record["job_id"], {})[record["round"]] = record
+            elif record.get("type") == "variant":
+                variants.setdefault(record["job_id"], {})[(record["variant"], record["index"])] = record
+            elif record.get("type") == "comparison":
+                comparisons[record["job_id"]] = record
+    return personas, plans, rounds, variants, comparisons
+
+def append_record(f, record):
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+def run_job(job, output_file, completed, concurrency, persona_batch_size, duplicate_threshold, exporter=None, cache_mode=None, cascade=None):
+    # cache_modeとcascadeは、この実行だけの応答キャッシュのモードと段階的なモデルの使用（以下の関数も同じ）
+    remaining = [index for index in range(job["count"]) if index not in completed]
+    # 再開時は出力済みの人物も含めて、ほぼ同じ人物かを判定する
+    persona_index = PersonaIndex(duplicate_threshold)
+    for index, record in completed.items():
+        if record["type"] == "persona":
+            persona_index.add(index, Character.model_validate(record["character"]))
+    # 目標の精度がある場合は、出力済みの需要レベルも含めて信頼区間を求め、収まった時点で新しい人物の投入を止める
+    stopper = None
+    if job.get("target_half_width") is not None:
+        stopper = AdaptiveStopper(job["target_half_width"])
+        for index in sorted(completed):
+            if completed[index]["type"] == "persona":
+                stopper.add(completed[index]["opinion"]["want_level"])
+        if stopper.converged():
+            remaining = []
+    if exporter is not None:
+        # 書き出しは未完了の人物の番号順に行う
+        exporter.expect(remaining)
+    if remaining:
+        limit = "最大" if stopper is not None else ""
+        print(f"[{job['job_id']}] {job['service_title']}: {limit}{len(remaining)}/{job['count']}人を生成します")
+    characters = {}
+    if remaining and job["use_library"]:
+        drawn = persona_library.sample(job["gender"], job["age_range_start"], job["age_range_end"], len(remaining))
+        characters = {index: character for index, (_, character) in zip(remaining, drawn)}
+        print(f"[{job['job_id']}] 保存済みの人物から{len(characters)}人を使用し、{len(remaining) - len(characters)}人を新たに生成します")
+
+    for result in RunPersonaPipelines(
+        job["count"], job["service_title"], job["service_req"], job["gender"], job["age_range_start"], job["age_range_end"],
+        job["backend"] == "local", max_workers=concurrency, indices=remaining, stop_on_error=False,
+        comment_mode=job["comment_mode"], fused=job["fused"], persona_batch_size=persona_batch_size,
+        characters=characters, persona_index=persona_index, stop_when=stopper.converged if stopper else None, cache_mode=cache_mode, cascade=cascade
+    ):
+        if result.duplicate_of is not None:
+            # 除外した人物も完了として記録し、再開時に作り直さない
+            record = {"type": "duplicate", "job_id": job["job_id"], "index": result.index, "duplicate_of": result.duplicate_of}
+            append_record(output_file, record)
+            completed[result.index] = record
+            print(f"[{job['job_id']}] {result.index + 1}人目: {result.error}", file=sys.stderr)
+            if exporter is not None:
+                exporter.skip(result.index)
+            continue
+        if result.error is not None:
+            print(f"[{job['job_id']}] {result.index + 1}人目の生成に失敗しました: {result.error}", file=sys.stderr)
+            if exporter is not None:
+                exporter.skip(result.index)
+            continue
+        record = {
+            "type": "persona",
+            "job_id": job["job_id"],
+            "index": result.index,
+            "character": result.character.model_dump(),
+            "comment": result.comment,
+            "comment_timings": result.comment_timings,
+            "opinion": result.opinion.model_dump(),
+        }
+        append_record(output_file, record)
+        completed[result.index] = record
+        if exporter is not None:
+            exporter.add(result.index, result.character, result.comment, result.opinion)
+        if stopper is not None:
+            stopper.add(result.opinion.want_level)
+        print(f"[{job['job_id']}] {result.index + 1}人目: {result.character.name} 需要レベル {result.opinion.want_level}")
+    return persona_index, stopper
+
+def interval_value(interval, signed=False):
+    # 評価できた人物がいない場合は平均を求められない
+    if interval is None or interval["count"] == 0:
+        return "—"
+    mean = f"{interval['mean']:+.2f}" if signed else f"{interval['mean']:.2f}"
+    if interval["half_width"] is None:
+        return mean
+    return f"{mean} ± {interval['half_width']:.2f}"
+
+def want_level_interval(completed):
+    return MeanConfidenceInterval([completed[index]["opinion"]["want_level"] for index in sorted(completed) if completed[index]["type"] == "persona"])
+
+def panel_complete(job, completed, stopper=None):
+    # 目標の精度に達して打ち切った場合は、最大人数に満たなくても揃ったとみなす
+    return len(completed) >= job["count"] or (stopper is not None and stopper.converged())
+
+def run_variants(job, output_file, completed, done, concurrency, memo, cache_mode=None, cascade=None):
+    # service_reqとvariantsを同じ人物のパネルで評価し、同じ人物どうしの需要レベルの差で比べる
+    # service_reqの評価と記録済みの組はmemoから返すため、評価し直さない
+    panel = {index: Character.model_validate(record["character"]) for index, record in completed.items() if record["type"] == "persona"}
+    variants = [job["service_req"], *job["variants"]]
+    RememberVariantRecords(
+        memo, panel, job["service_title"], variants,
+        [{"variant": 0, **record} for record in completed.values() if record["type"] == "persona"] + list(done.values()),
+        job["backend"] == "local", job["comment_mode"], job["fused"], cascade
+    )
+    print(f"[{job['job_id']}] {len(variants)}案を{len(panel)}人で比較します")
+    levels = {variant: {} for variant in range(len(variants))}
+    for variant, result in CompareVariants(
+        panel, job["service_title"], variants, job["backend"] == "local", memo=memo, max_workers=concurrency,
+        comment_mode=job["comment_mode"], fused=job["fused"], cache_mode=cache_mode, cascade=cascade
+    ):
+        if result.error is not None:
+            print(f"[{job['job_id']}] 案{VariantLabel(variant)}の{result.index + 1}人目の評価に失敗しました: {result.error}", file=sys.stderr)
+            continue
+        levels[variant][result.index] = result.opinion.want_level
+        if variant > 0 and (variant, result.index) not in done:
+            done[(variant, result.index)] = {
+                "type": "variant",
+                "job_id": job["job_id"],
+                "variant": variant,
+                "index": result.index,
+                "comment": result.comment,
+                "opinion": result.opinion.model_dump(),
+            }
+            append_record(output_file, done[(variant, result.index)])
+    rows = PairedComparison(levels)
+    # 評価に失敗した組がある場合は比較を記録せず、次回の再開時に失敗した組だけやり直す
+    if sum(len(variant_levels) for variant_levels in levels.values()) < len(panel) * len(variants):
+        print(f"[{job['job_id']}] 評価に失敗した組があるため、比較は次回の再開時に記録します", file=sys.stderr)
+    else:
+        append_record(output_file, {"type": "comparison", "job_id": job["job_id"], "variants": rows})
+    for row in rows:
+        versus = f", 案Aとの差 {interval_value(row['difference'], signed=True)}（上がった {row['higher']}人, 下がった {row['lower']}人）" if row["variant"] > 0 else ""
+        print(f"[{job['job_id']}] 案{row['label']}: 需要レベルの平均 {interval_value(row['want_level'])}（{row['want_level']['count']}人）{versus}")
+    return rows
+
+def run_plan(job, output_file, completed, stopper=None, cache_mode=None, cascade=None):
+    if not panel_complete(job, completed, stopper):
+        print(f"[{job['job_id']}] 未完了の人物があるため、サービス改良は次回の再開時に行います", file=sys.stderr)
+        return
+    persona_list = [completed[index]["comment"] for index in sorted(completed) if completed[index]["type"] == "persona"]
+    try:
+        revised_service_req = SuggestBusinessPlan(job["service_req"], persona_list, job["backend"] == "local", cache_mode=cache_mode, cascade=cascade)
+    except (CacheMissError, BackendUnavailableError) as e:
+        print(f"[{job['job_id']}] サービス改良に失敗しました: {e}", file=sys.stderr)
+        return
+    append_record(output_file, {"type": "plan", "job_id": job["job_id"], "revised_service_req": revised_service_req, "want_level": want_level_interval(completed)})
+    print(f"[{job['job_id']}] サービス改良完了")
+    return revised_service_req
+
+def run_rounds(job, output_file, completed, revised_service_req, done, concurrency, memo, cache_mode=None, cascade=None):
+    # 改良後のサービス要件を、同じ人物のパネルでコメント生成・意見要約だけやり直して評価し、その意見から再び改良する
+    # ラウンドは改良まで終えた時点で記録するため、再開時は記録済みのラウンドの改良案から続ける
+    panel = {index: Character.model_validate(record["character"]) for index, record in completed.items() if record["type"] == "persona"}
+    service_req = revised_service_req
+    for round_number in range(1, job["rounds"] + 1):
+        if round_number in done:
+            service_req = done[round_number]["revised_service_req"]
+            continue
+        results = {}
+        for result in EvaluatePanel(
+            panel, job["service_title"], service_req, job["backend"] == "local", memo=memo, max_workers=concurrency,
+            comment_mode=job["comment_mode"], fused=job["fused"], cache_mode=cache_mode, cascade=cascade
+        ):
+            if result.error is not None:
+                print(f"[{job['job_id']}] ラウンド{round_number}の{result.index + 1}人目の評価に失敗しました: {result.error}", file=sys.stderr)
+                continue
+            results[result.index] = result
+        if not results:
+            return
+        revised = None
+        if round_number < job["rounds"]:
+            try:
+                revised = RevisePlan(service_req, [results[index].comment for index in sorted(results)], job["backend"] == "local", memo=memo, cache_mode=cache_mode, cascade=cascade)
+            except (CacheMissError, BackendUnavailableError) as e:
+                print(f"[{job['job_id']}] ラウンド{round_number}のサービス改良に失敗しました: {e}", file=sys.stderr)
+                return
+        interval = MeanConfidenceInterval([result.opinion.want_level for result in results.values()])
+        append_record(output_file, {
+            "type": "round",
+            "job_id": job["job_id"],
+            "round": round_number,
+            "service_req": service_req,
+            "personas": [{"index": index, "comment": results[index].comment, "opinion": results[index].opinion.model_dump()} for index in sorted(results)],
+            "want_level": interval,
+            "revised_service_req": revised,
+        })
+        print(f"[{job['job_id']}] ラウンド{round_number}: 需要レベルの平均 {interval['mean']:.2f}（{interval['count']}人）")
+        if revised is None:
+            return
+        service_req = revised
+
+def main():
+    parser = argparse.ArgumentParser(description="ジョブ定義のJSONLを読み込み、ペルソナ生成からサービス改良までをまとめて実行します。")
+    parser.add_argument("--input", default="requests.jsonl", help="ジョブ定義のJSONLファイル")
+    parser.add_argument("--output", default="results.jsonl", help="結果を追記するJSONLファイル")
+    parser.add_argument("--concurrency", type=int, default=1, help="同時に生成する人数")
+    parser.add_argument("--cache-mode", choices=CACHE_MODES, default=response_cache.mode, help="LLM応答のキャッシュ")
+    parser.add_argument("--persona-batch-size", type=int, default=1, help="1回の呼び出しで生成する人物の数")
+    parser.add_argument("--comment-mode", choices=COMMENT_MODES, default="debate", help="ジョブで指定がない場合のコメント生成方法")
+    parser.add_argument("--cascade", action=argparse.BooleanOptionalAction, default=stage_models.enabled, help="下書き・要約・抽出は小さいローカルモデル（LOCAL_SMALL_MODEL）で行い、不十分な場合のみ大きいモデルでやり直す")
+    parser.add_argument("--fused", action="store_true", help="ジョブで指定がない場合に、コメントと需要レベルを同時に生成する")
+    parser.add_argument("--use-library", action="store_true", help="ジョブで指定がない場合に、保存済みの人物を優先して使い、不足分のみ生成する")
+    parser.add_argument("--duplicate-threshold", type=float, default=DUPLICATE_THRESHOLD, help="生成済みの人物とほぼ同じとみなす類似度（0〜1、1で完全一致のみ）")
+    parser.add_argument("--target-half-width", type=float, help="ジョブで指定がない場合に、需要レベルの平均の信頼区間（95%%）がこの幅（±）に収まった時点で生成を打ち切る（countは最大人数になる）")
+    parser.add_argument("--rounds", type=int, default=0, help="ジョブで指定がない場合に、改良後のサービス要件を同じ人物で再評価する回数")
+    parser.add_argument("--export-dir", help="人物ごとの結果をジョブ単位のCSV/Parquet（<job_id>.csv / <job_id>.parquet）としても書き出すディレクトリ")
+    parser.add_argument("--export-formats", nargs="+", choices=EXPORT_FORMATS, default=list(EXPORT_FORMATS), help="--export-dirに書き出す形式")
+    parser.add_argument("--no-resume", action="store_true", help="出力済みの結果を無視して最初から実行する")
+    parser.add_argument("--metrics-json", help="ステージごとの所要時間・トークン数などの実行レポートを書き出すJSONファイル")
+    parser.add_argument("--metrics-textfile", default=METRICS_TEXTFILE, help="同じ内容をPrometheusのtextfile形式で書き出すファイル")
+    args = parser.parse_args()
+
+    # キャッシュのモードと段階的なモデルの使用は、全体の設定を変えずにこの実行の呼び出しにだけ渡す
+    if args.no_resume:
+        personas, plans, rounds, variants, comparisons = {}, {}, {}, {}, {}
+    else:
+        personas, plans, rounds, variants, comparisons = load_checkpoint(args.output)
+    stage_memo = StageMemo()
+
+    with open(args.output, "w" if args.no_resume else "a", encoding="utf-8") as output_file:
+        # 途中で停止して改行のない行が残っている場合は、次の記録と混ざらないよう改行を補う
+        if output_file.tell() > 0:
+            with open(args.output, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    output_file.write("\n")
+        for job in read_jobs(args.input, {"comment_mode": args.comment_mode, "fused": args.fused, "use_library": args.use_library, "target_half_width": args.target_half_width, "rounds": args.rounds}):
+            completed = personas.setdefault(job["job_id"], {})
+            done_rounds = rounds.get(job["job_id"], {})
+            done_variants = variants.setdefault(job["job_id"], {})
+            compare = bool(job.get("variants")) and job["job_id"] not in comparisons
+            if job["job_id"] in plans:
+                if len(done_rounds) >= job.get("rounds", 0) and not compare:
+                    print(f"[{job['job_id']}] 完了済みのため読み飛ばします")
+                    continue
+                if compare:
+                    run_variants(job, output_file, completed, done_variants, args.concurrency, stage_memo, cache_mode=args.cache_mode, cascade=args.cascade)
+                if len(done_rounds) < job.get("rounds", 0):
+                    run_rounds(job, output_file, completed, plans[job["job_id"]], done_rounds, args.concurrency, stage_memo, cache_mode=args.cache_mode, cascade=args.cascade)
+                continue
+            if args.export_dir:
+                # CSVはジョブごとに追記し、Parquetは終了時にCSV全体から作り直す
+                with StreamingExporter(args.export_dir, stem=job["job_id"], formats=args.export_formats, append=not args.no_resume) as exporter:
+                    persona_index, stopper = run_job(job, output_file, completed, args.concurrency, args.persona_batch_size, args.duplicate_threshold, exporter, cache_mode=args.cache_mode, cascade=args.cascade)
+            else:
+                exporter = None
+                persona_index, stopper = run_job(job, output_file, completed, args.concurrency, args.persona_batch_size, args.duplicate_threshold, cache_mode=args.cache_mode, cascade=args.cascade)
+            diversity = persona_index.diversity()
+            if diversity["diversity"] is not None:
+                print(f"[{job['job_id']}] 多様性 {diversity['diversity']:.2f}（最も似ている2人: {diversity['closest_pair'][0] + 1}人目と{diversity['closest_pair'][1] + 1}人目, 類似度 {diversity['closest_similarity']:.2f}）, 作り直し {persona_index.regenerated}人, 除外 {persona_index.rejected}人")
+            interval = want_level_interval(completed)
+            if interval["half_width"] is not None:
+                converged = "（目標の精度に達したため打ち切り）" if stopper is not None and stopper.converged() else ""
+                print(f"[{job['job_id']}] 需要レベルの平均 {interval['mean']:.2f} ± {interval['half_width']:.2f}（{interval['count']}人）{converged}")
+            summary = {
+                "job_id": job["job_id"],
+                "want_level": interval,
+                "target_half_width": job.get("target_half_width"),
+                "max_people": job["count"],
+                "stopped_early": stopper is not None and stopper.converged(),
+                "diversity": diversity["diversity"],
+            }
+            if exporter is not None:
+                exporter.write_summary(summary)
+            if compare and panel_complete(job, completed, stopper):
+                summary["variants"] = run_variants(job, output_file, completed, done_variants, args.concurrency, stage_memo, cache_mode=args.cache_mode, cascade=args.cascade)
+                if exporter is not None:
+                    exporter.write_summary(summary)
+            revised_service_req = run_plan(job, output_file, completed, stopper, cache_mode=args.cache_mode, cascade=args.cascade)
+            if revised_service_req and job.get("rounds"):
+                run_rounds(job, output_file, completed, revised_service_req, done_rounds, args.concurrency, stage_memo, cache_mode=args.cache_mode, cascade=args.cascade)
+
+    output_stats = structured_output_stats.snapshot()
+    print(f"構造化出力: パース失敗 {output_stats['parse_failures']}件（{output_stats['parse_failure_rate']:.0%}）, 修復 {output_stats['saved_calls']}件（手元で修正 {output_stats['repaired_locally']}件, 不足項目のみ再取得 {output_stats['repaired_by_reask']}件）, 修復不能 {output_stats['unrepaired']}件")
+    for row in run_metrics.summary():
+        print(f"  {row['stage']}（{row['backend']}）: {row['calls']}回, 合計 {row['latency_total']:.1f}秒, p95 {row['latency_p95']:.1f}秒, トークン {row['prompt_tokens']}/{row['completion_tokens']}, 再試行 {row['retries']}回, キャッシュヒット {row['cache_hits']}件")
+    for row in cascade_stats.snapshot():
+        print(f"  {row['stage']}（段階的）: 小さいモデルで完了 {row['accepted']}件, 大きいモデルでやり直し {row['escalated']}件（{row['escalation_rate']:.0%}）")
+    local_pool = model_registry.loaded("local")
+    if isinstance(local_pool, BackendPool):
+        for row in local_pool.stats():
+            throughput = f"{row['tokens_per_second']:.1f}トークン/秒" if row["tokens_per_second"] is not None else "-"
+            concurrency = f"{row['mean_concurrency']:.2f}" if row["mean_concurrency"] is not None else "-"
+            print(f"  接続先 {row['name']}（{row['model']}{', 予備' if row['overflow'] else ''}）: {row['calls']}回, 失敗 {row['errors']}回, 切り替え {row['failovers']}回, 出力 {throughput}, 平均同時実行数 {concurrency}")
+    if args.metrics_json:
+        run_metrics.write_json(args.metrics_json)
+    if args.metrics_textfile:
+        run_metrics.write_prometheus(args.metrics_textfile)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import json
+import logging
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+def legacy_update_graph(placeholder, graph_data, plt, index, name, level):
+    # 以前のupdate_graphと同じく、1人ごとに新しい図を作り、閉じずに描画する
+    graph_data.append((index, name, level))
+    graph_data.sort(key=lambda item: item[0])
+    fig, ax = plt.subplots()
+    _, names, levels = zip(*graph_data)
+    ax.bar(names, levels)
+    ax.set_title("サービスの需要レベル")
+    ax.set_xlabel("人物名")
+    ax.set_ylabel("需要レベル")
+    placeholder.pyplot(fig)
+
+def run_child(mode, count, seed):
+    # Streamlitのサーバーを起動せずに（bareモード）、要素の生成と送信用データへの変換までを計測する
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    import streamlit as st
+
+    from dists.DemandChart import RenderDemandChart
+
+    random.seed(seed)
+    order = list(range(count))
+    random.shuffle(order)
+    placeholder = st.empty()
+
+    if mode == "legacy":
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        graph_data = []
+
+        def update(index, level):
+            legacy_update_graph(placeholder, graph_data, plt, index, f"人物{index + 1}", level)
+    else:
+        levels = {}
+
+        def update(index, level):
+            levels[index] = (f"人物{index + 1}", level)
+            RenderDemandChart(placeholder, levels)
+
+    # 初回の描画に含まれるライブラリの読み込みは計測から除く
+    warmup = st.empty()
+    if mode == "legacy":
+        fig, ax = plt.subplots()
+        ax.bar(["-"], [0])
+        warmup.pyplot(fig)
+        plt.close(fig)
+    else:
+        RenderDemandChart(warmup, {0: ("-", 0)})
+
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    update_times = []
+    for index in order:
+        start = time.perf_counter()
+        update(index, random.randint(0, 10))
+        update_times.append(time.perf_counter() - start)
+    end_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    update_times.sort()
+    return {
+        "count": count,
+        "total_seconds": sum(update_times),
+        "mean_ms": statistics.mean(update_times) * 1000,
+        "p95_ms": update_times[int(len(update_times) * 0.95) - 1] * 1000 if update_times else 0.0,
+        "max_ms": update_times[-1] * 1000 if update_times else 0.0,
+        "rss_growth_mb": (end_rss - start_rss) / 1024,
+        "open_figures": len(plt.get_fignums()) if mode == "legacy" else 0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="需要レベルのグラフを1人ずつ更新した場合の描画時間とメモリ使用量を、以前のmatplotlibによる描画と比較します。リポジトリ直下で python -m benchmarks.chart_benchmark として実行してください。")
+    parser.add_argument("--count", type=int, default=1000, help="更新する人数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", choices=("session", "legacy"), default=["session", "legacy"])
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    parser.add_argument("--child", choices=("session", "legacy"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.count, args.seed)))
+        return
+
+    # メモリ使用量を比べるため、方式ごとに別のプロセスで計測する
+    results = {}
+    for mode in args.modes:
+        command = [sys.executable, "-W", "ignore", "-m", "benchmarks.chart_benchmark", "--child", mode, "--count", str(args.count), "--seed", str(args.seed)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    for mode, row in results.items():
+        print(f"{mode:>7}: {row['count']}人, 合計 {row['total_seconds']:.1f}秒, 平均 {row['mean_ms']:.1f}ミリ秒/人, p95 {row['p95_ms']:.1f}ミリ秒, 最大 {row['max_ms']:.1f}ミリ秒, 最大RSSの増加 {row['rss_growth_mb']:.0f}MB, 開いたままの図 {row['open_figures']}枚")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 実際のモデルの代わりに、Ollamaと同じ /api/generate を返す決定的なサーバー
+# 同じプロンプトに対する n 回目の応答は、seedが同じなら常に同じ内容・同じ失敗になる
+
+SURNAMES = ("佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村", "小林", "加藤", "吉田", "山田")
+GIVEN_NAMES = ("陽菜", "蓮", "結衣", "湊", "美咲", "大翔", "葵", "悠真", "凛", "颯太", "花子", "太郎")
+FILLER = "このサービスは日々の暮らしに彩りを添えてくれそうですが、価格と手間のバランスが気になります。"
+
+class FakeSettings:
+    def __init__(self, latency=0.2, tokens_per_second=50.0, prefill_tokens_per_second=0.0, error_rate=0.0, malformed_rate=0.0, text_length=500, parallel=4, seed=0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.text_length = text_length
+        self.parallel = parallel
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+def _Text(rng, length):
+    start = rng.randrange(len(FILLER))
+    text = (FILLER * (length // len(FILLER) + 2))[start:start + length]
+    return text
+
+def _FromSchema(schema, root, rng, prompt, settings, key=None):
+    if "$ref" in schema:
+        schema = root["$defs"][schema["$ref"].rsplit("/", 1)[-1]]
+    if "anyOf" in schema:
+        schema = next((option for option in schema["anyOf"] if option.get("type") != "null"), schema["anyOf"][0])
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {name: _FromSchema(value, root, rng, prompt, settings, name) for name, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        count = re.search(r"(\d+)人", prompt) if key == "characters" else None
+        count = int(count.group(1)) if count else rng.randint(1, 3)
+        return [_FromSchema(schema.get("items", {}), root, rng, prompt, settings) for _ in range(count)]
+    if schema_type == "integer":
+        if key == "age":
+            return rng.randint(18, 80)
+        return rng.randint(0, 10)
+    if schema_type == "number":
+        return round(rng.random() * 10, 2)
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    if key == "name":
+        return f"{rng.choice(SURNAMES)} {rng.choice(GIVEN_NAMES)}{rng.randint(1, 99999)}"
+    if key == "comment":
+        return _Text(rng, settings.text_length)
+    return _Text(rng, rng.randint(10, 40))
+
+def _Malform(text, rng):
+    # よくある崩れ: 途中で切れる / 末尾のカンマ / 説明文付きのコードブロック
+    kind = rng.randrange(3)
+    if kind == 0:
+        return text[:max(1, int(len(text) * rng.uniform(0.6, 0.95)))]
+    if kind == 1:
+        return text[:-1] + ",}"
+    return f"以下が出力です。\n```json\n{text}\n```"
+
+class FakeOllamaServer:
+    def __init__(self, settings=None, host="127.0.0.1", port=0):
+        self.settings = settings or FakeSettings()
+        self._lock = threading.Lock()
+        self._prompt_counts = {}
+        self._slots = threading.BoundedSemaphore(max(1, self.settings.parallel))
+        self.requests = 0
+        self.errors = 0
+        self.malformed = 0
+        self.stopped = False
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # 接続済みのクライアントにも応答しなくなるようにする（サーバーが落ちた状態を再現する）
+        self.stopped = True
+        # start()していない場合はserve_foreverが動いていないため、shutdownを待たずに閉じる
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()
+
+    def _rng(self, prompt):
+        with self._lock:
+            count = self._prompt_counts.get(prompt, 0)
+            self._prompt_counts[prompt] = count + 1
+            self.requests += 1
+        digest = hashlib.sha256(f"{self.settings.seed}:{count}:{prompt}".encode("utf-8")).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def respond(self, request):
+        # (HTTPステータス, 応答テキスト, プロンプトのトークン数) を返す
+        prompt = request.get("prompt", "")
+        rng = self._rng(prompt)
+        if rng.random() < self.settings.error_rate:
+            with self._lock:
+                self.errors += 1
+            return 500, None, 0
+        schema = request.get("format")
+        if isinstance(schema, dict):
+            text = json.dumps(_FromSchema(schema, schema, rng, prompt, self.settings), ensure_ascii=False)
+        elif schema == "json":
+            text = json.dumps({"response": _Text(rng, self.settings.text_length)}, ensure_ascii=False)
+        else:
+            text = _Text(rng, self.settings.text_length)
+        if schema and rng.random() < self.settings.malformed_rate:
+            with self._lock:
+                self.malformed += 1
+            text = _Malform(text, rng)
+        return 200, text, len(prompt)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._send_json(200, {"models": [{"name": "fake", "model": "fake"}]})
+                else:
+                    self._send_json(200, {"status": "Ollama is running"})
+
+            def do_POST(self):
+                if server.stopped:
+                    self.close_connection = True
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/api/generate":
+                    self._send_json(404, {"error": f"{self.path} is not supported"})
+                    return
+                with server._slots:
+                    self._generate(request)
+
+            def _generate(self, request):
+                settings = server.settings
+                start = time.perf_counter()
+                status, text, prompt_tokens = server.respond(request)
+                prefill = settings.latency
+                if settings.prefill_tokens_per_second > 0:
+                    prefill += prompt_tokens / settings.prefill_tokens_per_second
+                time.sleep(prefill)
+                if status != 200:
+                    self._send_json(status, {"error": "fake server error"})
+                    return
+
+                model = request.get("model", "fake")
+                chunk_size = 4
+                final = {
+                    "model": model, "created_at": datetime.now(timezone.utc).isoformat(), "response": "", "done": True, "done_reason": "stop",
+                    "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int(prefill * 1e9),
+                    "eval_count": len(text), "eval_duration": int(len(text) / settings.tokens_per_second * 1e9) if settings.tokens_per_second > 0 else 0,
+                }
+                if request.get("stream", True) is False:
+                    time.sleep(len(text) / settings.tokens_per_second if settings.tokens_per_second > 0 else 0)
+                    final["response"] = text
+                    final["total_duration"] = int((time.perf_counter() - start) * 1e9)
+                    self._send_json(200, final)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for position in range(0, len(text), chunk_size):
+                    piece = text[position:position + chunk_size]
+                    if settings.tokens_per_second > 0:
+                        time.sleep(len(piece) / settings.tokens_per_second)
+                    self._write_chunk({"model": model, "created_at": datetime.now(timezone.utc).isoformat(), "response": piece, "done": False})
+                final["total_duration"] = int((time.perf_counter() - start) * 1e9)
+                self._write_chunk(final)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, body):
+                data = (json.dumps(body, ensure_ascii=False) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+def add_settings_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.2, help="最初のトークンまでの待ち時間（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="出力の速度（1文字を1トークンとして数える）")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=0.0, help="プロンプトの処理速度（0の場合はプロンプトの長さを考慮しない）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="HTTP 500を返す割合")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="JSON出力を崩して返す割合")
+    parser.add_argument("--text-length", type=int, default=500, help="文章の出力の文字数")
+    parser.add_argument("--server-parallel", type=int, default=4, help="同時に生成する数（OLLAMA_NUM_PARALLEL相当）")
+    parser.add_argument("--seed", type=int, default=0)
+
+def settings_from_args(args):
+    return FakeSettings(
+        latency=args.latency, tokens_per_second=args.tokens_per_second, prefill_tokens_per_second=args.prefill_tokens_per_second,
+        error_rate=args.error_rate, malformed_rate=args.malformed_rate, text_length=args.text_length,
+        parallel=args.server_parallel, seed=args.seed,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama互換の偽サーバーを起動します。OLLAMA_HOSTにこのサーバーのURLを設定すると、アプリやバッチ実行をモデルなしで動かせます。")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(settings_from_args(args), args.host, args.port)
+    print(f"{server.url} で待ち受けています（OLLAMA_HOST={server.url}）")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# dists以下のモジュールは読み込み時に環境変数から設定を読むため、先に.envを読み込む
+load_dotenv()
+
+from dists.GeneratePersona import Character, GenerateHumanModel
+from dists.PersonaPipeline import EvaluateCharacter
+
+# (comment_mode, fused) → 1人あたりのLLM呼び出し回数（人物生成を除く）
+MODES = {
+    ("debate", False): 4,
+    ("debate", True): 3,
+    ("single", False): 2,
+    ("single", True): 1,
+}
+BASELINE = ("debate", False)
+
+def load_panel(args):
+    if args.characters:
+        with open(args.characters, encoding="utf-8") as f:
+            return [Character.model_validate_json(line) for line in f if line.strip()]
+    panel = []
+    for index in range(args.panel_size):
+        character = GenerateHumanModel(args.gender, args.age_range_start, args.age_range_end, args.use_local, sample_index=index)
+        if character is not None:
+            panel.append(character)
+    return panel
+
+def summarize(levels):
+    histogram = [0] * 11
+    for level in levels:
+        histogram[min(10, max(0, level))] += 1
+    return {
+        "n": len(levels),
+        "mean": statistics.mean(levels) if levels else None,
+        "stdev": statistics.stdev(levels) if len(levels) > 1 else 0.0,
+        "histogram": histogram,
+    }
+
+def compare(levels, baseline_levels):
+    # 同じ人物どうしの差（対応のある比較）と、分布全体の差（累積分布の最大差）
+    pairs = [(level, base) for level, base in zip(levels, baseline_levels) if level is not None and base is not None]
+    if not pairs:
+        return {}
+    differences = [level - base for level, base in pairs]
+    cdf_distance = 0.0
+    for threshold in range(11):
+        ratio = sum(level <= threshold for level, _ in pairs) / len(pairs)
+        base_ratio = sum(base <= threshold for _, base in pairs) / len(pairs)
+        cdf_distance = max(cdf_distance, abs(ratio - base_ratio))
+    return {
+        "mean_difference": statistics.mean(differences),
+        "mean_absolute_difference": statistics.mean(abs(difference) for difference in differences),
+        "cdf_max_distance": cdf_distance,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="同じ人物パネルに対して、コメント生成方法ごとの需要レベルの分布を比較します。リポジトリ直下で python -m benchmarks.mode_comparison として実行してください。")
+    parser.add_argument("--characters", help="人物のJSONL（1行に1人。省略時は生成）")
+    parser.add_argument("--panel-size", type=int, default=10)
+    parser.add_argument("--gender", default="女性")
+    parser.add_argument("--age-range-start", default="20")
+    parser.add_argument("--age-range-end", default="30")
+    parser.add_argument("--service-title", default="フラデリ")
+    parser.add_argument("--service-req", default="花のサブスクリプションサービス。週1回、季節の花を550円からポスト投函で届ける。")
+    parser.add_argument("--gemini", dest="use_local", action="store_false", help="Geminiを使用する")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    panel = load_panel(args)
+    if not panel:
+        raise SystemExit("人物パネルを用意できませんでした。")
+
+    levels = {}
+    report = {}
+    for mode, calls in MODES.items():
+        comment_mode, fused = mode
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(
+                lambda item: EvaluateCharacter(item[0], item[1], args.service_title, args.service_req, args.use_local, comment_mode=comment_mode, fused=fused),
+                enumerate(panel)
+            ))
+        elapsed = time.perf_counter() - start
+        levels[mode] = [result.opinion.want_level if result.opinion else None for result in results]
+        report[f"{comment_mode}{'+fused' if fused else ''}"] = {
+            "calls_per_persona": calls,
+            "seconds": elapsed,
+            **summarize([level for level in levels[mode] if level is not None]),
+            "vs_baseline": compare(levels[mode], levels[BASELINE]) if mode != BASELINE else {},
+        }
+
+    for name, row in report.items():
+        mean = f"{row['mean']:.2f}" if row["mean"] is not None else "-"
+        line = f"{name:>13}: 呼び出し {row['calls_per_persona']}回/人, {row['seconds']:.1f}秒, 平均 {mean}, 標準偏差 {row['stdev']:.2f}, 分布 {row['histogram']}"
+        if row["vs_baseline"]:
+            line += f", 基準との差 {row['vs_baseline']['mean_difference']:+.2f}（絶対差 {row['vs_baseline']['mean_absolute_difference']:.2f}, CDF最大差 {row['vs_baseline']['cdf_max_distance']:.2f}）"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"panel_size": len(panel), "modes": report}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import subprocess
+import time
+
+from benchmarks.fake_ollama import FakeOllamaServer, FakeSettings, add_settings_arguments, settings_from_args
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], check=True, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+def percentile(values, ratio):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+def run_point(args, panel_size, concurrency):
+    # 1つの（人数, 並列数）の組について、ペルソナ生成からサービス改良までを実際のコードで実行する
+    from dists.Metrics import run_metrics
+    from dists.ModelCascade import cascade_stats
+    from dists.PersonaPipeline import RunPersonaPipelines
+    from dists.PlanRevisons import SuggestBusinessPlan
+    from dists.RetryPolicy import BackendUnavailableError, circuit_breakers
+
+    # 前の計測で開いたサーキットブレーカーを閉じておく
+    for breaker in circuit_breakers.values():
+        breaker.record_success()
+    cascade_stats.reset()
+
+    since = time.time()
+    start = time.perf_counter()
+    comments = []
+    failed = 0
+    for result in RunPersonaPipelines(
+        panel_size, args.service_title, args.service_req, "女性", "20", "40", True,
+        max_workers=concurrency, stop_on_error=False, comment_mode=args.comment_mode, fused=args.fused,
+        persona_batch_size=args.persona_batch_size
+    ):
+        if result.error is None:
+            comments.append(result.comment)
+        else:
+            failed += 1
+    personas_seconds = time.perf_counter() - start
+
+    plan_error = None
+    if comments:
+        try:
+            if SuggestBusinessPlan(args.service_req, comments, True) is None:
+                plan_error = "empty"
+        except BackendUnavailableError as e:
+            plan_error = str(e)
+    total_seconds = time.perf_counter() - start
+
+    # 段階的にモデルを使う場合、1つのステージの呼び出しが小さいモデルと大きいモデルに分かれるため、バックエンドをまたいで集計する
+    stages = {}
+    latencies = {}
+    for record in run_metrics.records(since):
+        row = stages.setdefault(record.stage, {"calls": 0, "backends": {}, "errors": 0, "retries": 0, "parse_failures": 0, "latency_total": 0.0})
+        row["calls"] += 1
+        row["backends"][record.backend] = row["backends"].get(record.backend, 0) + 1
+        row["errors"] += record.error is not None
+        row["retries"] += max(0, record.attempts - 1)
+        row["parse_failures"] += record.parse_failures
+        row["latency_total"] += record.latency or 0.0
+        latencies.setdefault(record.stage, []).append(record.latency or 0.0)
+    for stage, row in stages.items():
+        row["p50"] = percentile(latencies[stage], 0.5)
+        row["p95"] = percentile(latencies[stage], 0.95)
+    return {
+        "panel_size": panel_size,
+        "concurrency": concurrency,
+        "succeeded": len(comments),
+        "failed": failed,
+        "personas_seconds": personas_seconds,
+        "total_seconds": total_seconds,
+        "personas_per_minute": len(comments) / personas_seconds * 60 if personas_seconds else 0.0,
+        "plan_error": plan_error,
+        "stages": stages,
+        "cascade": cascade_stats.snapshot(),
+    }
+
+def load_previous(path, config):
+    # 同じ条件で計測した直近の結果を探す（段階的にモデルを使った計測の比較には、cascadeだけを変えた条件を渡す）
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("config") == config:
+                previous = record
+    return previous
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama互換の偽サーバーに対して実際のパイプライン（人物生成・コメント生成・意見要約・サービス改良）を実行し、スループットとステージごとの所要時間を計測します。リポジトリ直下で python -m benchmarks.pipeline_benchmark として実行してください。")
+    parser.add_argument("--panel-sizes", type=int, nargs="+", default=[4, 8, 16], help="計測する人数")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4], help="計測する並列数")
+    parser.add_argument("--comment-mode", choices=("debate", "single"), default="debate")
+    parser.add_argument("--fused", action="store_true")
+    parser.add_argument("--persona-batch-size", type=int, default=1)
+    parser.add_argument("--service-title", default="フラデリ")
+    parser.add_argument("--service-req", default="花のサブスクリプションサービス。週1回、季節の花を550円からポスト投函で届ける。")
+    parser.add_argument("--retry-base-delay", type=float, default=0.05, help="再試行の待ち時間の基準（秒）。計測を短くするため既定値より短くしている")
+    parser.add_argument("--cascade", action="store_true", help="下書き・要約・抽出を小さいモデルで行う（小さいモデル用の偽サーバーを別に起動し、同じ条件でcascadeなしの直近の結果と比べる）")
+    parser.add_argument("--small-speedup", type=float, default=4.0, help="小さいモデル用の偽サーバーを、大きいモデルの何倍速くするか（待ち時間と出力の速度に掛ける）")
+    parser.add_argument("--servers", type=int, default=1, help="起動する偽サーバーの数（2以上の場合はOLLAMA_ENDPOINTSで全サーバーに振り分ける）")
+    parser.add_argument("--output", default="benchmarks/pipeline_results.jsonl", help="結果を追記するJSONLファイル（コミット間の比較に使う）")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    # モデルを作る前に、接続先を偽サーバーへ向ける
+    servers = [FakeOllamaServer(settings_from_args(args)).start() for _ in range(max(1, args.servers))]
+    server = servers[0]
+    os.environ["OLLAMA_HOST"] = server.url
+    os.environ["OLLAMA_ENDPOINTS"] = ",".join(fake.url for fake in servers) if len(servers) > 1 else ""
+    os.environ["POOL_MAX_IN_FLIGHT"] = str(args.server_parallel)
+    small_server = None
+    if args.cascade:
+        settings = settings_from_args(args)
+        small_settings = FakeSettings(**{**settings.to_dict(), "latency": settings.latency / args.small_speedup, "tokens_per_second": settings.tokens_per_second * args.small_speedup})
+        small_server = FakeOllamaServer(small_settings).start()
+        os.environ["OLLAMA_SMALL_ENDPOINTS"] = small_server.url
+    os.environ["MODEL_CASCADE"] = "1" if args.cascade else "0"
+
+    from dists.ModelCascade import cascade_retry_policy, stage_models
+    from dists.ModelRegistry import model_registry
+    from dists.ResponseCache import response_cache
+    from dists.RetryPolicy import default_retry_policy
+
+    model_registry.reset()
+    response_cache.mode = "off"
+    stage_models.enabled = args.cascade
+    default_retry_policy.base_delay = args.retry_base_delay
+    cascade_retry_policy.base_delay = args.retry_base_delay
+
+    config = {
+        "server": server.settings.to_dict(),
+        "comment_mode": args.comment_mode,
+        "fused": args.fused,
+        "persona_batch_size": args.persona_batch_size,
+        "servers": len(servers),
+        "service_req": args.service_req,
+    }
+    if args.cascade:
+        # 以前の結果と比べられるよう、段階的にモデルを使う場合のみ条件に加える
+        config["cascade"] = True
+        config["small_speedup"] = args.small_speedup
+    previous = load_previous(args.output, config)
+    previous_runs = {(run["panel_size"], run["concurrency"]): run for run in previous["runs"]} if previous else {}
+    # 段階的にモデルを使う場合は、大きいモデルのみで計測した直近の結果とステージごとに比べる
+    large_only = load_previous(args.output, {key: value for key, value in config.items() if key not in ("cascade", "small_speedup")}) if args.cascade else None
+    large_only_runs = {(run["panel_size"], run["concurrency"]): run for run in large_only["runs"]} if large_only else {}
+
+    runs = []
+    try:
+        for panel_size in args.panel_sizes:
+            for concurrency in args.concurrency:
+                run = run_point(args, panel_size, concurrency)
+                runs.append(run)
+                baseline = previous_runs.get((panel_size, concurrency))
+                delta = ""
+                if baseline and baseline["personas_per_minute"]:
+                    change = run["personas_per_minute"] / baseline["personas_per_minute"] - 1
+                    delta = f"（前回 {previous['commit']} 比 {change:+.1%}）"
+                print(f"{panel_size:>4}人 × 並列{concurrency:>2}: {run['personas_per_minute']:.1f}人/分{delta}, 成功 {run['succeeded']}人, 失敗 {run['failed']}人, 全体 {run['total_seconds']:.1f}秒")
+                large_only_stages = large_only_runs.get((panel_size, concurrency), {}).get("stages", {})
+                for stage, row in run["stages"].items():
+                    backends = "" if len(row["backends"]) < 2 else "（" + ", ".join(f"{backend} {calls}回" for backend, calls in row["backends"].items()) + "）"
+                    speedup = ""
+                    if large_only_stages.get(stage, {}).get("latency_total") and row["latency_total"]:
+                        speedup = f", 大きいモデルのみ比 {large_only_stages[stage]['latency_total'] / row['latency_total']:.2f}倍速"
+                    print(f"    {stage}: {row['calls']}回{backends}, 合計 {row['latency_total']:.2f}秒, p50 {row['p50']:.2f}秒, p95 {row['p95']:.2f}秒, 再試行 {row['retries']}回, パース失敗 {row['parse_failures']}件, 失敗 {row['errors']}件{speedup}")
+                for row in run["cascade"]:
+                    print(f"    {row['stage']}（段階的）: 小さいモデルで完了 {row['accepted']}件, 大きいモデルでやり直し {row['escalated']}件（{row['escalation_rate']:.0%}）")
+    finally:
+        for fake in servers + ([small_server] if small_server else []):
+            fake.stop()
+
+    endpoints = model_registry.loaded("local").stats()
+    for row in endpoints:
+        throughput = f"{row['tokens_per_second']:.0f}トークン/秒" if row["tokens_per_second"] is not None else "-"
+        print(f"接続先 {row['name']}: {row['calls']}回, 失敗 {row['errors']}回, 切り替え {row['failovers']}回, 出力 {throughput}")
+
+    record = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "config": config,
+        "server_requests": sum(fake.requests for fake in servers),
+        "small_server_requests": small_server.requests if small_server else 0,
+        "server_errors": sum(fake.errors for fake in servers),
+        "server_malformed": sum(fake.malformed for fake in servers),
+        "endpoints": endpoints,
+        "runs": runs,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(f"結果を {args.output} に追記しました（偽サーバーへのリクエスト {record['server_requests']}件, うちエラー {record['server_errors']}件, 形式不正 {record['server_malformed']}件）")
+
+if __name__ == "__main__":
+    main()
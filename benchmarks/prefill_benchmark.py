@@ -0,0 +1,99 @@
+import argparse
+import json
+import threading
+import time
+import uuid
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import RunnableLambda
+
+from dotenv import load_dotenv
+
+# dists以下のモジュールは読み込み時に環境変数から設定を読むため、先に.envを読み込む
+load_dotenv()
+
+from dists.GeneratePersona import Character, GenerateHumanModel, GenerateComment, OpinionSummerizer
+from dists.ModelRegistry import model_registry
+from dists.ResponseCache import response_cache
+
+class PrefillRecorder(BaseCallbackHandler):
+    # Ollamaの応答に含まれるprompt_eval_count / prompt_eval_durationを集計する
+    # prompt_eval_countはKVキャッシュで再利用されずに実際に計算されたトークン数
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = []
+
+    def on_llm_end(self, response, **kwargs):
+        info = response.generations[0][0].generation_info or {}
+        with self._lock:
+            self.calls.append({
+                "prompt_eval_count": info.get("prompt_eval_count", 0),
+                "prompt_eval_seconds": info.get("prompt_eval_duration", 0) / 1e9,
+                "eval_count": info.get("eval_count", 0),
+            })
+
+def run_persona(character, service_title, service_req, recorder):
+    recorder.calls.clear()
+    start = time.perf_counter()
+    comment = GenerateComment(service_title, service_req, character, True)
+    OpinionSummerizer(service_title, character, comment, True, service_data=service_req)
+    elapsed = time.perf_counter() - start
+    return {
+        "calls": len(recorder.calls),
+        "prefill_tokens": sum(call["prompt_eval_count"] for call in recorder.calls),
+        "prefill_seconds": sum(call["prompt_eval_seconds"] for call in recorder.calls),
+        "total_seconds": elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="ローカルのOllamaで、共通接頭辞によるプリフィル時間の削減量を1人あたりで計測します。リポジトリ直下で python -m benchmarks.prefill_benchmark として実行してください。")
+    parser.add_argument("--character", help="計測に使う人物のJSONファイル（省略時はGenerateHumanModelで生成）")
+    parser.add_argument("--service-title", default="フラデリ")
+    parser.add_argument("--service-req", default="花のサブスクリプションサービス。週1回、季節の花を550円からポスト投函で届ける。")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    # 計測のため、応答キャッシュは使わない
+    response_cache.mode = "off"
+
+    if args.character:
+        with open(args.character, encoding="utf-8") as f:
+            character = Character.model_validate_json(f.read())
+    else:
+        character = GenerateHumanModel("女性", "20", "30", True)
+        if character is None:
+            raise SystemExit("人物の生成に失敗しました。")
+
+    recorder = PrefillRecorder()
+    model_local = model_registry.get("local")
+    for member in model_local.members:
+        member.model.callbacks = [recorder]
+
+    # 比較用に、呼び出しごとに異なる文字列を先頭に付けてKVキャッシュの再利用を無効にしたモデル
+    cold_model = RunnableLambda(lambda prompt_value: model_local.invoke(f"[{uuid.uuid4()}]\n" + prompt_value.to_string()))
+
+    results = {}
+    for mode, model in (("shared_prefix", model_local), ("no_reuse", cold_model)):
+        model_registry.set("local", model)
+        results[mode] = [run_persona(character, args.service_title, args.service_req, recorder) for _ in range(args.repeats)]
+    model_registry.set("local", model_local)
+
+    summary = {}
+    for mode, runs in results.items():
+        summary[mode] = {key: sum(run[key] for run in runs) / len(runs) for key in ("prefill_tokens", "prefill_seconds", "total_seconds")}
+    summary["saved_per_persona"] = {
+        "prefill_tokens": summary["no_reuse"]["prefill_tokens"] - summary["shared_prefix"]["prefill_tokens"],
+        "prefill_seconds": summary["no_reuse"]["prefill_seconds"] - summary["shared_prefix"]["prefill_seconds"],
+    }
+
+    for mode in ("shared_prefix", "no_reuse"):
+        print(f"{mode:>14}: プリフィル {summary[mode]['prefill_tokens']:.0f}トークン / {summary[mode]['prefill_seconds']:.2f}秒, 合計 {summary[mode]['total_seconds']:.2f}秒")
+    print(f"1人あたりの削減量: {summary['saved_per_persona']['prefill_tokens']:.0f}トークン / {summary['saved_per_persona']['prefill_seconds']:.2f}秒")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"runs": results, "summary": summary}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
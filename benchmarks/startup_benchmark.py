@@ -0,0 +1,101 @@
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# 以前は初回表示の前に読み込んでいたモジュール（現在は使う時まで読み込まないか、使用していない）
+DEFERRED_MODULES = (
+    "pandas",
+    "matplotlib.pyplot",
+    "japanize_matplotlib",
+    "langchain_ollama.llms",
+    "google.generativeai",
+    "langchain_google_genai",
+)
+
+def run_child(eager, reruns):
+    # 新しいプロセスでmain.pyを実行し、初回表示と再実行にかかる時間を計測する
+    # eagerの場合は、遅延読み込みの導入前と同じく初回表示の前に全モジュールを読み込む
+    from streamlit.testing.v1 import AppTest
+
+    start = time.perf_counter()
+    if eager:
+        for module in DEFERRED_MODULES:
+            importlib.import_module(module)
+    app = AppTest.from_file(os.path.join(os.getcwd(), "main.py"), default_timeout=120)
+    app.run()
+    first_paint = time.perf_counter() - start
+    if app.exception:
+        raise SystemExit(f"main.pyの実行に失敗しました: {app.exception[0].message}")
+
+    rerun_times = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        rerun_times.append(time.perf_counter() - start)
+
+    # 初回表示の時点で読み込まれていなかったモジュールの読み込み時間（遅延によって初回表示から外れた分）
+    deferred = {}
+    for module in DEFERRED_MODULES:
+        if module in sys.modules:
+            continue
+        start = time.perf_counter()
+        importlib.import_module(module)
+        deferred[module] = time.perf_counter() - start
+
+    return {
+        "first_paint": first_paint,
+        "rerun": statistics.mean(rerun_times) if rerun_times else None,
+        "deferred_imports": deferred,
+    }
+
+def measure(eager, reruns):
+    command = [sys.executable, "-W", "ignore", "-m", "benchmarks.startup_benchmark", "--child", "--reruns", str(reruns)]
+    if eager:
+        command.append("--eager")
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Streamlitアプリの初回表示と再実行にかかる時間を、モジュールを先に読み込む場合と比較します。リポジトリ直下で python -m benchmarks.startup_benchmark として実行してください。")
+    parser.add_argument("--repeats", type=int, default=3, help="プロセスを起動し直して計測する回数")
+    parser.add_argument("--reruns", type=int, default=5, help="1プロセスあたりの再実行の回数")
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--eager", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.eager, args.reruns)))
+        return
+
+    results = {}
+    for mode, eager in (("lazy", False), ("eager", True)):
+        results[mode] = [measure(eager, args.reruns) for _ in range(args.repeats)]
+
+    summary = {}
+    for mode, runs in results.items():
+        summary[mode] = {
+            "first_paint": statistics.mean(run["first_paint"] for run in runs),
+            "rerun": statistics.mean(run["rerun"] for run in runs if run["rerun"] is not None) if args.reruns else None,
+        }
+    deferred = results["lazy"][0]["deferred_imports"]
+    summary["saved_first_paint"] = summary["eager"]["first_paint"] - summary["lazy"]["first_paint"]
+
+    for mode in ("lazy", "eager"):
+        rerun = f"{summary[mode]['rerun'] * 1000:.0f}ミリ秒" if summary[mode]["rerun"] is not None else "-"
+        print(f"{mode:>5}: 初回表示 {summary[mode]['first_paint']:.2f}秒, 再実行 {rerun}")
+    print(f"初回表示の短縮: {summary['saved_first_paint']:.2f}秒")
+    for module, seconds in deferred.items():
+        print(f"  遅延読み込み {module}: {seconds:.2f}秒")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"runs": results, "summary": summary}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import math
+import statistics
+import threading
+
+def _TCentralProbability(t, degrees_of_freedom):
+    # 自由度が整数のt分布で、|T| < t となる確率（厳密な有限和の式）
+    n = degrees_of_freedom
+    theta = math.atan(t / math.sqrt(n))
+    cos_squared = math.cos(theta) ** 2
+    if n % 2 == 1:
+        term = math.cos(theta)
+        total = 0.0
+        for k in range(1, (n - 1) // 2 + 1):
+            if k > 1:
+                term *= cos_squared * (2 * k - 2) / (2 * k - 1)
+            total += term
+        return 2 / math.pi * (theta + math.sin(theta) * total) if n > 1 else 2 / math.pi * theta
+    term = 1.0
+    total = 1.0
+    for k in range(1, n // 2):
+        term *= cos_squared * (2 * k - 1) / (2 * k)
+        total += term
+    return math.sin(theta) * total
+
+def _TQuantile(probability, degrees_of_freedom):
+    # t分布の分位点。scipyがあればそれを使う
+    try:
+        from scipy.stats import t
+    except ImportError:
+        pass
+    else:
+        return float(t.ppf(probability, degrees_of_freedom))
+    n = degrees_of_freedom
+    z = statistics.NormalDist().inv_cdf(probability)
+    if n >= 30:
+        # 自由度が大きい場合は正規分布の分位点からのCornish-Fisher展開で十分（誤差0.001未満）
+        return (
+            z
+            + (z ** 3 + z) / (4 * n)
+            + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * n ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * n ** 3)
+        )
+    # 自由度が小さい場合は近似の誤差が大きい（自由度1で12.71に対して9.71）ため、分布関数を二分法で逆に解く
+    if probability == 0.5:
+        return 0.0
+    target = abs(2 * probability - 1)
+    low, high = 0.0, 1.0
+    while _TCentralProbability(high, n) < target:
+        high *= 2
+    for _ in range(100):
+        middle = (low + high) / 2
+        if _TCentralProbability(middle, n) < target:
+            low = middle
+        else:
+            high = middle
+    return math.copysign((low + high) / 2, probability - 0.5)
+
+def MeanConfidenceInterval(values, confidence=0.95):
+    # 平均値の信頼区間（t分布）。2件未満の場合は幅を求められないためNone
+    count = len(values)
+    mean = statistics.mean(values) if values else None
+    if count < 2:
+        return {"count": count, "mean": mean, "half_width": None, "low": None, "high": None, "confidence": confidence}
+    half_width = _TQuantile(0.5 + confidence / 2, count - 1) * statistics.stdev(values) / math.sqrt(count)
+    return {"count": count, "mean": mean, "half_width": half_width, "low": mean - half_width, "high": mean + half_width, "confidence": confidence}
+
+class AdaptiveStopper:
+    # 需要レベルの平均の信頼区間が±target_half_width以内に収まった時点で、新しい人物の投入を止める
+    # 少人数で全員の評価がたまたま揃った場合に打ち切らないよう、min_count人までは判定しない
+    def __init__(self, target_half_width, min_count=5, confidence=0.95):
+        self.target_half_width = target_half_width
+        self.min_count = max(2, min_count)
+        self.confidence = confidence
+        self._lock = threading.Lock()
+        self._values = []
+
+    def add(self, want_level):
+        with self._lock:
+            self._values.append(want_level)
+
+    def interval(self):
+        with self._lock:
+            values = list(self._values)
+        return MeanConfidenceInterval(values, self.confidence)
+
+    def converged(self):
+        interval = self.interval()
+        return interval["count"] >= self.min_count and interval["half_width"] is not None and interval["half_width"] <= self.target_half_width
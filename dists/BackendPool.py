@@ -0,0 +1,242 @@
+import threading
+import time
+
+from langchain_core.runnables import Runnable
+
+from dists.RateLimiter import EstimateTokens
+from dists.RetryPolicy import TRANSIENT, BackendUnavailableError, ClassifyError
+
+ROUTING_MODES = ("least_loaded", "latency")
+
+class PoolMember:
+    # プールの接続先1つ分。モデルは初めて使う時に作成する
+    # overflowの接続先（Geminiなど）は、通常の接続先がすべて停止中か同時実行数の上限に達した時のみ使う
+    def __init__(self, name, factory, model_name, max_in_flight=4, overflow=False, health_check=None):
+        self.name = name
+        self.factory = factory
+        self.model_name = model_name
+        self.max_in_flight = max(1, max_in_flight)
+        self.overflow = overflow
+        self.health_check = health_check
+        self._model = None
+        self._model_lock = threading.Lock()
+
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.failovers = 0
+        self.busy_seconds = 0.0
+        self.completion_tokens = 0
+        self.latency_ewma = None
+        self.first_started = None
+        self.last_finished = None
+        self.down_until = 0.0
+        self.recovering = False
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = self.factory()
+            return self._model
+
+    def stats(self):
+        span = self.last_finished - self.first_started if self.first_started is not None and self.last_finished is not None else 0.0
+        return {
+            "name": self.name,
+            "model": self.model_name,
+            "overflow": self.overflow,
+            "healthy": self.down_until <= time.monotonic(),
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "errors": self.errors,
+            "failovers": self.failovers,
+            "latency_mean": self.busy_seconds / self.calls if self.calls else None,
+            "latency_ewma": self.latency_ewma,
+            "completion_tokens": self.completion_tokens,
+            # 最初の呼び出しの開始から最後の呼び出しの終了までの間の、出力トークン数と平均同時実行数
+            "tokens_per_second": self.completion_tokens / span if span > 0 else None,
+            "mean_concurrency": self.busy_seconds / span if span > 0 else None,
+        }
+
+class BackendPool(Runnable):
+    # 複数の接続先（Ollamaのサーバー・モデル、予備のGemini）を1つのLLMとして扱う
+    # 呼び出しごとに負荷の低い接続先を選び、接続エラーなどの一時的な失敗は別の接続先で実行し直す
+    # 失敗した接続先はcooldown秒間使わず、その後は死活確認に成功してから戻す
+    def __init__(self, members, routing="least_loaded", cooldown=30.0):
+        if routing not in ROUTING_MODES:
+            raise ValueError(f"不明な振り分け方法です: {routing}")
+        if not members:
+            raise ValueError("接続先が指定されていません。")
+        self.members = list(members)
+        self.routing = routing
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        # キャッシュのキーには通常の接続先のモデル名を使う（接続先が1つなら単体のモデルと同じキーになる）
+        return "+".join(sorted({member.model_name for member in self.members if not member.overflow}))
+
+    @property
+    def temperature(self):
+        return getattr(self.members[0].model, "temperature", None)
+
+    def _score(self, member):
+        if self.routing == "latency":
+            return (member.latency_ewma or 0.0) * (member.in_flight + 1)
+        return (member.in_flight / member.max_in_flight, member.latency_ewma or 0.0)
+
+    def _acquire(self, tried):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [member for member in self.members if member not in tried]
+            if not candidates:
+                return None
+            available = [member for member in candidates if member.down_until <= now]
+            chosen = [member for member in available if not member.overflow and member.in_flight < member.max_in_flight]
+            if not chosen:
+                # 通常の接続先が埋まっている場合は予備を使い、予備もなければ通常の接続先で順番を待つ
+                chosen = [member for member in available if member.overflow] or [member for member in available if not member.overflow]
+            if not chosen:
+                # すべて停止中の場合は、最も早く停止が明ける接続先を試す
+                chosen = [min(candidates, key=lambda member: member.down_until)]
+            member = min(chosen, key=self._score)
+            member.in_flight += 1
+            if member.first_started is None:
+                member.first_started = time.perf_counter()
+            return member
+
+    def _release(self, member, start, output=None, error_kind=None):
+        now = time.perf_counter()
+        elapsed = now - start
+        with self._lock:
+            member.in_flight -= 1
+            member.calls += 1
+            member.busy_seconds += elapsed
+            member.last_finished = now
+            if error_kind is None:
+                member.latency_ewma = elapsed if member.latency_ewma is None else 0.8 * member.latency_ewma + 0.2 * elapsed
+                member.completion_tokens += EstimateTokens(output) if output else 0
+                member.down_until = 0.0
+                member.recovering = False
+                return
+            member.errors += 1
+            if error_kind == TRANSIENT:
+                member.down_until = time.monotonic() + self.cooldown
+                member.recovering = True
+
+    def _probe(self, member):
+        # 停止していた接続先は、呼び出す前に死活確認を行う（失敗した場合はその例外を返す）
+        if not member.recovering or member.health_check is None:
+            return None
+        try:
+            member.health_check()
+        except Exception as e:
+            print(f"{member.name}は応答しないため、引き続き使用を停止します。エラー: {e}")
+            with self._lock:
+                member.down_until = time.monotonic() + self.cooldown
+            return e
+        return None
+
+    def _select(self, tried):
+        # 全接続先が死活確認に失敗した場合は、その例外を返して再試行ポリシーに任せる
+        error = None
+        while True:
+            member = self._acquire(tried)
+            if member is None:
+                raise error or BackendUnavailableError("使用できる接続先がありません。")
+            tried.add(member)
+            error = self._probe(member)
+            if error is None:
+                return member
+            with self._lock:
+                member.in_flight -= 1
+
+    def _failover(self, member, error, tried):
+        # 一時的な失敗は別の接続先で実行し直し、それ以外（形式不正・認証エラー・429など）はそのまま返す
+        kind = ClassifyError(error)
+        if kind != TRANSIENT or len(tried) >= len(self.members):
+            return False
+        with self._lock:
+            member.failovers += 1
+        print(f"{member.name}の呼び出しに失敗したため、別の接続先で実行し直します。エラー: {error}")
+        return True
+
+    def route(self, call):
+        # call(モデル)を選んだ接続先で実行する（StructuredLLMなど、接続先ごとに呼び出し方を変える場合に使う）
+        tried = set()
+        while True:
+            member = self._select(tried)
+            start = time.perf_counter()
+            try:
+                output = call(member.model)
+            except Exception as e:
+                self._release(member, start, error_kind=ClassifyError(e))
+                if self._failover(member, e, tried):
+                    continue
+                raise
+            self._release(member, start, output=output if isinstance(output, str) else None)
+            return output
+
+    def route_stream(self, call):
+        # 最初のチャンクを受け取るまでの失敗のみ別の接続先で実行し直す
+        tried = set()
+        while True:
+            member = self._select(tried)
+            start = time.perf_counter()
+            try:
+                chunks = iter(call(member.model))
+                first = next(chunks, None)
+            except Exception as e:
+                self._release(member, start, error_kind=ClassifyError(e))
+                if self._failover(member, e, tried):
+                    continue
+                raise
+            break
+
+        output = []
+        error_kind = None
+        try:
+            if first is not None:
+                output.append(first)
+                yield first
+                for chunk in chunks:
+                    output.append(chunk)
+                    yield chunk
+        except Exception as e:
+            error_kind = ClassifyError(e)
+            raise
+        finally:
+            self._release(member, start, output="".join(output), error_kind=error_kind)
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.route(lambda model: model.invoke(input, config, **kwargs))
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.route_stream(lambda model: model.stream(input, config, **kwargs))
+
+    def check_health(self):
+        # 全接続先の死活確認を行い、{接続先: 応答したか} を返す
+        results = {}
+        for member in self.members:
+            if member.health_check is None:
+                results[member.name] = member.down_until <= time.monotonic()
+                continue
+            try:
+                member.health_check()
+            except Exception:
+                with self._lock:
+                    member.down_until = time.monotonic() + self.cooldown
+                    member.recovering = True
+                results[member.name] = False
+                continue
+            with self._lock:
+                member.down_until = 0.0
+                member.recovering = False
+            results[member.name] = True
+        return results
+
+    def stats(self):
+        with self._lock:
+            return [member.stats() for member in self.members]
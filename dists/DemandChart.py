@@ -0,0 +1,98 @@
+import statistics
+
+def DemandSummary(levels):
+    # levels: {人物の番号: (氏名, 需要レベル)}
+    values = [level for _, level in levels.values()]
+    histogram = [0] * 11
+    for level in values:
+        histogram[min(10, max(0, level))] += 1
+    return {
+        "count": len(values),
+        "mean": statistics.mean(values) if values else None,
+        "median": statistics.median(values) if values else None,
+        "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+        "histogram": histogram,
+    }
+
+def _PersonChartSpec(levels):
+    return {
+        "title": "サービスの需要レベル",
+        "data": {"values": [
+            {"番号": index + 1, "人物名": name, "需要レベル": level}
+            for index, (name, level) in sorted(levels.items())
+        ]},
+        "mark": "bar",
+        "encoding": {
+            "x": {"field": "番号", "type": "ordinal", "title": "人物"},
+            "y": {"field": "需要レベル", "type": "quantitative", "scale": {"domain": [0, 10]}},
+            "tooltip": [{"field": "人物名"}, {"field": "需要レベル"}],
+        },
+    }
+
+def _HistogramSpec(histogram):
+    return {
+        "title": "需要レベルの分布",
+        "data": {"values": [{"需要レベル": level, "人数": count} for level, count in enumerate(histogram)]},
+        "mark": "bar",
+        "encoding": {
+            "x": {"field": "需要レベル", "type": "ordinal"},
+            "y": {"field": "人数", "type": "quantitative"},
+        },
+    }
+
+def RenderDemandChart(placeholder, levels):
+    # matplotlibの図を毎回作る代わりに、ブラウザ側で描画する軽量なグラフ（Vega-Lite）で置き換える
+    # 送るのは数値のみのため、人数が増えても描画の負荷とメモリが図の枚数に比例して増えることはない
+    summary = DemandSummary(levels)
+    container = placeholder.container()
+    container.vega_lite_chart(_PersonChartSpec(levels), use_container_width=True)
+    container.vega_lite_chart(_HistogramSpec(summary["histogram"]), use_container_width=True)
+    if summary["count"]:
+        container.caption(f"{summary['count']}人 / 平均 {summary['mean']:.2f} / 中央値 {summary['median']:.1f} / 標準偏差 {summary['stdev']:.2f}")
+    return summary
+
+def _PairedChartSpec(title, axis, columns):
+    # 同じ人物の需要レベルを列（ラウンドや案）の間で線で結び、列ごとの平均を太線で重ねる
+    # columns: [(列の名前, {人物の番号: (氏名, 需要レベル)})]
+    values = [
+        {axis: column, "人物": f"{index + 1}. {name}", "需要レベル": level}
+        for column, levels in columns
+        for index, (name, level) in sorted(levels.items())
+    ]
+    return {
+        "title": title,
+        "data": {"values": values},
+        "encoding": {
+            "x": {"field": axis, "type": "ordinal", "sort": [column for column, _ in columns]},
+            "y": {"field": "需要レベル", "type": "quantitative", "scale": {"domain": [0, 10]}},
+        },
+        "layer": [
+            {
+                "mark": {"type": "line", "point": True, "opacity": 0.4},
+                "encoding": {"color": {"field": "人物", "type": "nominal", "legend": None}, "tooltip": [{"field": "人物"}, {"field": "需要レベル"}]},
+            },
+            {
+                "mark": {"type": "line", "point": True, "strokeWidth": 4, "color": "#00adb5"},
+                "encoding": {"y": {"aggregate": "mean", "field": "需要レベル", "type": "quantitative", "title": "需要レベル"}},
+            },
+        ],
+    }
+
+def _RoundChartSpec(rounds):
+    return _PairedChartSpec("ラウンドごとの需要レベル", "ラウンド", list(enumerate(rounds)))
+
+def RenderRoundChart(placeholder, rounds):
+    # rounds: ラウンドごとの {人物の番号: (氏名, 需要レベル)} のリスト（0は最初の評価）
+    summaries = [DemandSummary(levels) for levels in rounds]
+    container = placeholder.container()
+    container.vega_lite_chart(_RoundChartSpec(rounds), use_container_width=True)
+    container.caption(" → ".join(f"{round_number}: 平均 {summary['mean']:.2f}" for round_number, summary in enumerate(summaries) if summary["count"]))
+    return summaries
+
+def RenderVariantChart(placeholder, variants):
+    # variants: 案ごとの (案の名前, {人物の番号: (氏名, 需要レベル)}) のリスト（最初の案を基準にする）
+    summaries = [DemandSummary(levels) for _, levels in variants]
+    container = placeholder.container()
+    container.vega_lite_chart(_PairedChartSpec("案ごとの需要レベル", "案", variants), use_container_width=True)
+    container.caption(" / ".join(f"{label}: 平均 {summary['mean']:.2f}" for (label, _), summary in zip(variants, summaries) if summary["count"]))
+    return summaries
@@ -1,26 +1,19 @@
-import os
+import json
 import time
-from dotenv import load_dotenv
+from functools import lru_cache
 
+from langchain_core.exceptions import OutputParserException
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.output_parsers import PydanticOutputParser
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.output_parsers import PydanticOutputParser, StrOutputParser
+from langchain_core.runnables import RunnableLambda, RunnableParallel
 
-import google.generativeai as genai
-from langchain_google_genai import GoogleGenerativeAI
-from langchain_ollama.llms import OllamaLLM
+from pydantic import BaseModel, Field, ValidationError
 
-from pydantic import BaseModel, Field
-
-load_dotenv()
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=GOOGLE_API_KEY)
-
-model_gemini = GoogleGenerativeAI(model="gemini-2.0-flash-exp", temperature=1)
-model_local  = OllamaLLM(
-    model="qwen2-5-72b",
-    temperature=1,
-)
+from dists.ModelCascade import stage_models
+from dists.ModelRegistry import BackendName, GetModel
+from dists.ResponseCache import CachedChain, CacheMissError
+from dists.RetryPolicy import RetryingChain
+from dists.StructuredOutput import JsonArrayItemExtractor, RepairingOutputParser, StructuredLLM
 
 class Character(BaseModel):
     # 基本的な属性情報（デモグラフィック変数）
@@ -58,334 +51,386 @@ class Character(BaseModel):
     relationships: str = Field(description="人間関係")
     recent_events: str = Field(description="最近の出来事やエピソード")
     
+class CharacterList(BaseModel):
+    characters: list[Character] = Field(description="生成した人間モデルのリスト")
+
 class Opinion(BaseModel):
     want_level: int = Field(description="サービスの魅力度レベル。0から10の間の整数値。")
     reason: str = Field(description="理由。100字以内。")
 
-def GenerateHumanModel(gender, age_range_start, age_range_end, use_local):
-    if use_local:
-        model = model_local
-    else:
-        model = model_gemini
+class CommentWithOpinion(BaseModel):
+    comment: str = Field(description="サービスに対する意見。500字程度。")
+    want_level: int = Field(description="サービスの魅力度レベル。0から10の間の整数値。")
+    reason: str = Field(description="理由。100字以内。")
+
+# 再試行しても形式が直らなかった場合の例外（これ以外の失敗は呼び出し側へ伝える）
+PARSE_ERRORS = (OutputParserException, ValidationError, json.JSONDecodeError)
+
+def _AvoidInstruction(avoid):
+    # 生成済みの人物と重複しないよう、氏名と職業を列挙して伝える
+    if not avoid:
+        return ""
+    listed = "\n".join(f"- {character.name}（{character.job}）" for character in avoid)
+    return f"\n\n以下の人物はすでに生成済みです。氏名・職業・家族構成が重複しない、異なる人物を生成してください。\n{listed}"
+
+def GenerateHumanModel(gender, age_range_start, age_range_end, use_local, sample_index=None, avoid=None, cache_mode=None):
+    # cache_modeを渡すと、その実行だけ応答キャッシュのモードを変える（以下の関数も同じ）
+    model = GetModel(use_local)
     
-    output_parser = PydanticOutputParser(pydantic_object=Character)
+    output_parser = RepairingOutputParser(pydantic_object=Character, reask_model=model, cache_mode=cache_mode)
     format_instructions = output_parser.get_format_instructions()
 
     prompt = ChatPromptTemplate.from_template(
         template="""
-            あなたは超次元的存在であり、人間を生み出す事ができる存在です。次の条件を満たした日本人の人間モデルを1人のみ生成してください。条件を守りながら、なるべく多種多様な氏名、職業、家族構成、社会的地位の人間を生み出しなさい。\n\n年齢: {age}代\n性別: {gender}\n\n{format_instructions}
+            あなたは超次元的存在であり、人間を生み出す事ができる存在です。次の条件を満たした日本人の人間モデルを1人のみ生成してください。条件を守りながら、なるべく多種多様な氏名、職業、家族構成、社会的地位の人間を生み出しなさい。\n\n年齢: {age}代\n性別: {gender}{avoid}\n\n{format_instructions}
         """
     )
     
     prompt_with_format_instructions = prompt.partial(format_instructions=format_instructions)
     
-    chain = prompt_with_format_instructions | model | output_parser
-    for _ in range(3):
-        try:
-            human_model = chain.invoke({"age": age_range_start + "〜" + age_range_end + "代", "gender": gender})
-            return human_model
-        except Exception as e:
-            print(f"人間モデルの生成に失敗しました。再試行します。エラー: {e}")
-            time.sleep(5)
-            
-    return None
+    # 同じ条件で複数人を生成するため、何人目かをキャッシュのキーに含める
+    # 実行のたびに新しい人物を生成し、キャッシュの応答はリプレイモードでのみ使う
+    chain = RetryingChain(
+        CachedChain(prompt_with_format_instructions, StructuredLLM(model, output_parser.pydantic_object), output_parser, cache_slot=sample_index, mode=cache_mode, sampling=True),
+        BackendName(use_local), "人間モデルの生成"
+    )
+    try:
+        return chain.invoke({"age": age_range_start + "〜" + age_range_end + "代", "gender": gender, "avoid": _AvoidInstruction(avoid)})
+    except Exception as e:
+        print(f"人間モデルの生成に失敗しました。エラー: {e}")
+        return None
 
-def GenerateComment(service_title, service_data, character_data: Character, use_local):
+def GenerateHumanModels(gender, age_range_start, age_range_end, count, use_local, sample_index=None, avoid=None, cache_mode=None):
+    # 1回の呼び出しでcount人分をリストとして生成し、ストリーミング中に1人分が揃うごとに返す
+    # 形式が崩れた人物や重複した人物、出力が途中で切れて足りない人数分は、1人ずつ個別に生成し直す
+    # 生成に失敗した人物はNoneを返すため、呼び出し側は常にcount個の結果を受け取る
+    model = GetModel(use_local)
     
-    if use_local:
-        model = model_local
-    else:
-        model = model_gemini
+    output_parser = PydanticOutputParser(pydantic_object=CharacterList)
+    format_instructions = output_parser.get_format_instructions()
     
-    positive_prompt = ChatPromptTemplate.from_template(
+    prompt = ChatPromptTemplate.from_template(
         template="""
-            あなたは{name}です。プロフィールは以下の通りです。
-            名前: {name}
-            年齢: {age}歳
-            性別: {sex}
-            居住地: {residence}
-            住居情報: {housing}
-            職業・役職: {job}
-            会社規模: {company_size}
-            年収: {salary}
-            学歴: {educational_background}
-            家族構成: {family_structure}
-            価値観・人生観: {values}
-            ライフスタイル: {lifestyle}
-            趣味・嗜好: {hobbies}
-            目標・理想: {goals}
-            購買行動: {purchasing_behavior}
-            情報収集方法: {information_sources}
-            使用デバイス: {devices}
-            SNS利用状況: {sns_usage}
-            日課・タイムスケジュール: {daily_schedule}
-            悩み: {concerns}
-            解決したいこと: {needs}
-            好きなブランドや商品: {favorite_brands}
-            よく見る映画・動画チャンネル: {favorite_media}
-            人間関係: {relationships}
-            最近の出来事やエピソード: {recent_events}
-            
-            あなたは{service_title}のユーザーです。サービスに関する感想を述べてください。口調なども含めて、自由に書いてください。出来る限り肯定的に書いてください。
-            ただし、要件以外についてのコメントは控えてください。
-            {service_title}の要件: {service_data}
+            あなたは超次元的存在であり、人間を生み出す事ができる存在です。次の条件を満たした日本人の人間モデルを{count}人生成してください。条件を守りながら、なるべく多種多様な氏名、職業、家族構成、社会的地位の人間を生み出しなさい。{count}人の間で氏名・職業・家族構成が重複しないようにしてください。\n\n年齢: {age}代\n性別: {gender}{avoid}\n\n{format_instructions}
         """
     )
     
+    prompt_with_format_instructions = prompt.partial(format_instructions=format_instructions)
+    
+    chain = RetryingChain(
+        CachedChain(prompt_with_format_instructions, StructuredLLM(model, output_parser.pydantic_object), output_parser, cache_slot=sample_index, mode=cache_mode, sampling=True),
+        BackendName(use_local), "人間モデルの一括生成"
+    )
+    item_parser = RepairingOutputParser(pydantic_object=Character, reask_model=model, cache_mode=cache_mode)
+    generated = list(avoid or [])
+    names = {character.name for character in generated}
+    produced = 0
+    
+    def regenerate():
+        retry_index = None if sample_index is None else f"{sample_index}-{produced}"
+        return GenerateHumanModel(gender, age_range_start, age_range_end, use_local, sample_index=retry_index, avoid=generated, cache_mode=cache_mode)
+    
+    def accept(character):
+        # 個別に生成し直した人物も含め、以降の重複の確認と生成の指示に使う
+        nonlocal produced
+        if character is not None:
+            generated.append(character)
+            names.add(character.name)
+        produced += 1
+        return character
+    
+    extractor = JsonArrayItemExtractor("characters")
+    stream = chain.stream_text({
+        "count": count,
+        "age": age_range_start + "〜" + age_range_end + "代",
+        "gender": gender,
+        "avoid": _AvoidInstruction(avoid)
+    })
+    overflow = False
+    last = []
+    try:
+        for chunk in stream:
+            for item in extractor.feed(chunk):
+                if produced >= count:
+                    overflow = True
+                    break
+                try:
+                    character = item_parser.parse(item)
+                except Exception as e:
+                    print(f"人間モデルの形式が不正なため、個別に生成し直します。エラー: {e}")
+                    character = None
+                if character is not None and character.name in names:
+                    print(f"人間モデルの氏名が重複したため、個別に生成し直します: {character.name}")
+                    character = None
+                if character is None:
+                    character = regenerate()
+                character = accept(character)
+                if produced < count:
+                    yield character
+                else:
+                    # 呼び出し側はcount人目を受け取ると読むのをやめるため、応答の最後まで読んでから返す（キャッシュに保存されるように）
+                    last.append(character)
+            if overflow or (produced >= count and extractor.in_item):
+                # 必要な人数がそろった後に余分な人物の出力が始まったら、残りを待たずに生成を打ち切る（打ち切った応答は保存されない）
+                break
+    except CacheMissError as e:
+        print(f"人間モデルの一括生成に失敗しました。エラー: {e}")
+    except Exception as e:
+        print(f"人間モデルの一括生成が途中で失敗しました。残りは個別に生成します。エラー: {e}")
+    finally:
+        stream.close()
+    
+    yield from last
+    while produced < count:
+        yield accept(regenerate())
+
+# 全ステージで共通の人物プロフィール
+# Ollamaはプロンプトの先頭が一致する部分のKVキャッシュを再利用するため、
+# プロフィール（と評価対象のサービス）を必ず先頭に同じ文字列で置き、ステージごとの指示はその後ろに付ける
+PERSONA_PROFILE_TEMPLATE = """あなたは{name}です。プロフィールは以下の通りです。
+名前: {name}
+年齢: {age}歳
+性別: {sex}
+居住地: {residence}
+住居情報: {housing}
+職業・役職: {job}
+会社規模: {company_size}
+年収: {salary}
+学歴: {educational_background}
+家族構成: {family_structure}
+価値観・人生観: {values}
+ライフスタイル: {lifestyle}
+趣味・嗜好: {hobbies}
+目標・理想: {goals}
+購買行動: {purchasing_behavior}
+情報収集方法: {information_sources}
+使用デバイス: {devices}
+SNS利用状況: {sns_usage}
+日課・タイムスケジュール: {daily_schedule}
+悩み: {concerns}
+解決したいこと: {needs}
+好きなブランドや商品: {favorite_brands}
+よく見る映画・動画チャンネル: {favorite_media}
+人間関係: {relationships}
+最近の出来事やエピソード: {recent_events}
+"""
+
+SERVICE_TEMPLATE = """
+あなたは{service_title}のユーザーです。
+{service_title}の要件: {service_data}
+"""
+
+@lru_cache(maxsize=256)
+def _RenderPersonaPrefix(character_json, service_title, service_data):
+    character_data = Character.model_validate_json(character_json)
+    prefix = PERSONA_PROFILE_TEMPLATE.format(**character_data.model_dump())
+    if service_data is not None:
+        prefix += SERVICE_TEMPLATE.format(service_title=service_title, service_data=service_data)
+    return prefix
+
+def RenderPersonaPrefix(character_data: Character, service_title=None, service_data=None):
+    # 同じ人物・サービスに対しては常にバイト単位で同一の文字列を返す
+    return _RenderPersonaPrefix(character_data.model_dump_json(), service_title, service_data)
+
+def _TimedChain(chain, name, timings):
+    # 分岐ごとの開始・終了時刻を記録する
+    def run(inputs):
+        start = time.perf_counter()
+        output = chain.invoke(inputs)
+        timings[name] = (start, time.perf_counter())
+        return output
+    
+    return RunnableLambda(run)
+
+def TimedStream(chunks, name, timings):
+    # ストリーミング出力の最初のチャンクまでの時間（{name}_ttft）と全体の時間（{name}）を記録する
+    start = time.perf_counter()
+    for chunk in chunks:
+        if timings is not None and f"{name}_ttft" not in timings:
+            timings[f"{name}_ttft"] = time.perf_counter() - start
+        yield chunk
+    if timings is not None:
+        timings[name] = time.perf_counter() - start
+
+def _GenerateOpinionBranches(persona_prefix, backend, timings, cache_mode=None, cascade=None):
+    # プロフィールはテンプレートとして展開せず、描画済みの文字列を変数として渡す
+    positive_prompt = ChatPromptTemplate.from_template(
+        template="""{persona_prefix}
+サービスに関する感想を述べてください。口調なども含めて、自由に書いてください。出来る限り肯定的に書いてください。
+ただし、要件以外についてのコメントは控えてください。
+"""
+    )
+    
     negative_prompt = ChatPromptTemplate.from_template(
-        template="""
-            あなたは{name}です。プロフィールは以下の通りです。
-            名前: {name}
-            年齢: {age}歳
-            性別: {sex}
-            居住地: {residence}
-            住居情報: {housing}
-            職業・役職: {job}
-            会社規模: {company_size}
-            年収: {salary}
-            学歴: {educational_background}
-            家族構成: {family_structure}
-            価値観・人生観: {values}
-            ライフスタイル: {lifestyle}
-            趣味・嗜好: {hobbies}
-            目標・理想: {goals}
-            購買行動: {purchasing_behavior}
-            情報収集方法: {information_sources}
-            使用デバイス: {devices}
-            SNS利用状況: {sns_usage}
-            日課・タイムスケジュール: {daily_schedule}
-            悩み: {concerns}
-            解決したいこと: {needs}
-            好きなブランドや商品: {favorite_brands}
-            よく見る映画・動画チャンネル: {favorite_media}
-            人間関係: {relationships}
-            最近の出来事やエピソード: {recent_events}
-            
-            あなたは{service_title}のユーザーです。サービスに関する感想を述べてください。口調なども含めて、自由に書いてください。出来る限り否定的に書いてください。
-            ただし、要件以外についてのコメントは控えてください。
-            {service_title}の要件: {service_data}
-        """
+        template="""{persona_prefix}
+サービスに関する感想を述べてください。口調なども含めて、自由に書いてください。出来る限り否定的に書いてください。
+ただし、要件以外についてのコメントは控えてください。
+"""
     )
     
     output_parser = StrOutputParser()
     
-    positive_chain = positive_prompt | model | output_parser
-    positive_chain_output = positive_chain.invoke({
-        "name": character_data.name,
-        "age": character_data.age,
-        "sex": character_data.sex,
-        "residence": character_data.residence,
-        "housing": character_data.housing,
-        "job": character_data.job,
-        "company_size": character_data.company_size,
-        "salary": character_data.salary,
-        "educational_background": character_data.educational_background,
-        "family_structure": character_data.family_structure,
-        "values": character_data.values,
-        "lifestyle": character_data.lifestyle,
-        "hobbies": character_data.hobbies,
-        "goals": character_data.goals,
-        "purchasing_behavior": character_data.purchasing_behavior,
-        "information_sources": character_data.information_sources,
-        "devices": character_data.devices,
-        "sns_usage": character_data.sns_usage,
-        "daily_schedule": character_data.daily_schedule,
-        "concerns": character_data.concerns,
-        "needs": character_data.needs,
-        "favorite_brands": character_data.favorite_brands,
-        "favorite_media": character_data.favorite_media,
-        "relationships": character_data.relationships,
-        "recent_events": character_data.recent_events,
-        "service_title": service_title,
-        "service_data": service_data
-    })
-       
-    negative_chain = negative_prompt | model | output_parser
-    negative_chain_output = negative_chain.invoke({
-        "name": character_data.name,
-        "age": character_data.age,
-        "sex": character_data.sex,
-        "residence": character_data.residence,
-        "housing": character_data.housing,
-        "job": character_data.job,
-        "company_size": character_data.company_size,
-        "salary": character_data.salary,
-        "educational_background": character_data.educational_background,
-        "family_structure": character_data.family_structure,
-        "values": character_data.values,
-        "lifestyle": character_data.lifestyle,
-        "hobbies": character_data.hobbies,
-        "goals": character_data.goals,
-        "purchasing_behavior": character_data.purchasing_behavior,
-        "information_sources": character_data.information_sources,
-        "devices": character_data.devices,
-        "sns_usage": character_data.sns_usage,
-        "daily_schedule": character_data.daily_schedule,
-        "concerns": character_data.concerns,
-        "needs": character_data.needs,
-        "favorite_brands": character_data.favorite_brands,
-        "favorite_media": character_data.favorite_media,
-        "relationships": character_data.relationships,
-        "recent_events": character_data.recent_events,
-        "service_title": service_title,
-        "service_data": service_data
-    })
+    # 下書きのため、段階的にモデルを使う設定では小さいモデルで生成する（dists.ModelCascade）
+    # cascadeを渡すと、その実行だけ段階的にモデルを使うかを変える（以下の関数も同じ）
+    positive_chain = stage_models.chain("肯定的意見の生成", backend, lambda model, backend, policy: RetryingChain(CachedChain(positive_prompt, model, output_parser, mode=cache_mode), backend, "肯定的意見の生成", policy), cascade)
+    negative_chain = stage_models.chain("否定的意見の生成", backend, lambda model, backend, policy: RetryingChain(CachedChain(negative_prompt, model, output_parser, mode=cache_mode), backend, "否定的意見の生成", policy), cascade)
     
-    synthesize_prompt = ChatPromptTemplate.from_template(
-        template="""
-            あなたは{name}です。プロフィールは以下の通りです。
-            名前: {name}
-            年齢: {age}歳
-            性別: {sex}
-            居住地: {residence}
-            住居情報: {housing}
-            職業・役職: {job}
-            会社規模: {company_size}
-            年収: {salary}
-            学歴: {educational_background}
-            家族構成: {family_structure}
-            価値観・人生観: {values}
-            ライフスタイル: {lifestyle}
-            趣味・嗜好: {hobbies}
-            目標・理想: {goals}
-            購買行動: {purchasing_behavior}
-            情報収集方法: {information_sources}
-            使用デバイス: {devices}
-            SNS利用状況: {sns_usage}
-            日課・タイムスケジュール: {daily_schedule}
-            悩み: {concerns}
-            解決したいこと: {needs}
-            好きなブランドや商品: {favorite_brands}
-            よく見る映画・動画チャンネル: {favorite_media}
-            人間関係: {relationships}
-            最近の出来事やエピソード: {recent_events}
-            
-            あなたは{service_title}に対して、偏った2つの感想を抱きました。この2つの感想を総合して、より説得力のある意見を500字程度で作成してください。
-            プロフィールを元に、主観的な視点を含めてください。また、意見が肯定、否定のどちらかに偏っても構いません。
-            肯定的意見: {positive}
-            否定的意見: {negative}
-        """
+    # 肯定的意見と否定的意見は互いに独立しているため並列に生成する
+    branch_timings = {}
+    branch_chain = RunnableParallel(
+        positive=_TimedChain(positive_chain, "positive", branch_timings),
+        negative=_TimedChain(negative_chain, "negative", branch_timings),
     )
     
-    synthesize_chain = synthesize_prompt | model | output_parser
-    return_data = synthesize_chain.invoke({
-        "name": character_data.name,
-        "age": character_data.age,
-        "sex": character_data.sex,
-        "residence": character_data.residence,
-        "housing": character_data.housing,
-        "job": character_data.job,
-        "company_size": character_data.company_size,
-        "salary": character_data.salary,
-        "educational_background": character_data.educational_background,
-        "family_structure": character_data.family_structure,
-        "values": character_data.values,
-        "lifestyle": character_data.lifestyle,
-        "hobbies": character_data.hobbies,
-        "goals": character_data.goals,
-        "purchasing_behavior": character_data.purchasing_behavior,
-        "information_sources": character_data.information_sources,
-        "devices": character_data.devices,
-        "sns_usage": character_data.sns_usage,
-        "daily_schedule": character_data.daily_schedule,
-        "concerns": character_data.concerns,
-        "needs": character_data.needs,
-        "favorite_brands": character_data.favorite_brands,
-        "favorite_media": character_data.favorite_media,
-        "relationships": character_data.relationships,
-        "recent_events": character_data.recent_events,
-        "service_title": service_title,
-        "positive": positive_chain_output,
-        "negative": negative_chain_output
+    branch_start = time.perf_counter()
+    branch_output = branch_chain.invoke({"persona_prefix": persona_prefix})
+    branch_end = time.perf_counter()
+    
+    if timings is not None:
+        positive_time = branch_timings["positive"][1] - branch_timings["positive"][0]
+        negative_time = branch_timings["negative"][1] - branch_timings["negative"][0]
+        overlap_time = max(0.0, min(branch_timings["positive"][1], branch_timings["negative"][1]) - max(branch_timings["positive"][0], branch_timings["negative"][0]))
+        timings.update({
+            "positive": positive_time,
+            "negative": negative_time,
+            "branches": branch_end - branch_start,
+            "overlap": overlap_time,
         })
     
+    return branch_output
+
+# 最終的な意見を作る指示（comment_mode="debate"は肯定・否定の2案を統合、"single"は1回の呼び出しで直接作成）
+SYNTHESIZE_INSTRUCTION = """あなたは{service_title}に対して、偏った2つの感想を抱きました。この2つの感想を総合して、より説得力のある意見を500字程度で作成してください。
+プロフィールを元に、主観的な視点を含めてください。また、意見が肯定、否定のどちらかに偏っても構いません。
+肯定的意見: {positive}
+否定的意見: {negative}
+"""
+
+SINGLE_SHOT_INSTRUCTION = """{service_title}の良い点と気になる点の両方を検討したうえで、サービスに関する意見を500字程度で作成してください。口調なども含めて、自由に書いてください。
+プロフィールを元に、主観的な視点を含めてください。また、意見が肯定、否定のどちらかに偏っても構いません。
+ただし、要件以外についてのコメントは控えてください。
+"""
+
+COMMENT_MODES = ("debate", "single")
+
+def _CommentInputs(service_title, service_data, character_data, backend, comment_mode, timings, cache_mode=None, cascade=None):
+    if comment_mode not in COMMENT_MODES:
+        raise ValueError(f"不明なコメント生成モードです: {comment_mode}")
+    
+    persona_prefix = RenderPersonaPrefix(character_data, service_title, service_data)
+    inputs = {"persona_prefix": persona_prefix, "service_title": service_title}
+    if comment_mode == "single":
+        return SINGLE_SHOT_INSTRUCTION, inputs
+    
+    branch_output = _GenerateOpinionBranches(persona_prefix, backend, timings, cache_mode, cascade)
+    inputs.update(positive=branch_output["positive"], negative=branch_output["negative"])
+    return SYNTHESIZE_INSTRUCTION, inputs
+
+def _SynthesizeChain(instruction, model, use_local, cache_mode=None):
+    synthesize_prompt = ChatPromptTemplate.from_template(
+        template="{persona_prefix}\n" + instruction
+    )
+    
+    return RetryingChain(CachedChain(synthesize_prompt, model, StrOutputParser(), mode=cache_mode), BackendName(use_local), "意見の統合")
+
+def GenerateComment(service_title, service_data, character_data: Character, use_local, timings=None, comment_mode="debate", cache_mode=None, cascade=None):
+    
+    model = GetModel(use_local)
+    
+    instruction, inputs = _CommentInputs(service_title, service_data, character_data, BackendName(use_local), comment_mode, timings, cache_mode, cascade)
+    
+    synthesize_chain = _SynthesizeChain(instruction, model, use_local, cache_mode)
+    synthesize_start = time.perf_counter()
+    return_data = synthesize_chain.invoke(inputs)
+    synthesize_end = time.perf_counter()
+    
+    if timings is not None:
+        timings["synthesize"] = synthesize_end - synthesize_start
+    
     return return_data
 
-def OpinionSummerizer(service_title, character_data: Character, opinion, use_local):
+def GenerateCommentStream(service_title, service_data, character_data: Character, use_local, timings=None, comment_mode="debate", cache_mode=None, cascade=None):
+    # GenerateCommentと同じ意見を、最後の生成段階の出力から生成されたそばから返す（連結するとGenerateCommentの戻り値と同じ形式になる）
+    # timingsには最初の出力までの時間をsynthesize_ttftとして記録する
     
-    if use_local:
-        model = model_local
-    else:
-        model = model_gemini
+    model = GetModel(use_local)
     
-    output_parser = PydanticOutputParser(pydantic_object=Opinion)
-    format_instructions = output_parser.get_format_instructions()
+    instruction, inputs = _CommentInputs(service_title, service_data, character_data, BackendName(use_local), comment_mode, timings, cache_mode, cascade)
+    
+    synthesize_chain = _SynthesizeChain(instruction, model, use_local, cache_mode)
+    yield from TimedStream(synthesize_chain.stream_text(inputs), "synthesize", timings)
+
+def OpinionSummerizer(service_title, character_data: Character, opinion, use_local, service_data=None, cache_mode=None, cascade=None):
+    
+    format_instructions = PydanticOutputParser(pydantic_object=Opinion).get_format_instructions()
     
     opinion_prompt = ChatPromptTemplate.from_template(
-        template="""
-            あなたは{name}です。プロフィールは以下の通りです。
-            名前: {name}
-            年齢: {age}歳
-            性別: {sex}
-            居住地: {residence}
-            住居情報: {housing}
-            職業・役職: {job}
-            会社規模: {company_size}
-            年収: {salary}
-            学歴: {educational_background}
-            家族構成: {family_structure}
-            価値観・人生観: {values}
-            ライフスタイル: {lifestyle}
-            趣味・嗜好: {hobbies}
-            目標・理想: {goals}
-            購買行動: {purchasing_behavior}
-            情報収集方法: {information_sources}
-            使用デバイス: {devices}
-            SNS利用状況: {sns_usage}
-            日課・タイムスケジュール: {daily_schedule}
-            悩み: {concerns}
-            解決したいこと: {needs}
-            好きなブランドや商品: {favorite_brands}
-            よく見る映画・動画チャンネル: {favorite_media}
-            人間関係: {relationships}
-            最近の出来事やエピソード: {recent_events}
-            
-            あなたは{service_title}というサービスに対して、以下の感想を持っています。
-            この感想を元に、以下の要件を満たすような意見を作成してください。
-            感想: {opinion}
-            
-            {format_instructions}
-        """
+        template="""{persona_prefix}
+あなたは{service_title}というサービスに対して、以下の感想を持っています。
+この感想を元に、以下の要件を満たすような意見を作成してください。
+感想: {opinion}
+
+{format_instructions}
+"""
     )
     
     prompt_with_format_instructions = opinion_prompt.partial(format_instructions=format_instructions)
     
-    chain = prompt_with_format_instructions | model | output_parser
-    for _ in range(3):
-        try:
-            opinion_data = chain.invoke({
-                "name": character_data.name,
-                "age": character_data.age,
-                "sex": character_data.sex,
-                "residence": character_data.residence,
-                "housing": character_data.housing,
-                "job": character_data.job,
-                "company_size": character_data.company_size,
-                "salary": character_data.salary,
-                "educational_background": character_data.educational_background,
-                "family_structure": character_data.family_structure,
-                "values": character_data.values,
-                "lifestyle": character_data.lifestyle,
-                "hobbies": character_data.hobbies,
-                "goals": character_data.goals,
-                "purchasing_behavior": character_data.purchasing_behavior,
-                "information_sources": character_data.information_sources,
-                "devices": character_data.devices,
-                "sns_usage": character_data.sns_usage,
-                "daily_schedule": character_data.daily_schedule,
-                "concerns": character_data.concerns,
-                "needs": character_data.needs,
-                "favorite_brands": character_data.favorite_brands,
-                "favorite_media": character_data.favorite_media,
-                "relationships": character_data.relationships,
-                "recent_events": character_data.recent_events,
-                "service_title": service_title,
-                "opinion": opinion,
-                "format_instructions": format_instructions
-            })
-            return opinion_data
-        except Exception as e:
-            print(f"有効なデータの生成に失敗しました。再試行します。エラー: {e}")
-            time.sleep(5)
-            
-    return None
\ No newline at end of file
+    # service_dataを渡すと、GenerateCommentと同じ接頭辞になりKVキャッシュを再利用できる
+    persona_prefix = RenderPersonaPrefix(character_data, service_title, service_data)
+    
+    def build(model, backend, policy):
+        # 形式不正の修正の問い合わせも、同じモデルに対して行う
+        output_parser = RepairingOutputParser(pydantic_object=Opinion, reask_model=model, cache_mode=cache_mode)
+        return RetryingChain(
+            CachedChain(prompt_with_format_instructions, StructuredLLM(model, output_parser.pydantic_object), output_parser, mode=cache_mode),
+            backend, "魅力度の評価", policy
+        )
+    
+    # 意見からの値の抽出のため、段階的にモデルを使う設定では小さいモデルで行う
+    chain = stage_models.chain("魅力度の評価", BackendName(use_local), build, cascade)
+    try:
+        return chain.invoke({
+            "persona_prefix": persona_prefix,
+            "service_title": service_title,
+            "opinion": opinion
+        })
+    except PARSE_ERRORS as e:
+        # リプレイモードのキャッシュミスや停止中のバックエンドは、呼び出し側でそのまま利用者に伝える
+        print(f"有効なデータの生成に失敗しました。エラー: {e}")
+        return None
+
+def GenerateCommentWithOpinion(service_title, service_data, character_data: Character, use_local, timings=None, comment_mode="debate", cache_mode=None, cascade=None):
+    # 意見の作成と魅力度の評価を1回の呼び出しで行い、OpinionSummerizerの呼び出しを省く
+    
+    model = GetModel(use_local)
+    
+    instruction, inputs = _CommentInputs(service_title, service_data, character_data, BackendName(use_local), comment_mode, timings, cache_mode, cascade)
+    
+    output_parser = RepairingOutputParser(pydantic_object=CommentWithOpinion, reask_model=model, cache_mode=cache_mode)
+    format_instructions = output_parser.get_format_instructions()
+    
+    fused_prompt = ChatPromptTemplate.from_template(
+        template="{persona_prefix}\n" + instruction + """
+作成した意見を元に、サービスの魅力度を0から10の整数で評価し、その理由を100字以内でまとめてください。
+意見はcomment、魅力度はwant_level、理由はreasonとして出力してください。
+
+{format_instructions}
+"""
+    )
+    
+    prompt_with_format_instructions = fused_prompt.partial(format_instructions=format_instructions)
+    
+    chain = RetryingChain(
+        CachedChain(prompt_with_format_instructions, StructuredLLM(model, output_parser.pydantic_object), output_parser, mode=cache_mode),
+        BackendName(use_local), "意見と魅力度の生成"
+    )
+    synthesize_start = time.perf_counter()
+    try:
+        return_data = chain.invoke(inputs)
+    except PARSE_ERRORS as e:
+        print(f"有効なデータの生成に失敗しました。エラー: {e}")
+        return None
+    if timings is not None:
+        timings["synthesize"] = time.perf_counter() - synthesize_start
+    return return_data
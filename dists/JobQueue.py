@@ -0,0 +1,186 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+JOB_STATUSES = ("queued", "running", "done", "failed", "cancelled")
+# 実行中のジョブの生存確認がこの秒数途絶えた場合は、ワーカーが停止したとみなして待ち行列に戻す
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "300"))
+
+def WorkerName():
+    # 同じプロセスで複数のワーカーを動かしても区別できるよう、末尾に乱数を付ける
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class JobQueue:
+    # ジョブとその途中結果をSQLiteに保存し、複数のワーカープロセスと画面で共有する
+    # 結果は1件ずつjob_recordsへ追記するため、画面は前回以降の分（seq）だけを読めばよい
+    # ワーカーが途中で停止したジョブは待ち行列に戻し、記録済みの人物を飛ばして再開する
+    def __init__(self, path, stale_seconds=JOB_STALE_SECONDS):
+        self.path = path
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    heartbeat REAL,
+                    worker TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    error TEXT
+                )
+            """)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS job_records (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    record TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS job_records_job ON job_records (job_id, seq)")
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        keys = ("id", "status", "title", "params", "created_at", "started_at", "finished_at", "heartbeat", "worker", "attempts", "done", "total", "cancel_requested", "error")
+        job = dict(zip(keys, row))
+        job["params"] = json.loads(job["params"])
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def submit(self, title, params, total):
+        # ジョブを待ち行列に追加してIDを返す
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT INTO jobs (id, status, title, params, created_at, total) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, title, json.dumps(params, ensure_ascii=False), time.time(), total),
+            )
+            connection.commit()
+        return job_id
+
+    def claim(self, worker):
+        # 最も古い待機中のジョブを1件取り出して実行中にする（1文で更新するため、複数のワーカーが同じジョブを取ることはない）
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat < ?",
+                (now - self.stale_seconds,),
+            )
+            cursor = connection.execute(
+                """
+                UPDATE jobs SET status = 'running', worker = ?, started_at = COALESCE(started_at, ?), heartbeat = ?, attempts = attempts + 1
+                WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)
+                """,
+                (worker, now, now),
+            )
+            connection.commit()
+            if cursor.rowcount == 0:
+                return None
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE status = 'running' AND worker = ? ORDER BY heartbeat DESC LIMIT 1",
+                (worker,),
+            ).fetchone()
+        return self._job(row)
+
+    def add_record(self, job_id, record, done=None):
+        # 途中結果を追記する。doneを渡すと進捗も更新する
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT INTO job_records (job_id, type, record, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, record["type"], json.dumps(record, ensure_ascii=False), now),
+            )
+            if done is None:
+                connection.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (now, job_id))
+            else:
+                connection.execute("UPDATE jobs SET heartbeat = ?, done = ? WHERE id = ?", (now, done, job_id))
+            connection.commit()
+
+    def heartbeat(self, job_id):
+        # 生存を記録し、中止が要求されているかを返す
+        with self._lock:
+            connection = self._connect()
+            connection.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+            connection.commit()
+            row = connection.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def finish(self, job_id, status="done", error=None):
+        if status not in JOB_STATUSES:
+            raise ValueError(f"不明なジョブの状態です: {status}")
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+            connection.commit()
+
+    def cancel(self, job_id):
+        # 待機中のジョブはそのまま中止し、実行中のジョブは実行中の人物の処理が終わった時点で止める
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+            connection.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+            connection.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._job(self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def records(self, job_id, after=0):
+        # seqがafterより後の途中結果を(seq, 記録)のリストで返す
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT seq, record FROM job_records WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after),
+            ).fetchall()
+        return [(seq, json.loads(record)) for seq, record in rows]
+
+    def list(self, limit=50):
+        with self._lock:
+            rows = self._connect().execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def position(self, job_id):
+        # 待機中のジョブの前に並んでいるジョブの数（実行中のものを含む）
+        with self._lock:
+            return self._connect().execute(
+                """
+                SELECT COUNT(*) FROM jobs
+                WHERE status = 'running' OR (status = 'queued' AND created_at < (SELECT created_at FROM jobs WHERE id = ?))
+                """,
+                (job_id,),
+            ).fetchone()[0]
+
+job_queue = JobQueue(os.getenv("JOB_QUEUE_PATH", os.path.join(os.getenv("LLM_CACHE_DIR", ".cache"), "jobs.sqlite3")))
@@ -0,0 +1,242 @@
+import multiprocessing
+import os
+import threading
+import time
+
+from dists.AdaptiveSampling import AdaptiveStopper, MeanConfidenceInterval
+from dists.GeneratePersona import Character
+from dists.JobQueue import WorkerName, job_queue
+from dists.PanelRefinement import EvaluatePanel, RevisePlan, StageMemo
+from dists.PersonaDiversity import DUPLICATE_THRESHOLD, PersonaIndex
+from dists.PersonaLibrary import persona_library
+from dists.PersonaPipeline import RunPersonaPipelines
+from dists.PlanRevisons import SuggestBusinessPlan
+from dists.ResponseCache import CacheMissError
+from dists.ResultExport import EXPORT_DIR, StreamingExporter
+from dists.RetryPolicy import BackendUnavailableError
+from dists.VariantComparison import CompareVariants, PairedComparison, RememberVariantRecords, VariantLabel
+
+# 画面のサーバーと同じプロセスで起動するワーカーの数（0の場合はworker.pyで別に起動する）
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+# 実行中のジョブの生存を記録する間隔（秒）。JOB_STALE_SECONDSより十分短くする
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "10"))
+
+def JobExportDirectory(job_id):
+    return os.path.join(EXPORT_DIR, "jobs", job_id)
+
+class _Heartbeat:
+    # 1人分の処理が長くかかっても待ち行列に戻されないよう、別スレッドで生存を記録し続ける
+    # 中止の要求もここで受け取る
+    def __init__(self, queue, job_id, interval=JOB_HEARTBEAT_INTERVAL):
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self.cancelled = False
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.cancelled = self.queue.heartbeat(self.job_id) or self.cancelled
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop_event.set()
+        self._thread.join()
+
+def RunJob(queue, job, memo=None):
+    # 画面から投入された1件のジョブを実行し、途中結果を1件ずつ記録する
+    # 再開時（ワーカーが停止して待ち行列に戻された場合）は、記録済みの人物・改良案・ラウンドを飛ばす
+    job_id = job["id"]
+    params = job["params"]
+    use_local = params["use_local"]
+    # 同じプロセスで他のジョブも並行して実行するため、全体の設定は変えずにこのジョブの呼び出しにだけ渡す
+    cache_mode = params.get("cache_mode")
+    cascade = params.get("cascade")
+
+    completed = {}
+    plan = None
+    rounds_done = {}
+    variants_done = {}
+    comparison = None
+    for _, record in queue.records(job_id):
+        if record["type"] in ("persona", "duplicate"):
+            completed[record["index"]] = record
+        elif record["type"] == "plan":
+            plan = record
+        elif record["type"] == "round":
+            rounds_done[record["round"]] = record
+        elif record["type"] == "variant":
+            variants_done[(record["variant"], record["index"])] = record
+        elif record["type"] == "comparison":
+            comparison = record
+
+    persona_index = PersonaIndex(params.get("duplicate_threshold", DUPLICATE_THRESHOLD))
+    stopper = AdaptiveStopper(params["target_half_width"]) if params.get("target_half_width") else None
+    for index, record in sorted(completed.items()):
+        if record["type"] == "persona":
+            persona_index.add(index, Character.model_validate(record["character"]))
+            if stopper is not None:
+                stopper.add(record["opinion"]["want_level"])
+    remaining = [] if plan is not None or (stopper is not None and stopper.converged()) else [index for index in range(job["total"]) if index not in completed]
+    characters = {}
+    if remaining and params.get("use_library"):
+        drawn = persona_library.sample(params["gender"], params["age_range_start"], params["age_range_end"], len(remaining))
+        characters = {index: character for index, (_, character) in zip(remaining, drawn)}
+
+    with _Heartbeat(queue, job_id) as heartbeat, StreamingExporter(JobExportDirectory(job_id), append=True, order=remaining) as exporter:
+        def stop_when():
+            return heartbeat.cancelled or (stopper is not None and stopper.converged())
+
+        for result in RunPersonaPipelines(
+            job["total"], params["service_title"], params["service_req"], params["gender"], params["age_range_start"], params["age_range_end"], use_local,
+            max_workers=params.get("concurrency", 1), indices=remaining, stop_on_error=False,
+            comment_mode=params.get("comment_mode", "debate"), fused=params.get("fused", False), persona_batch_size=params.get("persona_batch_size", 1),
+            characters=characters, persona_index=persona_index, stop_when=stop_when, cache_mode=cache_mode, cascade=cascade
+        ):
+            if result.duplicate_of is not None:
+                completed[result.index] = {"type": "duplicate", "index": result.index, "duplicate_of": result.duplicate_of, "error": result.error}
+                queue.add_record(job_id, completed[result.index], done=len(completed))
+                exporter.skip(result.index)
+                continue
+            if result.error is None and result.opinion is None:
+                result = result.model_copy(update={"error": "有効なデータの生成に失敗しました。"})
+            if result.error is not None:
+                # 失敗した人物は完了として扱わず、再開時にやり直す
+                queue.add_record(job_id, {"type": "error", "index": result.index, "error": result.error})
+                exporter.skip(result.index)
+                continue
+            completed[result.index] = {
+                "type": "persona",
+                "index": result.index,
+                "character": result.character.model_dump(),
+                "comment": result.comment,
+                "comment_timings": result.comment_timings,
+                "opinion": result.opinion.model_dump(),
+            }
+            queue.add_record(job_id, completed[result.index], done=len(completed))
+            exporter.add(result.index, result.character, result.comment, result.opinion)
+            if stopper is not None:
+                stopper.add(result.opinion.want_level)
+
+        personas = {index: record for index, record in sorted(completed.items()) if record["type"] == "persona"}
+        interval = MeanConfidenceInterval([record["opinion"]["want_level"] for record in personas.values()])
+        diversity = persona_index.diversity()
+        exporter.write_summary({
+            "job_id": job_id,
+            "want_level": interval,
+            "target_half_width": params.get("target_half_width"),
+            "max_people": job["total"],
+            "stopped_early": stopper is not None and stopper.converged(),
+            "diversity": diversity["diversity"],
+        })
+        if heartbeat.cancelled:
+            queue.finish(job_id, "cancelled")
+            return
+        if not personas:
+            queue.finish(job_id, "failed", "有効な人物が1人も生成できませんでした。")
+            return
+
+        # 他のサービス要件を同じ人物のパネルで評価して比べる（記録済みの組は評価し直さない）
+        variants = [params["service_req"], *params.get("variants", [])]
+        if len(variants) > 1 and comparison is None:
+            panel = {index: Character.model_validate(record["character"]) for index, record in personas.items()}
+            comparison_memo = memo if memo is not None else StageMemo()
+            RememberVariantRecords(
+                comparison_memo, panel, params["service_title"], variants,
+                [{"variant": 0, **record} for record in personas.values()] + list(variants_done.values()),
+                use_local, params.get("comment_mode", "debate"), params.get("fused", False), cascade
+            )
+            levels = {variant: {} for variant in range(len(variants))}
+            for variant, result in CompareVariants(
+                panel, params["service_title"], variants, use_local, memo=comparison_memo, max_workers=params.get("concurrency", 1),
+                comment_mode=params.get("comment_mode", "debate"), fused=params.get("fused", False), cache_mode=cache_mode, cascade=cascade
+            ):
+                if heartbeat.cancelled:
+                    break
+                if result.error is not None:
+                    queue.add_record(job_id, {"type": "error", "index": result.index, "error": f"案{VariantLabel(variant)}: {result.error}"})
+                    continue
+                levels[variant][result.index] = result.opinion.want_level
+                if variant > 0 and (variant, result.index) not in variants_done:
+                    variants_done[(variant, result.index)] = {"type": "variant", "variant": variant, "index": result.index, "comment": result.comment, "opinion": result.opinion.model_dump()}
+                    queue.add_record(job_id, variants_done[(variant, result.index)])
+            if not heartbeat.cancelled:
+                comparison = {"type": "comparison", "variants": PairedComparison(levels)}
+                queue.add_record(job_id, comparison)
+        if heartbeat.cancelled:
+            queue.finish(job_id, "cancelled")
+            return
+
+        if plan is None:
+            revised = SuggestBusinessPlan(params["service_req"], [record["comment"] for record in personas.values()], use_local, cache_mode, cascade)
+            plan = {"type": "plan", "revised_service_req": revised, "want_level": interval, "diversity": diversity["diversity"]}
+            queue.add_record(job_id, plan)
+
+        # 改良後のサービス要件を、同じ人物で再評価する（人物は生成しない）
+        panel = {index: Character.model_validate(record["character"]) for index, record in personas.items()}
+        service_req = plan["revised_service_req"]
+        rounds = params.get("rounds", 0)
+        for round_number in range(1, rounds + 1):
+            if round_number in rounds_done:
+                service_req = rounds_done[round_number]["revised_service_req"]
+                continue
+            if heartbeat.cancelled or not service_req:
+                break
+            results = {}
+            for result in EvaluatePanel(
+                panel, params["service_title"], service_req, use_local, memo=memo, max_workers=params.get("concurrency", 1),
+                comment_mode=params.get("comment_mode", "debate"), fused=params.get("fused", False), cache_mode=cache_mode, cascade=cascade
+            ):
+                if result.error is None:
+                    results[result.index] = result
+            if not results:
+                queue.finish(job_id, "failed", f"ラウンド{round_number}の評価に失敗しました。")
+                return
+            revised = None
+            if round_number < rounds:
+                revised = RevisePlan(service_req, [results[index].comment for index in sorted(results)], use_local, memo=memo, cache_mode=cache_mode, cascade=cascade)
+            queue.add_record(job_id, {
+                "type": "round",
+                "round": round_number,
+                "service_req": service_req,
+                "personas": [{"index": index, "name": results[index].character.name, "comment": results[index].comment, "opinion": results[index].opinion.model_dump()} for index in sorted(results)],
+                "want_level": MeanConfidenceInterval([result.opinion.want_level for result in results.values()]),
+                "revised_service_req": revised,
+            })
+            service_req = revised
+
+    queue.finish(job_id, "cancelled" if heartbeat.cancelled else "done")
+
+def WorkerLoop(poll_interval=JOB_POLL_INTERVAL, stop_event=None):
+    # 待機中のジョブを1件ずつ取り出して実行する。ジョブがなければpoll_interval秒待つ
+    queue = job_queue
+    worker = WorkerName()
+    memo = StageMemo()
+    while stop_event is None or not stop_event.is_set():
+        job = queue.claim(worker)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        print(f"[{worker}] ジョブ {job['id']}（{job['title']}）を開始します（{job['attempts']}回目）")
+        try:
+            RunJob(queue, job, memo)
+        except (CacheMissError, BackendUnavailableError) as e:
+            queue.finish(job["id"], "failed", str(e))
+        except Exception as e:
+            # 1件のジョブの失敗でワーカーを止めない
+            print(f"[{worker}] ジョブ {job['id']} が失敗しました: {e!r}")
+            queue.finish(job["id"], "failed", repr(e))
+        print(f"[{worker}] ジョブ {job['id']} を終了しました")
+
+def StartWorkers(count, poll_interval=JOB_POLL_INTERVAL):
+    # ワーカープロセスをcount個起動する（スレッドを持つ親プロセスから安全に起動できるよう、spawnで起動する）
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=WorkerLoop, args=(poll_interval,), daemon=True, name=f"persona-worker-{number}") for number in range(count)]
+    for process in processes:
+        process.start()
+    return processes
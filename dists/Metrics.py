@@ -0,0 +1,225 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from dists.RateLimiter import EstimateTokens
+
+# 呼び出しごとの記録を、ステージ（RetryingChainのstage）とバックエンドの組で集計する
+# ワーカースレッドごとに実行中の記録を持ち、CachedChainやRepairingOutputParserはそこへトークン数やキャッシュヒットを書き込む
+_current = threading.local()
+
+class CallRecord:
+    def __init__(self, stage, backend):
+        self.stage = stage
+        self.backend = backend
+        self.started_at = time.time()
+        self.latency = None
+        self.ttft = None
+        self.attempts = 0
+        self.llm_calls = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.estimated_tokens = False
+        self.parse_failures = 0
+        self.error = None
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "backend": self.backend,
+            "started_at": self.started_at,
+            "latency": self.latency,
+            "ttft": self.ttft,
+            "retries": max(0, self.attempts - 1),
+            "llm_calls": self.llm_calls,
+            "cache_hits": self.cache_hits,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "estimated_tokens": self.estimated_tokens,
+            "parse_failures": self.parse_failures,
+            "error": self.error,
+        }
+
+def CurrentCall():
+    return getattr(_current, "record", None)
+
+@contextmanager
+def ActiveCall(record):
+    previous = CurrentCall()
+    _current.record = record
+    try:
+        yield record
+    finally:
+        _current.record = previous
+
+class TokenUsageHandler(BaseCallbackHandler):
+    # LLMの応答に含まれる実際のトークン数を取り出す
+    # Ollama: prompt_eval_count / eval_count、Gemini: usage_metadata
+    def __init__(self):
+        self.prompt_tokens = None
+        self.completion_tokens = None
+
+    def on_llm_end(self, response, **kwargs):
+        if not response.generations or not response.generations[0]:
+            return
+        info = response.generations[0][0].generation_info or {}
+        usage = info.get("usage_metadata") or {}
+        self.prompt_tokens = info.get("prompt_eval_count", usage.get("prompt_token_count"))
+        self.completion_tokens = info.get("eval_count", usage.get("candidates_token_count"))
+
+    def attach(self, config):
+        config = dict(config or {})
+        callbacks = config.get("callbacks")
+        if callbacks is None:
+            config["callbacks"] = [self]
+        elif isinstance(callbacks, list):
+            config["callbacks"] = [*callbacks, self]
+        else:
+            callbacks = callbacks.copy()
+            callbacks.add_handler(self, inherit=True)
+            config["callbacks"] = callbacks
+        return config
+
+    def record(self, record, prompt_text, response):
+        # 実際の値が得られなかった場合（Geminiのストリーミングなど）は文字数で見積もる
+        if record is None:
+            return
+        record.llm_calls += 1
+        if self.prompt_tokens is None or self.completion_tokens is None:
+            record.estimated_tokens = True
+        record.prompt_tokens += self.prompt_tokens if self.prompt_tokens is not None else EstimateTokens(prompt_text)
+        record.completion_tokens += self.completion_tokens if self.completion_tokens is not None else EstimateTokens(response)
+
+def _Percentile(values, ratio):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+# Prometheusのカウンタとして書き出す累計（記録を捨てても減らないよう、記録とは別に数える）
+COUNTER_KEYS = ("calls", "errors", "latency_total", "retries", "llm_calls", "cache_hits", "prompt_tokens", "completion_tokens", "parse_failures")
+
+class RunMetrics:
+    # 呼び出しごとの記録は直近max_records件のみ保持する（集計・レポート用）
+    def __init__(self, max_records=100000):
+        self.max_records = max_records
+        self._lock = threading.Lock()
+        self._records = []
+        self._totals = {}
+
+    def add(self, record):
+        with self._lock:
+            self._records.append(record)
+            if len(self._records) > self.max_records:
+                del self._records[:len(self._records) - self.max_records]
+            totals = self._totals.setdefault((record.stage, record.backend), dict.fromkeys(COUNTER_KEYS, 0))
+            totals["calls"] += 1
+            totals["errors"] += record.error is not None
+            totals["latency_total"] += record.latency or 0.0
+            totals["retries"] += max(0, record.attempts - 1)
+            for key in ("llm_calls", "cache_hits", "prompt_tokens", "completion_tokens", "parse_failures"):
+                totals[key] += getattr(record, key)
+
+    def reset(self):
+        with self._lock:
+            self._records.clear()
+            self._totals.clear()
+
+    def totals(self):
+        # プロセス開始（またはreset）からの累計。保持する記録の件数に関わらず減らない
+        with self._lock:
+            return [{"stage": stage, "backend": backend, **totals} for (stage, backend), totals in self._totals.items()]
+
+    def records(self, since=None):
+        with self._lock:
+            records = list(self._records)
+        return [record for record in records if since is None or record.started_at >= since]
+
+    def summary(self, since=None):
+        stages = {}
+        for record in self.records(since):
+            row = stages.setdefault((record.stage, record.backend), {
+                "stage": record.stage, "backend": record.backend, "calls": 0, "errors": 0,
+                "latency_total": 0.0, "latencies": [], "ttfts": [], "retries": 0, "llm_calls": 0, "cache_hits": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "parse_failures": 0,
+            })
+            row["calls"] += 1
+            row["errors"] += record.error is not None
+            row["latency_total"] += record.latency or 0.0
+            row["latencies"].append(record.latency or 0.0)
+            if record.ttft is not None:
+                row["ttfts"].append(record.ttft)
+            row["retries"] += max(0, record.attempts - 1)
+            for key in ("llm_calls", "cache_hits", "prompt_tokens", "completion_tokens", "parse_failures"):
+                row[key] += getattr(record, key)
+
+        rows = []
+        for row in stages.values():
+            latencies = row.pop("latencies")
+            ttfts = row.pop("ttfts")
+            row["latency_mean"] = row["latency_total"] / row["calls"]
+            row["latency_p50"] = _Percentile(latencies, 0.5)
+            row["latency_p95"] = _Percentile(latencies, 0.95)
+            row["latency_max"] = max(latencies)
+            row["ttft_mean"] = sum(ttfts) / len(ttfts) if ttfts else None
+            rows.append(row)
+        return sorted(rows, key=lambda row: -row["latency_total"])
+
+    def report(self, since=None):
+        records = self.records(since)
+        return {
+            "generated_at": time.time(),
+            "since": since,
+            "stages": self.summary(since),
+            "calls": [record.to_dict() for record in records],
+        }
+
+    def write_json(self, path, since=None):
+        _WriteAtomically(path, json.dumps(self.report(since), ensure_ascii=False, indent=2))
+
+    def write_prometheus(self, path, since=None):
+        # node_exporterのtextfileコレクタで読み込める形式で書き出す
+        # カウンタはプロセス全体の累計から、p95は保持している記録（sinceを渡すとそれ以降）から求める
+        metrics = (
+            ("persona_llm_stage_calls_total", "counter", "ステージの呼び出し回数", "calls"),
+            ("persona_llm_stage_errors_total", "counter", "再試行後も失敗した呼び出しの回数", "errors"),
+            ("persona_llm_stage_latency_seconds_total", "counter", "ステージの所要時間の合計（秒）", "latency_total"),
+            ("persona_llm_stage_retries_total", "counter", "再試行の回数", "retries"),
+            ("persona_llm_stage_llm_calls_total", "counter", "モデルを実際に呼び出した回数", "llm_calls"),
+            ("persona_llm_stage_cache_hits_total", "counter", "応答キャッシュのヒット数", "cache_hits"),
+            ("persona_llm_stage_prompt_tokens_total", "counter", "入力トークン数", "prompt_tokens"),
+            ("persona_llm_stage_completion_tokens_total", "counter", "出力トークン数", "completion_tokens"),
+            ("persona_llm_stage_parse_failures_total", "counter", "出力のパースに失敗した回数", "parse_failures"),
+            ("persona_llm_stage_latency_p95_seconds", "gauge", "ステージの所要時間の95パーセンタイル（秒）", "latency_p95"),
+        )
+        totals = self.totals()
+        gauges = self.summary(since)
+        lines = []
+        for name, metric_type, description, key in metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for row in totals if metric_type == "counter" else gauges:
+                labels = f'stage="{_EscapeLabel(row["stage"])}",backend="{_EscapeLabel(row["backend"])}"'
+                lines.append(f"{name}{{{labels}}} {row[key]}")
+        _WriteAtomically(path, "\n".join(lines) + "\n")
+
+def _EscapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _WriteAtomically(path, text):
+    # 読み込み途中のファイルを見せないよう、一時ファイルに書いてから置き換える
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temporary_path, path)
+
+run_metrics = RunMetrics()
+
+# 設定されている場合、実行の終わりにPrometheusのtextfile形式で書き出す
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE")
@@ -0,0 +1,152 @@
+import os
+import threading
+
+from langchain_core.runnables import Runnable
+
+from dists.ModelRegistry import model_registry
+from dists.RetryPolicy import FATAL, PARSE, RATE_LIMIT, TRANSIENT, RetryPolicy, default_retry_policy
+
+# large: 大きいモデルのみ / small: 小さいモデルのみ / cascade: 小さいモデルで生成し、検証に失敗した場合のみ大きいモデルでやり直す
+MODEL_TIERS = ("large", "small", "cascade")
+
+# 段階的に使う場合の既定の割り当て。抽出・要約・下書きは小さいモデルに任せ、
+# 人物の生成・意見の統合・サービスの改良など、出力の質が結果を左右するステージは大きいモデルのみで行う
+CASCADE_STAGES = {
+    "肯定的意見の生成": "cascade",
+    "否定的意見の生成": "cascade",
+    "意見の要約": "cascade",
+    "要約の統合": "cascade",
+    "魅力度の評価": "cascade",
+}
+
+# 小さいモデルの出力を採用する最低文字数（空白を除く）。これより短い場合は自信がないとみなす
+CASCADE_MIN_CHARS = {
+    "肯定的意見の生成": int(os.getenv("CASCADE_MIN_DRAFT_CHARS", "80")),
+    "否定的意見の生成": int(os.getenv("CASCADE_MIN_DRAFT_CHARS", "80")),
+    "意見の要約": int(os.getenv("CASCADE_MIN_SUMMARY_CHARS", "150")),
+    "要約の統合": int(os.getenv("CASCADE_MIN_SUMMARY_CHARS", "150")),
+}
+
+# 小さいモデルでは形式不正を繰り返し直さず、すぐに大きいモデルへ切り替える
+cascade_retry_policy = RetryPolicy(
+    max_attempts={TRANSIENT: 2, RATE_LIMIT: 1, PARSE: 1, FATAL: 1},
+    base_delay=default_retry_policy.base_delay,
+    max_delay=default_retry_policy.max_delay,
+    retry_budget=default_retry_policy.retry_budget,
+)
+
+def _Rejection(stage, output):
+    # 小さいモデルの出力を採用しない理由（採用する場合はNone）
+    if isinstance(output, str):
+        minimum = CASCADE_MIN_CHARS.get(stage, 0)
+        if len("".join(output.split())) < minimum:
+            return "short"
+        return None
+    want_level = getattr(output, "want_level", None)
+    if want_level is not None and not 0 <= want_level <= 10:
+        return "out_of_range"
+    reason = getattr(output, "reason", None)
+    if reason is not None and len(reason.strip()) < 10:
+        return "short"
+    return None
+
+class CascadeStats:
+    # ステージごとの、小さいモデルの出力を採用した件数と、大きいモデルでやり直した件数（理由別）
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stage, outcome):
+        with self._lock:
+            counts = self._stages.setdefault(stage, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            stages = {stage: dict(counts) for stage, counts in self._stages.items()}
+        rows = []
+        for stage, counts in stages.items():
+            accepted = counts.pop("accepted", 0)
+            escalated = sum(counts.values())
+            rows.append({
+                "stage": stage,
+                "accepted": accepted,
+                "escalated": escalated,
+                "escalation_rate": escalated / (accepted + escalated) if accepted + escalated else 0.0,
+                "reasons": counts,
+            })
+        return rows
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+cascade_stats = CascadeStats()
+
+class CascadeChain(Runnable):
+    # 小さいモデルのチェーンを先に実行し、失敗（形式不正・接続失敗など）か出力を採用できない場合のみ大きいモデルで実行し直す
+    def __init__(self, small_chain, large_chain, stage, stats=None):
+        self.small_chain = small_chain
+        self.large_chain = large_chain
+        self.stage = stage
+        self.stats = stats if stats is not None else cascade_stats
+
+    def _try_small(self, call):
+        try:
+            output = call()
+        except Exception as e:
+            print(f"{self.stage}を小さいモデルで実行できなかったため、大きいモデルで実行し直します。エラー: {e}")
+            self.stats.add(self.stage, "error")
+            return None
+        rejection = _Rejection(self.stage, output)
+        if rejection is not None:
+            self.stats.add(self.stage, rejection)
+            return None
+        self.stats.add(self.stage, "accepted")
+        return output
+
+    def invoke(self, input, config=None, **kwargs):
+        output = self._try_small(lambda: self.small_chain.invoke(input, config, **kwargs))
+        if output is None:
+            return self.large_chain.invoke(input, config, **kwargs)
+        return output
+
+    def stream_text(self, input, config=None):
+        # 小さいモデルの出力は確認してから返すため、まとめて受け取ってから返す
+        output = self._try_small(lambda: "".join(self.small_chain.stream_text(input, config)))
+        if output is None:
+            yield from self.large_chain.stream_text(input, config)
+            return
+        yield output
+
+class StageModels:
+    # ステージごとに使うモデルを決める（ローカルモデルを使う場合のみ。Geminiは常に同じモデルを使う）
+    # STAGE_MODELS="魅力度の評価=small,意見の統合=cascade" のように、ステージごとに上書きできる
+    def __init__(self, enabled=False, tiers=None):
+        self.enabled = enabled
+        self.tiers = dict(CASCADE_STAGES if tiers is None else tiers)
+        for entry in os.getenv("STAGE_MODELS", "").split(","):
+            stage, _, tier = entry.strip().partition("=")
+            if not stage:
+                continue
+            if tier not in MODEL_TIERS:
+                raise ValueError(f"不明なモデルの割り当てです: {entry}")
+            self.tiers[stage] = tier
+
+    def tier(self, stage, backend, enabled=None):
+        # enabledを渡すと、全体の設定（self.enabled）の代わりにその実行の設定を使う
+        if not (self.enabled if enabled is None else enabled) or backend != "local":
+            return "large"
+        return self.tiers.get(stage, "large")
+
+    def chain(self, stage, backend, build, enabled=None):
+        # build(model, backend, policy)で、指定したモデルを使うRetryingChainを作る
+        tier = self.tier(stage, backend, enabled)
+        if tier == "large":
+            return build(model_registry.get(backend), backend, None)
+        small_chain = build(model_registry.get("local_small"), "local_small", cascade_retry_policy if tier == "cascade" else None)
+        if tier == "small":
+            return small_chain
+        return CascadeChain(small_chain, build(model_registry.get(backend), backend, None), stage)
+
+stage_models = StageModels(enabled=os.getenv("MODEL_CASCADE") == "1")
@@ -0,0 +1,18 @@
+import os
+
+def OllamaOptions():
+    # ステージ間でモデルをメモリに常駐させ、プロンプトが切り詰められないよう十分なコンテキスト長を確保する
+    # Ollamaの既定のnum_ctx(2048)ではプロフィールと2つの感想を含むプロンプトの先頭が切り捨てられ、KVキャッシュも再利用されない
+    keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+    options = {
+        "keep_alive": int(keep_alive) if keep_alive.lstrip("-").isdigit() else keep_alive,
+        "num_ctx": int(os.getenv("OLLAMA_NUM_CTX", "8192")),
+        # 1回の呼び出しの上限時間（応答しないOllamaを待ち続けないようにする）
+        "client_kwargs": {"timeout": float(os.getenv("OLLAMA_TIMEOUT", "300"))},
+    }
+    if os.getenv("OLLAMA_NUM_PREDICT"):
+        options["num_predict"] = int(os.getenv("OLLAMA_NUM_PREDICT"))
+    return options
+
+def GeminiTimeout():
+    return float(os.getenv("GEMINI_TIMEOUT", "120"))
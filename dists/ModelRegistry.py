@@ -0,0 +1,120 @@
+import os
+import threading
+from functools import partial
+
+from dists.BackendPool import BackendPool, PoolMember
+from dists.ModelConfig import GeminiTimeout, OllamaOptions
+from dists.RateLimiter import RateLimitedLLM, gemini_rate_limiter
+
+LOCAL_MODEL = "qwen2-5-72b"
+# 抽出・要約・下書きなど、軽いステージに使う小さいモデル（modelfiles/Modelfile_qwen2-5-7b）
+SMALL_LOCAL_MODEL = os.getenv("LOCAL_SMALL_MODEL", "qwen2-5-7b")
+GEMINI_MODEL = "gemini-2.0-flash-exp"
+
+def _CreateGeminiModel():
+    # google.generativeai / langchain_google_genaiは読み込みに時間がかかるため、Geminiを初めて使う時に読み込む
+    import google.generativeai as genai
+    from langchain_google_genai import GoogleGenerativeAI
+
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    # 再試行はRetryPolicyで行うため、クライアント内部の再試行は無効にする
+    return RateLimitedLLM(
+        GoogleGenerativeAI(model=GEMINI_MODEL, temperature=1, max_retries=1, timeout=GeminiTimeout()),
+        gemini_rate_limiter,
+    )
+
+def _OllamaEndpoints(variable="OLLAMA_ENDPOINTS", default_model=LOCAL_MODEL):
+    # OLLAMA_ENDPOINTS="http://gpu1:11434,http://gpu2:11434=qwen2-5-32b" のように、接続先（=モデル名）をカンマ区切りで指定する
+    # 未指定の場合はOLLAMA_HOST（なければOllamaの既定の接続先）のみを使う
+    endpoints = []
+    for entry in os.getenv(variable, "").split(","):
+        base_url, _, model = entry.strip().partition("=")
+        if base_url:
+            endpoints.append((base_url.strip(), model.strip() or default_model))
+    return endpoints or [(None, default_model)]
+
+def _SmallOllamaEndpoints():
+    # OLLAMA_SMALL_ENDPOINTSが未指定の場合は、大きいモデルと同じ接続先で小さいモデルを動かす
+    if os.getenv("OLLAMA_SMALL_ENDPOINTS"):
+        return _OllamaEndpoints("OLLAMA_SMALL_ENDPOINTS", SMALL_LOCAL_MODEL)
+    return [(base_url, SMALL_LOCAL_MODEL) for base_url, _ in _OllamaEndpoints()]
+
+def _CreateOllamaModel(base_url, model):
+    from langchain_ollama.llms import OllamaLLM
+
+    return OllamaLLM(
+        model=model,
+        base_url=base_url,
+        temperature=1,
+        **OllamaOptions(),
+    )
+
+def _OllamaHealthCheck(base_url):
+    from ollama import Client
+
+    Client(host=base_url, timeout=float(os.getenv("POOL_HEALTH_TIMEOUT", "5"))).list()
+
+def _CreateLocalModel(endpoints=_OllamaEndpoints, overflow=True):
+    # 接続先ごとの同時実行数の上限はOllamaのOLLAMA_NUM_PARALLELに合わせる
+    # LOCAL_GEMINI_OVERFLOW=1の場合、ローカルの接続先がすべて停止中か埋まっている時にGeminiへ逃がす
+    max_in_flight = int(os.getenv("POOL_MAX_IN_FLIGHT", "4"))
+    members = [
+        PoolMember(
+            base_url or os.getenv("OLLAMA_HOST") or "ollama", partial(_CreateOllamaModel, base_url, model), model,
+            max_in_flight=max_in_flight, health_check=partial(_OllamaHealthCheck, base_url)
+        )
+        for base_url, model in endpoints()
+    ]
+    if overflow and os.getenv("LOCAL_GEMINI_OVERFLOW") == "1":
+        members.append(PoolMember("gemini", _CreateGeminiModel, GEMINI_MODEL, max_in_flight=max_in_flight, overflow=True))
+    return BackendPool(
+        members,
+        routing=os.getenv("POOL_ROUTING", "least_loaded"),
+        cooldown=float(os.getenv("POOL_COOLDOWN", "30")),
+    )
+
+MODEL_FACTORIES = {
+    "local": _CreateLocalModel,
+    # 小さいモデルで失敗した呼び出しは大きいモデルでやり直すため、Geminiへは逃がさない
+    "local_small": partial(_CreateLocalModel, _SmallOllamaEndpoints, overflow=False),
+    "gemini": _CreateGeminiModel,
+}
+
+def BackendName(use_local):
+    return "local" if use_local else "gemini"
+
+class ModelRegistry:
+    # バックエンドごとのモデルを初めて使う時に1度だけ作成し、全モジュールで共有する
+    # モジュールはプロセス内で1度しか読み込まれないため、Streamlitの再実行をまたいで同じインスタンスが使われる
+    def __init__(self, factories):
+        self.factories = factories
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def get(self, backend):
+        with self._lock:
+            if backend not in self._models:
+                self._models[backend] = self.factories[backend]()
+            return self._models[backend]
+
+    def set(self, backend, model):
+        # ベンチマークなどでモデルを差し替える
+        with self._lock:
+            self._models[backend] = model
+
+    def loaded(self, backend):
+        # 作成済みのモデルを返す（未作成の場合は作成せずにNoneを返す）
+        with self._lock:
+            return self._models.get(backend)
+
+    def reset(self, backend=None):
+        with self._lock:
+            if backend is None:
+                self._models.clear()
+            else:
+                self._models.pop(backend, None)
+
+model_registry = ModelRegistry(MODEL_FACTORIES)
+
+def GetModel(use_local):
+    return model_registry.get(BackendName(use_local))
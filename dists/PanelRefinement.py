@@ -0,0 +1,95 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from dists.ModelCascade import stage_models
+from dists.ModelRegistry import BackendName
+from dists.PersonaPipeline import RunPersonaPipelines
+from dists.PlanRevisons import SuggestBusinessPlan
+
+def InputKey(stage, *parts):
+    # 段階の名前と入力の内容から決まるキー（人物はJSONにして比べる）
+    payload = json.dumps(
+        [stage, *[part.model_dump() if hasattr(part, "model_dump") else part for part in parts]],
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class StageMemo:
+    # 段階ごとの出力を入力のキーで保持し、入力が変わらない処理はやり直さない
+    # LLM応答のキャッシュ（ResponseCache）を使わない設定でも、同じパネルの再評価の間は効く
+    # 件数がmax_entriesを超えた場合は、最も古く使われたものから捨てる
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+def _Models(use_local, cascade=None):
+    # 入力が同じでも、バックエンドやステージごとのモデル（dists.ModelCascade）が違えば結果は異なる
+    backend = BackendName(use_local)
+    return {"backend": backend, "tiers": {stage: stage_models.tier(stage, backend, cascade) for stage in sorted(stage_models.tiers)}}
+
+def EvaluationKey(character, service_title, service_req, use_local, comment_mode="debate", fused=False, cascade=None):
+    return InputKey("evaluate", character, service_title, service_req, comment_mode, fused, _Models(use_local, cascade))
+
+def RevisionKey(service_req, comments, use_local, cascade=None):
+    return InputKey("revise", service_req, comments, _Models(use_local, cascade))
+
+def RememberEvaluation(memo, result, service_title, service_req, use_local, comment_mode="debate", fused=False, cascade=None):
+    # 最初の評価など、EvaluatePanelの外で得た結果も再評価で使えるようにする
+    memo.put(EvaluationKey(result.character, service_title, service_req, use_local, comment_mode, fused, cascade), result)
+
+def RememberRevision(memo, service_req, comments, revised, use_local, cascade=None):
+    memo.put(RevisionKey(service_req, comments, use_local, cascade), revised)
+
+def EvaluatePanel(characters, service_title, service_req, use_local, memo=None, max_workers=1, comment_mode="debate", fused=False, on_wait=None, poll_interval=0.5, on_token=None, cache_mode=None, cascade=None):
+    # 固定した人物のパネル（{番号: 人物}）について、コメント生成と意見要約だけを行い、完了した順に結果を返す
+    # 人物の生成は行わない。memoに同じ入力の結果があれば、その人物は呼び出さずに結果を返す
+    pending = []
+    for index in sorted(characters):
+        cached = memo.get(EvaluationKey(characters[index], service_title, service_req, use_local, comment_mode, fused, cascade)) if memo is not None else None
+        if cached is not None:
+            # 同じ人物が別の番号で保持されている場合もあるため、番号はこのパネルのものにする
+            yield cached.model_copy(update={"index": index})
+        else:
+            pending.append(index)
+    if not pending:
+        return
+    for result in RunPersonaPipelines(
+        len(characters), service_title, service_req, None, None, None, use_local,
+        max_workers=max_workers, on_wait=on_wait, poll_interval=poll_interval, indices=pending, stop_on_error=False,
+        comment_mode=comment_mode, fused=fused, on_token=on_token, characters=characters, cache_mode=cache_mode, cascade=cascade
+    ):
+        # 失敗した結果は次回やり直せるよう保持しない
+        if memo is not None and result.error is None:
+            RememberEvaluation(memo, result, service_title, service_req, use_local, comment_mode, fused, cascade)
+        yield result
+
+def RevisePlan(service_req, comments, use_local, memo=None, cache_mode=None, cascade=None):
+    # SuggestBusinessPlanと同じ。同じサービス要件と意見の組は1度だけ改良する
+    key = RevisionKey(service_req, comments, use_local, cascade)
+    revised = memo.get(key) if memo is not None else None
+    if revised is None:
+        revised = SuggestBusinessPlan(service_req, comments, use_local, cache_mode, cascade)
+        if memo is not None and revised:
+            RememberRevision(memo, service_req, comments, revised, use_local, cascade)
+    return revised
@@ -0,0 +1,142 @@
+import os
+import random
+import threading
+
+# 生成済みの人物との類似度がこの値以上の人物は、ほぼ同じ人物とみなす（0〜1）
+DUPLICATE_THRESHOLD = float(os.getenv("PERSONA_DUPLICATE_THRESHOLD", "0.6"))
+# ほぼ同じ人物が生成された場合に作り直す回数（作り直しても似ている場合は除外する）
+DUPLICATE_RETRIES = int(os.getenv("PERSONA_DUPLICATE_RETRIES", "2"))
+
+# 比較に使う項目と重み。氏名は言い換えで簡単に変わるため使わず、職業・家族構成などの属性を重く見る
+FIELD_WEIGHTS = {
+    "job": 2.0,
+    "family_structure": 2.0,
+    "residence": 1.5,
+    "housing": 1.5,
+    "company_size": 1.0,
+    "salary": 1.0,
+    "educational_background": 1.0,
+    "values": 1.0,
+    "lifestyle": 1.0,
+    "hobbies": 1.0,
+    "goals": 1.0,
+    "purchasing_behavior": 1.0,
+    "information_sources": 0.5,
+    "devices": 0.5,
+    "sns_usage": 0.5,
+    "daily_schedule": 0.5,
+    "concerns": 1.0,
+    "needs": 1.0,
+    "favorite_brands": 0.5,
+    "favorite_media": 0.5,
+    "relationships": 0.5,
+    "recent_events": 0.5,
+}
+
+def _Shingles(text, size=3):
+    # 日本語は単語の区切りがないため、文字単位のn-gramで比べる
+    text = "".join(str(text).split())
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[position:position + size] for position in range(len(text) - size + 1)}
+
+def _Jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+def Profile(character):
+    # 項目ごとのn-gramの集合（比較のたびに作り直さないよう、追加時に1度だけ作る）
+    data = character.model_dump()
+    return {field: _Shingles(data[field]) for field in FIELD_WEIGHTS}
+
+def ProfileSimilarity(a, b):
+    # 項目ごとのJaccard係数の重み付き平均
+    total = sum(FIELD_WEIGHTS.values())
+    return sum(weight * _Jaccard(a[field], b[field]) for field, weight in FIELD_WEIGHTS.items()) / total
+
+class PersonaIndex:
+    # 1回の実行（パネル）内の人物を保持し、新しい人物が生成済みの人物とほぼ同じかを判定する
+    # ワーカースレッドから同時に呼ばれるため、判定と追加は1つのロックの中で行う
+    def __init__(self, threshold=DUPLICATE_THRESHOLD, max_pairs=10000):
+        self.threshold = threshold
+        self.max_pairs = max_pairs
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._characters = {}
+        self.rejected = 0
+        self.regenerated = 0
+
+    def _most_similar(self, profile):
+        best_key, best_similarity = None, 0.0
+        for key, other in self._profiles.items():
+            similarity = ProfileSimilarity(profile, other)
+            if similarity > best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key, best_similarity
+
+    def add(self, key, character):
+        # 判定せずに追加する（ライブラリから取り出した人物など）
+        profile = Profile(character)
+        with self._lock:
+            self._profiles[key] = profile
+            self._characters[key] = character
+
+    def add_if_novel(self, key, character):
+        # 生成済みのどの人物とも似ていなければ追加してNoneを、似ていれば(似ている人物のキー, 類似度)を返す
+        profile = Profile(character)
+        with self._lock:
+            similar_key, similarity = self._most_similar(profile)
+            if similar_key is not None and similarity >= self.threshold:
+                return similar_key, similarity
+            self._profiles[key] = profile
+            self._characters[key] = character
+            return None
+
+    def novel(self, key, character, regenerate):
+        # 生成済みの人物とほぼ同じであれば、regenerate(試行回数, 似ている人物)で作り直す
+        # 戻り値は(人物, 似ている人物のキー)。DUPLICATE_RETRIES回作り直しても似ている場合は人物をNoneにして除外する
+        similar_key = None
+        for attempt in range(DUPLICATE_RETRIES + 1):
+            match = self.add_if_novel(key, character)
+            if match is None:
+                return character, None
+            similar_key, similarity = match
+            if attempt == DUPLICATE_RETRIES:
+                break
+            print(f"生成された人物（{character.name}）が生成済みの人物と似ているため（類似度 {similarity:.2f}）、作り直します。")
+            with self._lock:
+                self.regenerated += 1
+            character = regenerate(attempt, self.character(similar_key))
+            if character is None:
+                return None, None
+        print(f"作り直しても生成済みの人物と似ているため、除外します: {character.name}")
+        with self._lock:
+            self.rejected += 1
+        return None, similar_key
+
+    def character(self, key):
+        with self._lock:
+            return self._characters.get(key)
+
+    def diversity(self):
+        # パネルの多様性（1 - 全ペアの平均類似度）と、最も似ている2人
+        # 人数が多い場合は、max_pairs組を無作為に選んで見積もる
+        with self._lock:
+            profiles = dict(self._profiles)
+        keys = sorted(profiles)
+        pairs = [(a, b) for position, a in enumerate(keys) for b in keys[position + 1:]]
+        if not pairs:
+            return {"count": len(keys), "diversity": None, "mean_similarity": None, "closest_pair": None, "closest_similarity": None}
+        if len(pairs) > self.max_pairs:
+            pairs = random.Random(0).sample(pairs, self.max_pairs)
+        similarities = [(ProfileSimilarity(profiles[a], profiles[b]), a, b) for a, b in pairs]
+        mean_similarity = sum(similarity for similarity, _, _ in similarities) / len(similarities)
+        closest_similarity, closest_a, closest_b = max(similarities)
+        return {
+            "count": len(keys),
+            "diversity": 1.0 - mean_similarity,
+            "mean_similarity": mean_similarity,
+            "closest_pair": (closest_a, closest_b),
+            "closest_similarity": closest_similarity,
+        }
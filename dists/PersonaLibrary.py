@@ -0,0 +1,107 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from dists.GeneratePersona import Character
+
+# 性別を問わない指定。ライブラリから取り出す際は、どの性別で生成した人物も対象にする
+ANY_GENDER = "男女どちらでも"
+
+class PersonaLibrary:
+    # 生成・検証済みの人物をSQLiteに保存し、次回以降の評価で再利用する
+    # 人物のプロフィールはサービスに依存しないため、同じ条件の人物は生成せずにここから取り出せる
+    # 取り出す際は、使われた回数の少ない人物から重複なしで選ぶ
+    def __init__(self, path, save=True):
+        self.path = path
+        self.save = save
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS personas (
+                    id INTEGER PRIMARY KEY,
+                    fingerprint TEXT NOT NULL UNIQUE,
+                    gender TEXT NOT NULL,
+                    age INTEGER NOT NULL,
+                    age_bucket INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    character TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    uses INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS personas_gender_age ON personas (gender, age_bucket, uses)")
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def _age_bucket(age):
+        # 年代（20代なら20）で分類する
+        return max(0, age) // 10 * 10
+
+    def add(self, character, gender):
+        # 同じ内容の人物は1度だけ保存する。保存した場合はTrueを返す
+        if not self.save:
+            return False
+        character_json = character.model_dump_json()
+        fingerprint = hashlib.sha256(character_json.encode("utf-8")).hexdigest()
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO personas (fingerprint, gender, age, age_bucket, name, character, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fingerprint, gender, character.age, self._age_bucket(character.age), character.name, character_json, time.time()),
+            )
+            connection.commit()
+            return cursor.rowcount > 0
+
+    def _where(self, gender, age_range_start, age_range_end):
+        conditions = ["age_bucket BETWEEN ? AND ?"]
+        parameters = [int(age_range_start), int(age_range_end)]
+        if gender != ANY_GENDER:
+            conditions.append("gender = ?")
+            parameters.append(gender)
+        return " AND ".join(conditions), parameters
+
+    def count(self, gender, age_range_start, age_range_end):
+        where, parameters = self._where(gender, age_range_start, age_range_end)
+        with self._lock:
+            return self._connect().execute(f"SELECT COUNT(*) FROM personas WHERE {where}", parameters).fetchone()[0]
+
+    def sample(self, gender, age_range_start, age_range_end, count, exclude=()):
+        # 条件に合う人物を最大count人、重複なしで取り出して(id, Character)のリストを返す
+        # 使われた回数の少ない人物を優先し、同じ回数の中からは無作為に選ぶ
+        if count <= 0:
+            return []
+        where, parameters = self._where(gender, age_range_start, age_range_end)
+        exclude = list(exclude)
+        if exclude:
+            where += f" AND id NOT IN ({', '.join('?' * len(exclude))})"
+            parameters += exclude
+        with self._lock:
+            connection = self._connect()
+            rows = connection.execute(
+                f"SELECT id, character FROM personas WHERE {where} ORDER BY uses, RANDOM() LIMIT ?",
+                (*parameters, count),
+            ).fetchall()
+            now = time.time()
+            connection.executemany("UPDATE personas SET uses = uses + 1, last_used = ? WHERE id = ?", [(now, row[0]) for row in rows])
+            connection.commit()
+        return [(persona_id, Character.model_validate_json(character_json)) for persona_id, character_json in rows]
+
+    def stats(self):
+        with self._lock:
+            count, used = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(uses), 0) FROM personas").fetchone()
+            return {"personas": count, "reuses": used}
+
+persona_library = PersonaLibrary(
+    os.getenv("PERSONA_LIBRARY_PATH", os.path.join(os.getenv("LLM_CACHE_DIR", ".cache"), "personas.sqlite3")),
+    save=os.getenv("PERSONA_LIBRARY_SAVE", "1") == "1",
+)
@@ -0,0 +1,225 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Optional
+
+from pydantic import BaseModel
+
+from dists.GeneratePersona import Character, Opinion, GenerateHumanModel, GenerateHumanModels, GenerateComment, GenerateCommentStream, GenerateCommentWithOpinion, OpinionSummerizer
+from dists.PersonaLibrary import persona_library
+from dists.ResponseCache import CacheMissError
+from dists.RetryPolicy import BackendUnavailableError
+
+class PersonaResult(BaseModel):
+    index: int
+    character: Optional[Character] = None
+    comment: Optional[str] = None
+    comment_timings: Optional[dict] = None
+    opinion: Optional[Opinion] = None
+    error: Optional[str] = None
+    # ほぼ同じ人物しか生成されずに除外した場合の、似ている人物の番号（失敗ではないため、stop_on_errorでも処理を止めない）
+    duplicate_of: Optional[int] = None
+
+def _DuplicateResult(index, duplicate_of):
+    return PersonaResult(index=index, duplicate_of=duplicate_of, error=f"{duplicate_of + 1}人目とほぼ同じ人物しか生成されなかったため、除外しました。")
+
+def EvaluateCharacter(index, character, service_title, service_req, use_local, comment_mode="debate", fused=False, on_token=None, cache_mode=None, cascade=None):
+    # 生成済みの人物について、コメント生成 → 意見要約を実行
+    # fusedの場合はコメントと意見を1回の呼び出しで生成する
+    # on_tokenを渡すと、コメントを生成されたそばから on_token(index, chunk) で通知する（fusedの場合はJSONのため通知しない）
+    comment_timings = {}
+    try:
+        if fused:
+            fused_data = GenerateCommentWithOpinion(service_title, service_req, character, use_local, timings=comment_timings, comment_mode=comment_mode, cache_mode=cache_mode, cascade=cascade)
+            if fused_data is None:
+                return PersonaResult(index=index, character=character, error="有効なデータの生成に失敗しました。試行回数を変更し、再度実行してください。")
+            return PersonaResult(
+                index=index, character=character, comment=fused_data.comment, comment_timings=comment_timings,
+                opinion=Opinion(want_level=fused_data.want_level, reason=fused_data.reason)
+            )
+        if on_token is None:
+            persona_data = GenerateComment(service_title, service_req, character, use_local, timings=comment_timings, comment_mode=comment_mode, cache_mode=cache_mode, cascade=cascade)
+        else:
+            chunks = []
+            for chunk in GenerateCommentStream(service_title, service_req, character, use_local, timings=comment_timings, comment_mode=comment_mode, cache_mode=cache_mode, cascade=cascade):
+                chunks.append(chunk)
+                on_token(index, chunk)
+            persona_data = "".join(chunks)
+    except (CacheMissError, BackendUnavailableError) as e:
+        return PersonaResult(index=index, character=character, error=str(e))
+
+    try:
+        opinion_data = OpinionSummerizer(service_title, character, persona_data, use_local, service_data=service_req, cache_mode=cache_mode, cascade=cascade)
+    except (CacheMissError, BackendUnavailableError) as e:
+        return PersonaResult(index=index, character=character, comment=persona_data, comment_timings=comment_timings, error=str(e))
+    if opinion_data is None:
+        return PersonaResult(index=index, character=character, comment=persona_data, comment_timings=comment_timings, error="有効なデータの生成に失敗しました。試行回数を変更し、再度実行してください。")
+
+    return PersonaResult(index=index, character=character, comment=persona_data, comment_timings=comment_timings, opinion=opinion_data)
+
+def RunPersonaPipeline(index, service_title, service_req, gender, age_range_start, age_range_end, use_local, comment_mode="debate", fused=False, on_token=None, persona_index=None, cache_mode=None, cascade=None):
+    # 1人分のペルソナ生成 → コメント生成 → 意見要約を順に実行
+    # persona_indexを渡すと、生成済みの人物とほぼ同じ人物は後続の処理に進む前に作り直す
+    person_model = GenerateHumanModel(gender, age_range_start, age_range_end, use_local, sample_index=index, cache_mode=cache_mode)
+    if person_model is None:
+        return PersonaResult(index=index, error="有効な人間モデルの生成に失敗しました。")
+    if persona_index is not None:
+        person_model, duplicate_of = persona_index.novel(
+            index, person_model,
+            lambda attempt, similar: GenerateHumanModel(gender, age_range_start, age_range_end, use_local, sample_index=f"{index}-novel-{attempt}", avoid=[similar], cache_mode=cache_mode)
+        )
+        if duplicate_of is not None:
+            return _DuplicateResult(index, duplicate_of)
+        if person_model is None:
+            return PersonaResult(index=index, error="有効な人間モデルの生成に失敗しました。")
+    persona_library.add(person_model, gender)
+
+    return EvaluateCharacter(index, person_model, service_title, service_req, use_local, comment_mode=comment_mode, fused=fused, on_token=on_token, cache_mode=cache_mode, cascade=cascade)
+
+def _ProduceCharacters(character_queue, stop_event, indices, persona_batch_size, gender, age_range_start, age_range_end, use_local, preset=(), persona_index=None, cache_mode=None):
+    # 人物をpersona_batch_size人ずつまとめて生成し、1人分が揃うごとに(番号, 人物, 似ている人物の番号)をキューへ入れる
+    # 直近に生成した人物を次の生成に伝え、バッチをまたいだ重複も避ける
+    # presetの(番号, 人物)は生成せずに先にキューへ入れる
+    generated = []
+    try:
+        for index, character in preset:
+            character_queue.put((index, character, None))
+            generated.append(character)
+        for batch_start in range(0, len(indices), persona_batch_size):
+            batch = indices[batch_start:batch_start + persona_batch_size]
+            characters = GenerateHumanModels(
+                gender, age_range_start, age_range_end, len(batch), use_local,
+                sample_index=f"batch-{batch[0]}", avoid=generated[-AVOID_HISTORY:], cache_mode=cache_mode
+            )
+            for index, character in zip(batch, characters):
+                if stop_event.is_set():
+                    return
+                duplicate_of = None
+                if character is not None and persona_index is not None:
+                    character, duplicate_of = persona_index.novel(
+                        index, character,
+                        lambda attempt, similar: GenerateHumanModel(
+                            gender, age_range_start, age_range_end, use_local,
+                            sample_index=f"batch-{index}-novel-{attempt}", avoid=[*generated[-AVOID_HISTORY:], similar], cache_mode=cache_mode
+                        )
+                    )
+                character_queue.put((index, character, duplicate_of))
+                if character is not None:
+                    generated.append(character)
+                    persona_library.add(character, gender)
+    finally:
+        character_queue.put(None)
+
+AVOID_HISTORY = 30
+
+def RunPersonaPipelines(number_of_people, service_title, service_req, gender, age_range_start, age_range_end, use_local, max_workers=1, on_wait=None, poll_interval=0.5, indices=None, stop_on_error=True, comment_mode="debate", fused=False, persona_batch_size=1, on_token=None, characters=None, persona_index=None, stop_when=None, evaluate=None, cache_mode=None, cascade=None):
+    # 最大max_workers人分のパイプラインを並行実行し、完了した順に結果を返す
+    # 次の投入は呼び出し側が結果を受け取った後に行うため、呼び出し側で待機を挟めば投入ペースを調整できる
+    # stop_on_errorの場合、いずれかの人物で失敗したら新規の投入を止め、実行中のものだけを最後まで返す
+    # stop_on_errorでない場合は例外も失敗結果として返し、残りの人物の処理を続ける
+    # on_waitを渡すと、結果を待っている間poll_interval秒ごとに呼び出す（待機状況の表示用）
+    # indicesを渡すと、その番号の人物だけを生成する（再開時など）
+    # persona_batch_sizeが2以上の場合、人物はまとめて生成し、1人分が揃うごとに後続の処理を始める
+    # on_tokenはワーカースレッドから呼び出されるため、UIへの描画は呼び出し側のスレッドで行うこと
+    # charactersに{番号: 人物}を渡すと（ライブラリから取り出した人物など）、その番号は人物を生成せずに後続の処理を行う
+    # persona_index（dists.PersonaDiversity.PersonaIndex）を渡すと、ほぼ同じ人物を作り直し、それでも似ている人物は除外する
+    # stop_whenを渡すと、新しい人物を投入する前に呼び出し、Trueを返した時点で新規の投入を止める（実行中のものは最後まで返す）
+    # evaluateを渡すと、生成済みの人物の評価にEvaluateCharacterの代わりに evaluate(番号, 人物) を使う（番号ごとに評価する内容を変える場合など）
+    # cache_modeとcascadeは、この実行だけの応答キャッシュのモードと段階的なモデルの使用（Noneの場合は全体の設定）
+    if evaluate is None:
+        def evaluate(index, character):
+            return EvaluateCharacter(index, character, service_title, service_req, use_local, comment_mode, fused, on_token, cache_mode, cascade)
+    indices = list(range(number_of_people)) if indices is None else list(indices)
+    if not indices:
+        return
+    characters = characters or {}
+    if persona_index is not None:
+        for index, character in characters.items():
+            persona_index.add(index, character)
+    max_workers = max(1, min(max_workers, len(indices)))
+    next_position = 0
+    stopped = False
+
+    batched = persona_batch_size > 1
+    if batched:
+        character_queue = queue.Queue()
+        stop_event = threading.Event()
+        producer = threading.Thread(
+            target=_ProduceCharacters,
+            args=(
+                character_queue, stop_event, [index for index in indices if index not in characters], persona_batch_size,
+                gender, age_range_start, age_range_end, use_local, [(index, characters[index]) for index in indices if index in characters], persona_index, cache_mode
+            ),
+            daemon=True
+        )
+        producer.start()
+        producer_finished = False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        try:
+            while True:
+                failed = []
+                if not stopped and stop_when is not None and stop_when():
+                    stopped = True
+                while not stopped and len(pending) < max_workers:
+                    if not batched:
+                        if next_position >= len(indices):
+                            break
+                        index = indices[next_position]
+                        if index in characters:
+                            pending[executor.submit(evaluate, index, characters[index])] = index
+                        else:
+                            pending[executor.submit(
+                                RunPersonaPipeline, index, service_title, service_req, gender, age_range_start, age_range_end, use_local, comment_mode, fused, on_token, persona_index, cache_mode, cascade
+                            )] = index
+                        next_position += 1
+                        continue
+
+                    if producer_finished:
+                        break
+                    try:
+                        # 処理中のものがなければ、次の人物が揃うまで待つ
+                        item = character_queue.get(timeout=poll_interval) if not pending else character_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        producer_finished = True
+                        break
+                    index, character, duplicate_of = item
+                    if duplicate_of is not None:
+                        failed.append(_DuplicateResult(index, duplicate_of))
+                        continue
+                    if character is None:
+                        failed.append(PersonaResult(index=index, error="有効な人間モデルの生成に失敗しました。"))
+                        if stop_on_error:
+                            stopped = True
+                        continue
+                    pending[executor.submit(evaluate, index, character)] = index
+
+                for result in failed:
+                    yield result
+
+                if not pending:
+                    if not batched or producer_finished or stopped:
+                        break
+                    if on_wait is not None:
+                        on_wait()
+                    continue
+
+                timeout = poll_interval if on_wait or batched else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if on_wait is not None:
+                    on_wait()
+                for future in sorted(done, key=pending.get):
+                    index = pending.pop(future)
+                    if future.exception() is not None and not stop_on_error:
+                        result = PersonaResult(index=index, error=str(future.exception()))
+                    else:
+                        result = future.result()
+                    if result.error is not None and result.duplicate_of is None and stop_on_error:
+                        stopped = True
+                    yield result
+        finally:
+            if batched:
+                stop_event.set()
@@ -1,38 +1,50 @@
 import os
-from dotenv import load_dotenv
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.output_parsers import PydanticOutputParser
 from langchain_core.output_parsers import StrOutputParser
 
-import google.generativeai as genai
-from langchain_google_genai import GoogleGenerativeAI
-from langchain_ollama.llms import OllamaLLM
-
 from pydantic import BaseModel, Field
 
-load_dotenv()
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=GOOGLE_API_KEY)
-
-model_gemini = GoogleGenerativeAI(model="gemini-2.0-flash-exp", temperature=1)
-model_local  = OllamaLLM(
-    model="qwen2-5-72b",
-    temperature=1,
-)
+from dists.GeneratePersona import TimedStream
+from dists.ModelCascade import stage_models
+from dists.ModelRegistry import BackendName, GetModel
+from dists.RateLimiter import EstimateTokens
+from dists.ResponseCache import CachedChain
+from dists.RetryPolicy import RetryingChain
 
 class Opinion(BaseModel):
     want_level: int = Field(description="サービスの魅力度レベル。0から10の間の整数値。")
     reason: str = Field(description="理由。100字以内。")
 
-def SuggestBusinessPlan(service_data, persona_list, use_local):
-    if use_local:
-        model = model_local
-    else:
-        model = model_gemini
-    
-    output_parser = StrOutputParser()
-    
+# 1回の要約に入れる意見の上限（見積もりトークン数）
+# ローカルモデルのnum_ctx（既定8192）に、指示文と500字程度の出力が収まる大きさにする
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "4000"))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+
+def _ChunkByBudget(texts, budget):
+    # 先頭から順に、見積もりトークン数がbudgetを超えない範囲でまとめる
+    # 段ごとに要約の数が必ず減るよう、budgetを超える場合でも各まとまりには最低2件を入れる
+    chunks = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = EstimateTokens(text)
+        if len(current) >= 2 and current_tokens + tokens > budget:
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _SummarizeOpinions(persona_list, backend, timings=None, cache_mode=None, cascade=None):
+    # 意見がSUMMARY_CHUNK_TOKENSに収まらない場合は、まとまりごとに並列に要約し（map）、
+    # その要約をさらにまとめて要約する（reduce）ことを1つになるまで繰り返す
+    # 段数は人数の対数で増えるため、人数が多くても1回のプロンプトがコンテキスト長を超えない
     persona_summerize_prompt = ChatPromptTemplate.from_template(
         template="""
             次のユーザーの意見を500字程度にまとめてください。
@@ -40,9 +52,43 @@ def SuggestBusinessPlan(service_data, persona_list, use_local):
         """
     )
     
-    persona_summerize_chain = persona_summerize_prompt | model | output_parser
-    persona_summerize = persona_summerize_chain.invoke({"persona": "\n".join(persona_list)})
+    summary_reduce_prompt = ChatPromptTemplate.from_template(
+        template="""
+            次の文章は、ユーザーの意見をいくつかに分けてそれぞれ要約したものです。全体を500字程度にまとめてください。
+            意見の多さや共通する点、少数でも重要な点が分かるようにしてください。
+            要約: {persona}
+        """
+    )
+    
+    # 段階的にモデルを使う設定では、要約は小さいモデルで行う（dists.ModelCascade）
+    persona_summerize_chain = stage_models.chain("意見の要約", backend, lambda model, backend, policy: RetryingChain(CachedChain(persona_summerize_prompt, model, StrOutputParser(), mode=cache_mode), backend, "意見の要約", policy), cascade)
+    summary_reduce_chain = stage_models.chain("要約の統合", backend, lambda model, backend, policy: RetryingChain(CachedChain(summary_reduce_prompt, model, StrOutputParser(), mode=cache_mode), backend, "要約の統合", policy), cascade)
+    
+    chunks = _ChunkByBudget(persona_list, SUMMARY_CHUNK_TOKENS)
+    calls = 0
+    levels = 0
+    if len(chunks) <= 1:
+        summaries = [persona_summerize_chain.invoke({"persona": "\n".join(persona_list)})]
+        calls = 1
+        levels = 1
+    else:
+        chain = persona_summerize_chain
+        with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY) as executor:
+            while True:
+                summaries = list(executor.map(lambda chunk: chain.invoke({"persona": "\n".join(chunk)}), chunks))
+                calls += len(chunks)
+                levels += 1
+                if len(summaries) == 1:
+                    break
+                chain = summary_reduce_chain
+                chunks = _ChunkByBudget(summaries, SUMMARY_CHUNK_TOKENS)
     
+    if timings is not None:
+        timings["summarize_calls"] = calls
+        timings["summarize_levels"] = levels
+    return summaries[0]
+
+def _RemakeChain(model, backend, cache_mode=None):
     persona_remake_prompt = ChatPromptTemplate.from_template(
         template="""
             次のユーザーの意見の要約を元に、サービスを改良してください。
@@ -52,6 +98,29 @@ def SuggestBusinessPlan(service_data, persona_list, use_local):
         """
     )
     
-    chain = persona_remake_prompt | model | output_parser
+    return RetryingChain(CachedChain(persona_remake_prompt, model, StrOutputParser(), mode=cache_mode), backend, "サービスの改良")
+
+def SuggestBusinessPlan(service_data, persona_list, use_local, cache_mode=None, cascade=None):
+    # cache_modeとcascadeは、この実行だけの応答キャッシュのモードと段階的なモデルの使用（Noneの場合は全体の設定）
+    model = GetModel(use_local)
+    backend = BackendName(use_local)
+    
+    persona_summerize = _SummarizeOpinions(persona_list, backend, cache_mode=cache_mode, cascade=cascade)
+    
+    chain = _RemakeChain(model, backend, cache_mode)
     return_data = chain.invoke({"persona": persona_summerize, "service_data": service_data})
-    return return_data
\ No newline at end of file
+    return return_data
+
+def SuggestBusinessPlanStream(service_data, persona_list, use_local, timings=None, cache_mode=None, cascade=None):
+    # SuggestBusinessPlanと同じ改良後のサービス要件を、生成されたそばから返す
+    # 要約は途中経過を表示しないため一括で生成し、timingsにはsummarize / remake_ttft / remakeを記録する
+    model = GetModel(use_local)
+    backend = BackendName(use_local)
+    
+    summarize_start = time.perf_counter()
+    persona_summerize = _SummarizeOpinions(persona_list, backend, timings, cache_mode, cascade)
+    if timings is not None:
+        timings["summarize"] = time.perf_counter() - summarize_start
+    
+    chain = _RemakeChain(model, backend, cache_mode)
+    yield from TimedStream(chain.stream_text({"persona": persona_summerize, "service_data": service_data}), "remake", timings)
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+
+from langchain_core.runnables import Runnable
+
+def EstimateTokens(text):
+    # 日本語は概ね1文字1トークン前後のため、文字数をそのまま上限側の見積もりとして使う
+    return max(1, len(text))
+
+def _StatusCode(error):
+    # ollama.ResponseError（status_code）・httpx.HTTPStatusError（response.status_code）・google.api_coreの例外（code）が持つHTTPステータス
+    for status_code in (getattr(error, "status_code", None), getattr(getattr(error, "response", None), "status_code", None), getattr(error, "code", None)):
+        if isinstance(status_code, int):
+            return status_code
+    return None
+
+def IsRateLimitError(error):
+    # 例外の型とHTTPステータスのみで判断する（メッセージには出力の引用など「429」を含む任意の文字列が入りうるため見ない）
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests", "RateLimitError"):
+        return True
+    return _StatusCode(error) == 429
+
+class TokenBucketRateLimiter:
+    # RPM/TPMの2つのトークンバケットでリクエストを制御する
+    # 429を受けると補充速度を半減させて一定時間停止し、成功が続くと徐々に元の速度へ戻す（AIMD）
+    def __init__(self, requests_per_minute, tokens_per_minute, min_rate_scale=0.1, initial_backoff=5.0, max_backoff=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.min_rate_scale = min_rate_scale
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._request_bucket = float(requests_per_minute)
+        self._token_bucket = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._rate_scale = 1.0
+        self._backoff = initial_backoff
+        self._blocked_until = 0.0
+        self._waiters = {}
+
+        self.total_wait = 0.0
+        self.rate_limited_count = 0
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        scale = self._rate_scale / 60.0
+        self._request_bucket = min(self.requests_per_minute, self._request_bucket + elapsed * self.requests_per_minute * scale)
+        self._token_bucket = min(self.tokens_per_minute, self._token_bucket + elapsed * self.tokens_per_minute * scale)
+
+    def _required_wait(self, now, tokens):
+        scale = self._rate_scale / 60.0
+        wait_time = max(0.0, self._blocked_until - now)
+        if self._request_bucket < 1:
+            wait_time = max(wait_time, (1 - self._request_bucket) / (self.requests_per_minute * scale))
+        # バケット容量を超える見積もりは満タンになるまで待てば通す
+        tokens = min(tokens, self.tokens_per_minute)
+        if self._token_bucket < tokens:
+            wait_time = max(wait_time, (tokens - self._token_bucket) / (self.tokens_per_minute * scale))
+        return wait_time
+
+    def acquire(self, tokens=1):
+        # 送信可能になるまで待機し、実際に待った秒数を返す
+        thread_id = threading.get_ident()
+        start = time.monotonic()
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait_time = self._required_wait(now, tokens)
+                    if wait_time <= 0:
+                        self._request_bucket -= 1
+                        self._token_bucket -= tokens
+                        waited = now - start
+                        self.total_wait += waited
+                        return waited
+                    self._waiters[thread_id] = (start, now + wait_time)
+                time.sleep(min(wait_time, 1.0))
+        finally:
+            with self._lock:
+                self._waiters.pop(thread_id, None)
+
+    def record_tokens(self, tokens):
+        # 応答側のトークン数は事後に差し引く（残量はマイナスになり得る）
+        with self._lock:
+            self._token_bucket -= tokens
+
+    def report_success(self):
+        with self._lock:
+            self._rate_scale = min(1.0, self._rate_scale + 0.1)
+            self._backoff = self.initial_backoff
+
+    def report_rate_limited(self):
+        with self._lock:
+            now = time.monotonic()
+            self.rate_limited_count += 1
+            self._rate_scale = max(self.min_rate_scale, self._rate_scale / 2)
+            self._request_bucket = min(self._request_bucket, 0.0)
+            self._blocked_until = max(self._blocked_until, now + self._backoff)
+            self._backoff = min(self.max_backoff, self._backoff * 2)
+
+    def status(self):
+        # 現在最も長く待っている呼び出しの待機状況を返す（UIの進捗表示用）
+        with self._lock:
+            now = time.monotonic()
+            waiting = None
+            for start, until in self._waiters.values():
+                if waiting is None or until > waiting[1]:
+                    waiting = (start, until)
+            return {
+                "waiting": len(self._waiters),
+                "elapsed": now - waiting[0] if waiting else 0.0,
+                "remaining": max(0.0, waiting[1] - now) if waiting else 0.0,
+                "total_wait": self.total_wait,
+                "rate_scale": self._rate_scale,
+                "rate_limited_count": self.rate_limited_count,
+            }
+
+class RateLimitedLLM(Runnable):
+    # LLMの呼び出し前にレート制限を適用する
+    # 429を受けた場合は制限側に伝えて送信を止め、例外はそのまま返す（再送はRetryPolicyで行う）
+    def __init__(self, llm, limiter):
+        self.llm = llm
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        # model名やtemperatureなどは元のLLMの値を参照する
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    def invoke(self, input, config=None, **kwargs):
+        self.limiter.acquire(EstimateTokens(input.to_string() if hasattr(input, "to_string") else str(input)))
+        try:
+            output = self.llm.invoke(input, config, **kwargs)
+        except Exception as e:
+            if IsRateLimitError(e):
+                self.limiter.report_rate_limited()
+            raise
+        self.limiter.report_success()
+        self.limiter.record_tokens(EstimateTokens(output))
+        return output
+
+    def stream(self, input, config=None, **kwargs):
+        self.limiter.acquire(EstimateTokens(input.to_string() if hasattr(input, "to_string") else str(input)))
+        output_tokens = 0
+        try:
+            for chunk in self.llm.stream(input, config, **kwargs):
+                output_tokens += EstimateTokens(chunk)
+                yield chunk
+        except Exception as e:
+            if IsRateLimitError(e):
+                self.limiter.report_rate_limited()
+            raise
+        self.limiter.report_success()
+        self.limiter.record_tokens(output_tokens)
+
+gemini_rate_limiter = TokenBucketRateLimiter(
+    requests_per_minute=int(os.getenv("GEMINI_RPM", "10")),
+    tokens_per_minute=int(os.getenv("GEMINI_TPM", "4000000")),
+)
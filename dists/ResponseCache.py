@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from langchain_core.runnables import Runnable
+
+from dists.Metrics import CurrentCall, TokenUsageHandler
+
+CACHE_MODES = ("on", "off", "replay")
+
+class CacheMissError(Exception):
+    pass
+
+def _DescribeModel(model):
+    # ラッパー越しでも元のLLMのモデル名とtemperatureを取得する
+    return {
+        "model": str(getattr(model, "model", type(model).__name__)),
+        "temperature": getattr(model, "temperature", None),
+    }
+
+def _DescribeParser(parser):
+    description = {"parser": type(parser).__name__}
+    pydantic_object = getattr(parser, "pydantic_object", None)
+    if pydantic_object is not None:
+        description["schema"] = pydantic_object.model_json_schema()
+    return description
+
+class ResponseCache:
+    # LLMの生の応答をSQLiteに保存する
+    # 最終アクセス順（LRU）で件数・サイズ上限を超えた分と、期限切れの分を削除する
+    def __init__(self, path, mode="on", max_entries=10000, max_bytes=256 * 1024 * 1024, max_age_days=30):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"不明なキャッシュモードです: {mode}")
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def make_key(model, prompt_text, parser, cache_slot=None):
+        payload = json.dumps({
+            **_DescribeModel(model),
+            **_DescribeParser(parser),
+            "prompt": prompt_text,
+            "slot": cache_slot,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            row = connection.execute(
+                "SELECT response FROM responses WHERE key = ? AND created_at >= ?",
+                (key, now - self.max_age_days * 86400),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE responses SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, _DescribeModel(model)["model"], response, len(response.encode("utf-8")), now, now),
+            )
+            self._evict(connection, now)
+            connection.commit()
+
+    def _evict(self, connection, now):
+        connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age_days * 86400,))
+        count, total_size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total_size <= self.max_bytes:
+            return
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            count -= 1
+            total_size -= size
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM responses")
+            connection.commit()
+
+    def stats(self):
+        with self._lock:
+            count, total_size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": count,
+                "bytes": total_size,
+            }
+
+class CachedChain(Runnable):
+    # prompt | model | parser と同じ処理を、モデル呼び出しの手前でキャッシュを参照しながら行う
+    # パースに成功した応答のみ保存するため、再試行時に壊れた応答が返り続けることはない
+    # temperatureが高い生成で同じプロンプトから複数の結果が欲しい場合はcache_slotで区別する
+    # modeを渡すと、キャッシュ全体の設定（cache.mode）の代わりにその実行のモードを使う（画面の利用者ごとに異なるため）
+    # samplingは、実行のたびに異なる結果が欲しい呼び出し（人物の生成など）。onモードでは保存のみ行ってキャッシュからは返さず、
+    # replayモードでのみ最後に保存した応答を返す（同じ条件で再実行しても毎回同じパネルにならないようにする）
+    def __init__(self, prompt, model, parser, cache=None, cache_slot=None, mode=None, sampling=False):
+        self.prompt = prompt
+        self.model = model
+        self.parser = parser
+        self.cache = cache if cache is not None else response_cache
+        self.cache_slot = cache_slot
+        self.sampling = sampling
+        self.mode = mode or self.cache.mode
+        if self.mode not in CACHE_MODES:
+            raise ValueError(f"不明なキャッシュモードです: {self.mode}")
+
+    def _lookup(self, key):
+        if self.sampling and self.mode == "on":
+            return None
+        return self.cache.get(key)
+
+    def _invoke_model(self, prompt_value, config):
+        usage = TokenUsageHandler()
+        response = self.model.invoke(prompt_value, usage.attach(config))
+        usage.record(CurrentCall(), prompt_value.to_string(), response)
+        return response
+
+    def invoke(self, input, config=None, **kwargs):
+        prompt_value = self.prompt.invoke(input, config)
+        if self.mode == "off":
+            return self.parser.invoke(self._invoke_model(prompt_value, config), config)
+
+        key = self.cache.make_key(self.model, prompt_value.to_string(), self.parser, self.cache_slot)
+        response = self._lookup(key)
+        if response is not None:
+            _RecordCacheHit(CurrentCall())
+            return self.parser.invoke(response, config)
+        if self.mode == "replay":
+            raise CacheMissError("リプレイモードですが、キャッシュに該当する応答がありません。")
+
+        response = self._invoke_model(prompt_value, config)
+        output = self.parser.invoke(response, config)
+        self.cache.put(key, self.model, response)
+        return output
+
+    def stream_text(self, input, config=None):
+        # パース前の応答テキストを生成されたそばから返す（キャッシュにある場合は全文を一度に返す）
+        # 全文がそろった時点でパースに成功した応答のみ保存する
+        # 呼び出し側のスレッドで実行中の記録は、最初のチャンクを要求された時点のものを使う
+        record = CurrentCall()
+        prompt_value = self.prompt.invoke(input, config)
+        key = None
+        if self.mode != "off":
+            key = self.cache.make_key(self.model, prompt_value.to_string(), self.parser, self.cache_slot)
+            response = self._lookup(key)
+            if response is not None:
+                _RecordCacheHit(record)
+                yield response
+                return
+            if self.mode == "replay":
+                raise CacheMissError("リプレイモードですが、キャッシュに該当する応答がありません。")
+
+        usage = TokenUsageHandler()
+        chunks = []
+        for chunk in self.model.stream(prompt_value, usage.attach(config)):
+            chunks.append(chunk)
+            yield chunk
+        response = "".join(chunks)
+        usage.record(record, prompt_value.to_string(), response)
+
+        if key is not None:
+            try:
+                self.parser.invoke(response, config)
+            except Exception:
+                return
+            self.cache.put(key, self.model, response)
+
+def _RecordCacheHit(record):
+    if record is not None:
+        record.cache_hits += 1
+
+response_cache = ResponseCache(
+    os.path.join(os.getenv("LLM_CACHE_DIR", ".cache"), "llm_responses.sqlite3"),
+    mode=os.getenv("LLM_CACHE_MODE", "on"),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_MB", "256")) * 1024 * 1024,
+    max_age_days=float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "30")),
+)
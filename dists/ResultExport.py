@@ -0,0 +1,214 @@
+import csv
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from dists.GeneratePersona import Character, Opinion
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(os.getenv("LLM_CACHE_DIR", ".cache"), "exports"))
+# 画面の実行の出力を残す日数（最後の書き込みから）
+EXPORT_MAX_AGE_DAYS = float(os.getenv("EXPORT_MAX_AGE_DAYS", "7"))
+RUN_DIRECTORY_PATTERN = re.compile(r"\d{8}-\d{6}-[0-9a-f]{6}")
+
+# CSVの見出し（以前の出力と同じ名前・同じ列）。Parquetでは項目名をそのまま列名にする
+CSV_HEADERS = {
+    "name": "名前",
+    "age": "年齢",
+    "sex": "性別",
+    "residence": "居住地",
+    "housing": "住居情報",
+    "job": "職業・役職",
+    "company_size": "会社規模",
+    "salary": "年収",
+    "educational_background": "学歴",
+    "family_structure": "家族構成",
+    "values": "価値観・人生観",
+    "lifestyle": "ライフスタイル",
+    "hobbies": "趣味・嗜好",
+    "goals": "目標・理想",
+    "purchasing_behavior": "購買行動",
+    "information_sources": "情報収集方法",
+    "devices": "使用デバイス",
+    "sns_usage": "SNS利用状況",
+    "daily_schedule": "日課・タイムスケジュール",
+    "concerns": "悩み",
+    "needs": "解決したいこと",
+    "favorite_brands": "好きなブランドや商品",
+    "favorite_media": "よく見る映画・動画チャンネル",
+    "relationships": "人間関係",
+    "recent_events": "最近の出来事やエピソード",
+    "comment": "生成されたコメント",
+    "want_level": "サービスの需要レベル",
+    "reason": "理由",
+}
+
+EXPORT_FORMATS = ("csv", "parquet")
+
+def _ExportFields():
+    # 列の順序と型はCharacterとOpinionの定義から決める
+    fields = {name: field.annotation for name, field in Character.model_fields.items()}
+    fields["comment"] = str
+    fields.update({name: field.annotation for name, field in Opinion.model_fields.items()})
+    return fields
+
+EXPORT_FIELDS = _ExportFields()
+
+def ExportRow(character, comment, opinion):
+    return {**character.model_dump(), "comment": comment, **opinion.model_dump()}
+
+def _ParquetSchema():
+    import pyarrow as pa
+
+    types = {int: pa.int64(), str: pa.string(), float: pa.float64()}
+    return pa.schema([(name, types[annotation]) for name, annotation in EXPORT_FIELDS.items()])
+
+def _LastModified(directory):
+    # ディレクトリ内のファイルを上書きしてもディレクトリ自体の更新時刻は変わらないため、ファイルの更新時刻も見る
+    times = [os.path.getmtime(directory)]
+    for entry in os.scandir(directory):
+        times.append(entry.stat().st_mtime)
+    return max(times)
+
+def PruneExportDirectories(max_age_days=None):
+    # NewExportDirectoryで作ったディレクトリのうち、最後の書き込みからmax_age_days日を過ぎたものを消す
+    # （閉じられた画面の分が残り続けないようにする。ジョブごとのディレクトリ（jobs）は消さない）
+    max_age_days = EXPORT_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    if not os.path.isdir(EXPORT_DIR):
+        return []
+    removed = []
+    deadline = time.time() - max_age_days * 86400
+    for entry in os.scandir(EXPORT_DIR):
+        if not entry.is_dir() or not RUN_DIRECTORY_PATTERN.fullmatch(entry.name):
+            continue
+        try:
+            if _LastModified(entry.path) < deadline:
+                shutil.rmtree(entry.path)
+                removed.append(entry.path)
+        except OSError as e:
+            # 他のプロセスが同時に消した場合など
+            print(f"古い出力ディレクトリを削除できませんでした: {entry.path} エラー: {e}")
+    return removed
+
+def NewExportDirectory():
+    # 画面の利用者ごとに別のディレクトリへ書き出す（同時に実行している他の利用者の結果と混ざらないようにする）
+    # 呼び出し側は同じ利用者の実行では同じディレクトリを使い回し、ここでは古いディレクトリを消してから新しい名前を返す
+    PruneExportDirectories()
+    return os.path.join(EXPORT_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}")
+
+class StreamingExporter:
+    # 1人分の結果が揃うごとに行を書き出す（全員分をメモリに溜めてから変換しない）
+    # 結果は完了順に届くが、行は人物の番号順（orderの順、省略時は0から）に書く。先に届いた行は前の番号が揃うまで保持する
+    # 結果が出ない番号（失敗・除外）はskip()で知らせる。保持する行は同時に処理している人数分程度に収まる
+    # CSVは1行ごとに書き込んで保存するため、途中で停止してもそれまでの結果は残る
+    # Parquetは追記できず、途中で停止すると読めないファイルが残るため、close()の時点でCSVから作り直す
+    # （再開時にCSVへ追記した行も含めて1つのファイルになる）
+    def __init__(self, directory, stem="persona_data", formats=EXPORT_FORMATS, row_group_size=64, append=False, order=None):
+        for export_format in formats:
+            if export_format not in EXPORT_FORMATS:
+                raise ValueError(f"不明な出力形式です: {export_format}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.stem = stem
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self.paths = {}
+
+        self._order = list(order) if order is not None else None
+        self._position = 0
+        self._pending = {}
+
+        self._csv_file = None
+        if "csv" in formats:
+            self.paths["csv"] = os.path.join(directory, f"{stem}.csv")
+        if "parquet" in formats:
+            self.paths["parquet"] = os.path.join(directory, f"{stem}.parquet")
+        # Parquetのみを出力する場合も、途中経過はCSVに書いておき、close()でParquetに変換した後に消す
+        self._rows_path = self.paths.get("csv", os.path.join(directory, f".{stem}.rows.csv"))
+        write_header = not append or not os.path.exists(self._rows_path) or os.path.getsize(self._rows_path) == 0
+        # Excelで文字化けしないよう、新しく作る場合のみBOMを付ける
+        self._csv_file = open(self._rows_path, "a" if append else "w", encoding="utf-8-sig" if write_header else "utf-8", newline="")
+        self._csv_writer = csv.writer(self._csv_file)
+        if write_header:
+            self._csv_writer.writerow(CSV_HEADERS[name] for name in EXPORT_FIELDS)
+            self._csv_file.flush()
+
+    def expect(self, order):
+        # 書き出す番号の順序を後から指定する（再開時に未完了の番号が分かってから決める場合など）
+        self._order = list(order)
+        self._position = 0
+
+    def _expected(self):
+        if self._order is None:
+            return self._position
+        return self._order[self._position] if self._position < len(self._order) else None
+
+    def _resolve(self, index, row):
+        self._pending[index] = row
+        while self._expected() is not None and self._expected() in self._pending:
+            row = self._pending.pop(self._expected())
+            if row is not None:
+                self._write(row)
+            self._position += 1
+
+    def _write(self, row):
+        self.rows += 1
+        self._csv_writer.writerow(row[name] for name in EXPORT_FIELDS)
+        self._csv_file.flush()
+        os.fsync(self._csv_file.fileno())
+
+    def add(self, index, character, comment, opinion):
+        self._resolve(index, ExportRow(character, comment, opinion))
+
+    def skip(self, index):
+        # この番号の行は出力されない（前の番号として待たずに、次の番号の行を書く）
+        self._resolve(index, None)
+
+    def write_summary(self, summary):
+        # パネル全体の集計（需要レベルの信頼区間など）を<stem>.summary.jsonに書き出す。呼ぶたびに上書きする
+        self.paths["summary"] = os.path.join(self.directory, f"{self.stem}.summary.json")
+        with open(self.paths["summary"], "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    def _write_parquet(self):
+        # CSVをrow_group_size行ずつ読み、型を付けて一時ファイルに書いてから置き換える（読み込み途中の不完全なファイルを見せない）
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = _ParquetSchema()
+        temporary_path = f"{self.paths['parquet']}.{os.getpid()}.tmp"
+        with open(self._rows_path, encoding="utf-8-sig", newline="") as f, pq.ParquetWriter(temporary_path, schema) as writer:
+            reader = csv.reader(f)
+            next(reader, None)
+            rows = []
+            for values in reader:
+                rows.append({name: annotation(value) for (name, annotation), value in zip(EXPORT_FIELDS.items(), values)})
+                if len(rows) >= self.row_group_size:
+                    writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                    rows = []
+            if rows:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        os.replace(temporary_path, self.paths["parquet"])
+
+    def close(self):
+        if self._csv_file is None:
+            return
+        # 結果が届かなかった番号（打ち切りなど）を待たずに、残りの行を番号順に書く
+        for index in sorted(self._pending):
+            if self._pending[index] is not None:
+                self._write(self._pending[index])
+        self._pending = {}
+        self._csv_file.close()
+        self._csv_file = None
+        if "parquet" in self.paths:
+            self._write_parquet()
+            if "csv" not in self.paths:
+                os.remove(self._rows_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
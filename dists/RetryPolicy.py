@@ -0,0 +1,200 @@
+import json
+import os
+import random
+import threading
+import time
+
+import httpx
+from google.api_core import exceptions as google_exceptions
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import Runnable
+from pydantic import ValidationError
+
+from dists.Metrics import ActiveCall, CallRecord, run_metrics
+from dists.RateLimiter import IsRateLimitError
+from dists.ResponseCache import CacheMissError
+
+TRANSIENT = "transient"
+RATE_LIMIT = "rate_limit"
+PARSE = "parse"
+FATAL = "fatal"
+
+class BackendUnavailableError(Exception):
+    pass
+
+def ClassifyError(error):
+    # 再試行して意味のある失敗かどうかで分類する
+    # transient: 接続失敗・タイムアウト・サーバー側の一時的なエラー（待ってから再試行）
+    # rate_limit: 429・クォータ超過（長めに待ってから再試行）
+    # parse: 出力の形式不正（待たずに再試行）
+    # fatal: 認証エラー・モデルが存在しない・リプレイモードでのキャッシュミスなど（再試行しない）
+    # 形式不正のエラーは出力の内容をメッセージに含むため、他の判定より先に型で分類する
+    if isinstance(error, (OutputParserException, ValidationError, json.JSONDecodeError)):
+        return PARSE
+    if isinstance(error, (CacheMissError, BackendUnavailableError)):
+        return FATAL
+    if IsRateLimitError(error):
+        return RATE_LIMIT
+    if isinstance(error, (google_exceptions.Unauthenticated, google_exceptions.PermissionDenied, google_exceptions.InvalidArgument, google_exceptions.NotFound)):
+        return FATAL
+    if isinstance(error, (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError, google_exceptions.DeadlineExceeded)):
+        return TRANSIENT
+    if isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError)):
+        return TRANSIENT
+    # ollama.ResponseError（モデル未作成の404などは再試行しても直らない）
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return TRANSIENT if status_code >= 500 else FATAL
+    if isinstance(error, (ValueError, TypeError, KeyError)):
+        return FATAL
+    return TRANSIENT
+
+class RetryPolicy:
+    # 分類ごとの最大試行回数と待機時間（指数バックオフ＋フルジッター）、再試行に使える時間（retry_budget）
+    # retry_budgetは最初の試行からの経過時間と次の待機時間の合計の上限で、超える場合は再試行せずに失敗させる
+    # 実行中の呼び出しは打ち切らないため、1回の呼び出しの時間はクライアントのタイムアウト（dists.ModelConfig）で制限する
+    def __init__(self, max_attempts=None, base_delay=1.0, max_delay=60.0, retry_budget=600.0):
+        self.max_attempts = max_attempts or {TRANSIENT: 3, RATE_LIMIT: 6, PARSE: 3, FATAL: 1}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+
+    def delay(self, kind, attempt):
+        if kind == PARSE:
+            return 0.0
+        base = self.base_delay * (4 if kind == RATE_LIMIT else 1)
+        return random.uniform(0, min(self.max_delay, base * 2 ** attempt))
+
+class CircuitBreaker:
+    # 一時的な失敗が続いたバックエンドへの呼び出しを一定時間止め、停止中は待たずに失敗させる
+    # 停止時間が過ぎたら1件だけ試し（half-open）、成功すれば再開する
+    def __init__(self, name, failure_threshold=5, reset_timeout=60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                raise BackendUnavailableError(f"{self.name}は応答しない状態が続いているため、呼び出しを停止しています。")
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self, kind):
+        # 接続できない・サーバーが落ちている場合のみ数える（形式不正や429はバックエンドの停止ではない）
+        if kind != TRANSIENT:
+            with self._lock:
+                self._probing = False
+            return
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+default_retry_policy = RetryPolicy(
+    base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0")),
+    max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", "60.0")),
+    retry_budget=float(os.getenv("LLM_RETRY_BUDGET", "600.0")),
+)
+
+circuit_breakers = {
+    "local": CircuitBreaker("ローカルモデル", failure_threshold=int(os.getenv("LLM_CIRCUIT_FAILURES", "5")), reset_timeout=float(os.getenv("LLM_CIRCUIT_RESET", "60.0"))),
+    "local_small": CircuitBreaker("ローカルの小さいモデル", failure_threshold=int(os.getenv("LLM_CIRCUIT_FAILURES", "5")), reset_timeout=float(os.getenv("LLM_CIRCUIT_RESET", "60.0"))),
+    "gemini": CircuitBreaker("Gemini", failure_threshold=int(os.getenv("LLM_CIRCUIT_FAILURES", "5")), reset_timeout=float(os.getenv("LLM_CIRCUIT_RESET", "60.0"))),
+}
+
+def CallWithRetry(func, backend, stage, policy=None):
+    policy = policy or default_retry_policy
+    breaker = circuit_breakers[backend]
+    start = time.monotonic()
+    attempts = {}
+    while True:
+        breaker.before_call()
+        try:
+            result = func()
+        except Exception as e:
+            kind = ClassifyError(e)
+            breaker.record_failure(kind)
+            attempts[kind] = attempts.get(kind, 0) + 1
+            if attempts[kind] >= policy.max_attempts[kind]:
+                raise
+            delay = policy.delay(kind, attempts[kind] - 1)
+            if time.monotonic() - start + delay > policy.retry_budget:
+                raise
+            print(f"{stage}の呼び出しに失敗しました（{kind}）。{delay:.1f}秒後に再試行します。エラー: {e}")
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+class RetryingChain(Runnable):
+    # chain.invokeを共通の再試行ポリシーとサーキットブレーカーの下で実行する
+    # 呼び出しごとにステージ名・所要時間・試行回数などを記録する（dists.Metrics）
+    def __init__(self, chain, backend, stage, policy=None):
+        self.chain = chain
+        self.backend = backend
+        self.stage = stage
+        self.policy = policy
+
+    def invoke(self, input, config=None, **kwargs):
+        record = CallRecord(self.stage, self.backend)
+        start = time.perf_counter()
+
+        def attempt():
+            record.attempts += 1
+            return self.chain.invoke(input, config, **kwargs)
+
+        try:
+            with ActiveCall(record):
+                return CallWithRetry(attempt, self.backend, self.stage, self.policy)
+        except Exception as e:
+            record.error = type(e).__name__
+            raise
+        finally:
+            record.latency = time.perf_counter() - start
+            run_metrics.add(record)
+
+    def stream_text(self, input, config=None):
+        # 最初のチャンクを受け取るまでの失敗のみ再試行する（途中まで返した出力は取り消せないため）
+        record = CallRecord(self.stage, self.backend)
+        start = time.perf_counter()
+
+        def attempt():
+            record.attempts += 1
+            chunks = iter(self.chain.stream_text(input, config))
+            return chunks, next(chunks, None)
+
+        try:
+            with ActiveCall(record):
+                chunks, first = CallWithRetry(attempt, self.backend, self.stage, self.policy)
+            record.ttft = time.perf_counter() - start
+            if first is not None:
+                yield first
+                yield from chunks
+        except Exception as e:
+            record.error = type(e).__name__
+            raise
+        finally:
+            record.latency = time.perf_counter() - start
+            run_metrics.add(record)
@@ -0,0 +1,275 @@
+import json
+import re
+import sys
+import threading
+from typing import Any, Optional
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
+from pydantic import ValidationError, create_model
+
+from dists.BackendPool import BackendPool
+from dists.Metrics import CurrentCall
+from dists.ResponseCache import CachedChain
+
+class JsonArrayItemExtractor:
+    # ストリーミング中のJSONテキストから、指定したキーの配列の要素を閉じ括弧が揃った時点で1つずつ取り出す
+    # 例: {"characters": [{...}, {...}]} の各 {...} を、配列全体の完了を待たずに返す
+    def __init__(self, key):
+        self.key = key
+        self._buffer = ""
+        self._position = 0
+        self._array_started = False
+        self._item_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self.finished = False
+
+    def feed(self, text):
+        self._buffer += text
+        items = []
+        if not self._array_started:
+            key_position = self._buffer.find(f'"{self.key}"')
+            if key_position < 0:
+                return items
+            bracket_position = self._buffer.find("[", key_position)
+            if bracket_position < 0:
+                return items
+            self._array_started = True
+            self._position = bracket_position + 1
+
+        while self._position < len(self._buffer) and not self.finished:
+            char = self._buffer[self._position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._item_start = self._position
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0 and self._item_start is not None:
+                    items.append(self._buffer[self._item_start:self._position + 1])
+                    self._item_start = None
+            elif char == "]" and self._depth == 0:
+                self.finished = True
+            self._position += 1
+        return items
+
+    @property
+    def in_item(self):
+        # 要素の途中まで受け取っている（閉じ括弧がまだ揃っていない）
+        return self._item_start is not None
+
+class StructuredOutputStats:
+    # パース失敗と修復の件数（修復できた分だけ、呼び出し全体のやり直しを省けている）
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"parsed": 0, "parse_failures": 0, "repaired_locally": 0, "repaired_by_reask": 0, "unrepaired": 0}
+
+    def add(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        total = counts["parsed"] + counts["parse_failures"]
+        counts["parse_failure_rate"] = counts["parse_failures"] / total if total else 0.0
+        counts["repair_rate"] = (counts["repaired_locally"] + counts["repaired_by_reask"]) / counts["parse_failures"] if counts["parse_failures"] else 0.0
+        counts["saved_calls"] = counts["repaired_locally"] + counts["repaired_by_reask"]
+        return counts
+
+structured_output_stats = StructuredOutputStats()
+
+def _BaseLLM(llm):
+    # RateLimitedLLMなどのラッパーを外して元のLLMを取り出す
+    while hasattr(llm, "llm"):
+        llm = llm.llm
+    return llm
+
+def _IsInstance(obj, module_name, class_name):
+    # クライアントライブラリは使う時まで読み込まないため、読み込み済みの場合のみ型を確認する
+    cls = getattr(sys.modules.get(module_name), class_name, None)
+    return cls is not None and isinstance(obj, cls)
+
+class StructuredLLM(Runnable):
+    # バックエンドが対応していれば、スキーマに沿ったJSONのみを出力させる
+    # Ollama: formatにJSONスキーマを指定 / Gemini: response_mime_typeとresponse_schemaを指定
+    def __init__(self, llm, schema):
+        self.llm = llm
+        self.schema = schema
+
+    def __getattr__(self, name):
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    def _options(self):
+        base = _BaseLLM(self.llm)
+        if _IsInstance(base, "langchain_ollama.llms", "OllamaLLM"):
+            return {"format": self.schema.model_json_schema()}
+        if _IsInstance(base, "langchain_google_genai.llms", "GoogleGenerativeAI"):
+            return {"generation_config": {"response_mime_type": "application/json", "response_schema": self.schema}}
+        return {}
+
+    def invoke(self, input, config=None, **kwargs):
+        if isinstance(self.llm, BackendPool):
+            # 接続先ごとに指定方法が異なるため、選ばれた接続先のモデルに合わせて指定する
+            return self.llm.route(lambda model: StructuredLLM(model, self.schema).invoke(input, config, **kwargs))
+        options = self._options()
+        if "generation_config" in options:
+            # GoogleGenerativeAIはストリーミング時のみgeneration_configの追加指定を受け付ける
+            return "".join(self.llm.stream(input, config, **options, **kwargs))
+        return self.llm.invoke(input, config, **options, **kwargs)
+
+    def stream(self, input, config=None, **kwargs):
+        if isinstance(self.llm, BackendPool):
+            yield from self.llm.route_stream(lambda model: StructuredLLM(model, self.schema).stream(input, config, **kwargs))
+            return
+        yield from self.llm.stream(input, config, **self._options(), **kwargs)
+
+def _ExtractJson(text):
+    # コードブロックや前後の説明文を取り除き、最初の { から始まる部分を取り出す
+    fenced = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.DOTALL)
+    if fenced and "{" in fenced.group(1):
+        text = fenced.group(1)
+    start = text.find("{")
+    if start < 0:
+        return None
+    return text[start:]
+
+def _RepairJson(text):
+    # よくある崩れを修正する: 末尾のカンマ、閉じていない文字列・括弧、閉じ括弧以降の余計な文字
+    # 文字列の内側にある ", ]" などは変えないよう、JsonArrayItemExtractorと同じく文字列の内外を追いながら処理する
+    stack = []
+    in_string = False
+    escaped = False
+    kept = []
+    for position, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == ",":
+            following = text[position + 1:].lstrip()
+            if following[:1] in ("}", "]"):
+                continue
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                kept.append(char)
+                break
+        kept.append(char)
+    text = "".join(kept)
+    if in_string:
+        text += '"'
+    text = re.sub(r",\s*$", "", text)
+    text = re.sub(r':\s*$', ': null', text)
+    return text + "".join(reversed(stack))
+
+def _LoadRepairedJson(text):
+    # そのまま閉じても壊れている場合は（キーの途中で切れているなど）、最後の項目を捨てて閉じ直す
+    data = _LoadJson(_RepairJson(text))
+    if data is None and "," in text:
+        data = _LoadJson(_RepairJson(text[:text.rfind(",")]))
+    return data
+
+def _LoadJson(text):
+    try:
+        return json.loads(text, strict=False)
+    except json.JSONDecodeError:
+        return None
+
+class RepairingOutputParser(PydanticOutputParser):
+    # PydanticOutputParserと同じ形式で出力を検証し、失敗した場合は呼び出し全体をやり直す前に
+    # 1. 手元でJSONの崩れを修正し
+    # 2. それでも不足・不正な項目が残れば、その項目だけをモデルに再度問い合わせる
+    reask_model: Optional[Any] = None
+    # 再度の問い合わせにも、元の呼び出しと同じキャッシュモードを使う
+    cache_mode: Optional[str] = None
+
+    def parse_result(self, result, *, partial=False):
+        return self.parse(result[0].text)
+
+    def parse(self, text):
+        json_text = _ExtractJson(text)
+        data = _LoadJson(json_text) if json_text is not None else None
+        if isinstance(data, dict):
+            try:
+                parsed = self.pydantic_object.model_validate(data)
+                structured_output_stats.add("parsed")
+                return parsed
+            except ValidationError:
+                pass
+
+        structured_output_stats.add("parse_failures")
+        record = CurrentCall()
+        if record is not None:
+            record.parse_failures += 1
+        if data is None and json_text is not None:
+            data = _LoadRepairedJson(json_text)
+        if not isinstance(data, dict):
+            structured_output_stats.add("unrepaired")
+            raise OutputParserException(f"{self.pydantic_object.__name__}として解釈できるJSONが見つかりません。", llm_output=text)
+
+        try:
+            parsed = self.pydantic_object.model_validate(data)
+            structured_output_stats.add("repaired_locally")
+            return parsed
+        except ValidationError as e:
+            invalid_fields = sorted({str(error["loc"][0]) for error in e.errors() if error["loc"]})
+
+        if self.reask_model is None or not invalid_fields:
+            structured_output_stats.add("unrepaired")
+            raise OutputParserException(f"{self.pydantic_object.__name__}の項目が不正です: {', '.join(invalid_fields)}", llm_output=text)
+
+        try:
+            parsed = self._reask(data, invalid_fields)
+        except Exception as e:
+            structured_output_stats.add("unrepaired")
+            raise OutputParserException(f"不足している項目の再取得に失敗しました: {e}", llm_output=text) from e
+        structured_output_stats.add("repaired_by_reask")
+        return parsed
+
+    def _reask(self, data, invalid_fields):
+        # 不足・不正な項目だけを持つスキーマを作り、その項目のみを生成させて元のデータに合わせる
+        fields = {
+            name: (self.pydantic_object.model_fields[name].annotation, self.pydantic_object.model_fields[name])
+            for name in invalid_fields if name in self.pydantic_object.model_fields
+        }
+        partial_schema = create_model(f"{self.pydantic_object.__name__}Missing", **fields)
+        partial_parser = PydanticOutputParser(pydantic_object=partial_schema)
+        known = {key: value for key, value in data.items() if key not in invalid_fields}
+
+        prompt = ChatPromptTemplate.from_template(
+            template="""次のJSONは一部の項目が欠けているか、形式が正しくありません。
+既存の項目と矛盾しないように、次の項目のみを補ってJSONで出力してください: {fields}
+
+既存の項目: {known}
+
+{format_instructions}
+"""
+        ).partial(format_instructions=partial_parser.get_format_instructions())
+
+        chain = CachedChain(prompt, StructuredLLM(self.reask_model, partial_schema), partial_parser, mode=self.cache_mode)
+        missing = chain.invoke({"fields": ", ".join(fields), "known": json.dumps(known, ensure_ascii=False)})
+        return self.pydantic_object.model_validate({**known, **missing.model_dump()})
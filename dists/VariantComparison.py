@@ -0,0 +1,82 @@
+import string
+
+from dists.AdaptiveSampling import MeanConfidenceInterval
+from dists.GeneratePersona import Opinion
+from dists.PanelRefinement import EvaluationKey, RememberEvaluation
+from dists.PersonaPipeline import EvaluateCharacter, PersonaResult, RunPersonaPipelines
+
+# 画面で複数のサービス要件を1つの欄に入力する場合の区切り（この文字列だけの行）
+VARIANT_SEPARATOR = "---"
+
+def SplitVariants(text):
+    variants = [[]]
+    for line in (text or "").splitlines():
+        if line.strip() == VARIANT_SEPARATOR:
+            variants.append([])
+        else:
+            variants[-1].append(line)
+    return [variant for variant in ("\n".join(lines).strip() for lines in variants) if variant]
+
+def VariantLabel(variant):
+    # 0からA, B, C...（27案以上は番号）。「案」は呼び出し側で付ける
+    return string.ascii_uppercase[variant] if variant < len(string.ascii_uppercase) else str(variant + 1)
+
+def RememberVariantRecords(memo, characters, service_title, variants, records, use_local, comment_mode="debate", fused=False, cascade=None):
+    # 記録済みの評価（{"variant", "index", "comment", "opinion"}）をmemoへ入れ、再開時にCompareVariantsで評価し直さないようにする
+    for record in records:
+        if record["index"] not in characters:
+            continue
+        result = PersonaResult(
+            index=record["index"], character=characters[record["index"]], comment=record["comment"],
+            opinion=Opinion.model_validate(record["opinion"])
+        )
+        RememberEvaluation(memo, result, service_title, variants[record["variant"]], use_local, comment_mode, fused, cascade)
+
+def CompareVariants(characters, service_title, variants, use_local, memo=None, max_workers=1, comment_mode="debate", fused=False, on_wait=None, poll_interval=0.5, cache_mode=None, cascade=None):
+    # 同じ人物のパネル（{番号: 人物}）で複数のサービス要件（variants）を評価し、完了した順に(案の番号, 結果)を返す
+    # 人物は生成せず、人物×案の組をRunPersonaPipelinesで最大max_workers組ずつ並行して評価する（組の順番を番号として渡す）
+    # 同じ人物の案は続けて投入するため、人物のプロフィールから始まるプロンプトの共通部分をOllamaのプロンプトキャッシュで使い回せる
+    # memoに同じ入力の結果がある組（最初の評価で得た案Aの結果など）は呼び出さずに返す
+    pairs = []
+    for index in sorted(characters):
+        for variant, service_req in enumerate(variants):
+            cached = memo.get(EvaluationKey(characters[index], service_title, service_req, use_local, comment_mode, fused, cascade)) if memo is not None else None
+            if cached is not None:
+                yield variant, cached.model_copy(update={"index": index})
+            else:
+                pairs.append((index, variant))
+
+    def evaluate(position, character):
+        # 結果の番号は組の順番にし、受け取った側で人物の番号に戻す
+        _, variant = pairs[position]
+        return EvaluateCharacter(position, character, service_title, variants[variant], use_local, comment_mode, fused, cache_mode=cache_mode, cascade=cascade)
+
+    for result in RunPersonaPipelines(
+        len(pairs), service_title, None, None, None, None, use_local, max_workers=max_workers, on_wait=on_wait, poll_interval=poll_interval,
+        stop_on_error=False, characters={position: characters[index] for position, (index, _) in enumerate(pairs)}, evaluate=evaluate
+    ):
+        # 結果は組の順番を番号として持つため、人物の番号と人物に置き換える
+        index, variant = pairs[result.index]
+        result = result.model_copy(update={"index": index, "character": characters[index]})
+        # 失敗した結果は次回やり直せるよう保持しない
+        if memo is not None and result.error is None:
+            RememberEvaluation(memo, result, service_title, variants[variant], use_local, comment_mode, fused, cascade)
+        yield variant, result
+
+def PairedComparison(levels, baseline=0):
+    # levels: {案の番号: {人物の番号: 需要レベル}}
+    # 同じ人物どうしの差（案 - 基準の案）で比べるため、人物ごとのばらつきが差に混ざらない
+    base = levels.get(baseline, {})
+    rows = []
+    for variant, variant_levels in sorted(levels.items()):
+        differences = [variant_levels[index] - base[index] for index in sorted(variant_levels) if index in base]
+        rows.append({
+            "variant": variant,
+            "label": VariantLabel(variant),
+            "want_level": MeanConfidenceInterval(list(variant_levels.values())),
+            "difference": MeanConfidenceInterval(differences) if variant != baseline and differences else None,
+            "higher": sum(difference > 0 for difference in differences) if variant != baseline else None,
+            "lower": sum(difference < 0 for difference in differences) if variant != baseline else None,
+            "same": sum(difference == 0 for difference in differences) if variant != baseline else None,
+        })
+    return rows
@@ -1,34 +1,198 @@
+import itertools
+import json
 import os
+import threading
 import time
-import pandas as pd
 
 import streamlit as st
+from dotenv import load_dotenv
 
-import matplotlib.pyplot as plt
-import japanize_matplotlib
-import matplotlib.font_manager as fm
+# dists以下のモジュールは読み込み時に環境変数から設定を読むため、先に.envを読み込む
+load_dotenv()
 
-from dists.GeneratePersona import GenerateHumanModel, GenerateComment, OpinionSummerizer
-from dists.PlanRevisons import SuggestBusinessPlan
+from dists.AdaptiveSampling import AdaptiveStopper, MeanConfidenceInterval
+from dists.BackendPool import BackendPool
+from dists.DemandChart import RenderDemandChart, RenderRoundChart, RenderVariantChart
+from dists.GeneratePersona import COMMENT_MODES, Character
+from dists.JobQueue import job_queue
+from dists.JobWorker import JOB_POLL_INTERVAL, JOB_WORKERS, JobExportDirectory, StartWorkers
+from dists.Metrics import METRICS_TEXTFILE, run_metrics
+from dists.ModelCascade import cascade_stats, stage_models
+from dists.ModelRegistry import model_registry
+from dists.PanelRefinement import EvaluatePanel, RememberEvaluation, RememberRevision, RevisePlan, StageMemo
+from dists.PersonaDiversity import DUPLICATE_THRESHOLD, PersonaIndex
+from dists.PersonaLibrary import persona_library
+from dists.PersonaPipeline import RunPersonaPipelines
+from dists.PlanRevisons import SuggestBusinessPlanStream
+from dists.RateLimiter import gemini_rate_limiter
+from dists.ResponseCache import CACHE_MODES, CacheMissError, response_cache
+from dists.ResultExport import NewExportDirectory, StreamingExporter
+from dists.RetryPolicy import BackendUnavailableError
+from dists.StructuredOutput import structured_output_stats
+from dists.VariantComparison import CompareVariants, PairedComparison, SplitVariants, VariantLabel
 
-current_dir = os.getcwd()
-font_path = os.path.join(current_dir, "fonts", "NotoSansJP-VariableFont_wght.ttf")
-font_prop = fm.FontProperties(fname=font_path)
+def update_graph(index, person, data):
+    # 需要レベルはセッションごとに保持する（モジュールの変数だと再実行や他の利用者の結果と混ざる）
+    # 完了順ではなく人物の番号順に並べる
+    st.session_state.demand_levels[index] = (person.name, data.want_level)
+    RenderDemandChart(graph_placeholder, st.session_state.demand_levels)
 
-graph_data = []
+def render_character(person_model):
+    with st.expander(f"生成された人間モデル: {person_model.name}", expanded=False):
+        st.markdown(f"""
+            * 名前: {person_model.name}
+            * 年齢: {person_model.age}歳
+            * 性別: {person_model.sex}
+            * 居住地: {person_model.residence}
+            * 住居情報: {person_model.housing}
+            * 職業・役職: {person_model.job}
+            * 会社規模: {person_model.company_size}
+            * 年収: {person_model.salary}
+            * 学歴: {person_model.educational_background}
+            * 家族構成: {person_model.family_structure}
+            * 価値観・人生観: {person_model.values}
+            * ライフスタイル: {person_model.lifestyle}
+            * 趣味・嗜好: {person_model.hobbies}
+            * 目標・理想: {person_model.goals}
+            * 購買行動: {person_model.purchasing_behavior}
+            * 情報収集方法: {person_model.information_sources}
+            * 使用デバイス: {person_model.devices}
+            * SNS利用状況: {person_model.sns_usage}
+            * 日課・タイムスケジュール: {person_model.daily_schedule}
+            * 悩み: {person_model.concerns}
+            * 解決したいこと: {person_model.needs}
+            * 好きなブランドや商品: {person_model.favorite_brands}
+            * よく見る映画・動画チャンネル: {person_model.favorite_media}
+            * 人間関係: {person_model.relationships}
+            * 最近の出来事やエピソード: {person_model.recent_events}
+        """
+        )
+
+def render_comparison(variants, levels):
+    # variants: サービス要件のリスト（最初が案A）, levels: {案の番号: {人物の番号: (氏名, 需要レベル)}}
+    rows = PairedComparison({variant: {index: level for index, (_, level) in person_levels.items()} for variant, person_levels in levels.items()})
+    RenderVariantChart(st.empty(), [(VariantLabel(variant), levels.get(variant, {})) for variant in range(len(variants))])
+    st.table([{
+        "案": row["label"],
+        "人数": row["want_level"]["count"],
+        "需要レベルの平均": interval_value(row["want_level"]),
+        "案Aとの差（同じ人物どうし）": "基準" if row["variant"] == 0 else interval_value(row["difference"], signed=True),
+        "上がった / 下がった / 同じ": "" if row["variant"] == 0 else f"{row['higher']} / {row['lower']} / {row['same']}人",
+    } for row in rows])
+    names = {index: name for person_levels in levels.values() for index, (name, _) in person_levels.items()}
+    st.table([{
+        "人物": f"{index + 1}. {name}",
+        **{VariantLabel(variant): levels.get(variant, {}).get(index, (None, None))[1] for variant in range(len(variants))},
+    } for index, name in sorted(names.items())])
+    with st.expander("比較したサービス要件", expanded=False):
+        for variant, variant_req in enumerate(variants):
+            st.markdown(f"#### 案{VariantLabel(variant)}")
+            st.markdown(variant_req)
+    return rows
 
-def update_graph(person, data):
-    # 新しいデータを追加
-    graph_data.append((person.name, data.want_level))
+JOB_STATUS_LABELS = {"queued": "待機中", "running": "実行中", "done": "完了", "failed": "失敗", "cancelled": "中止"}
+
+@st.cache_resource
+def start_job_workers():
+    # サーバーのプロセスごとに1度だけワーカーを起動し、すべての利用者のジョブを実行する（JOB_WORKERS=0の場合はworker.pyを別に起動する）
+    return StartWorkers(JOB_WORKERS) if JOB_WORKERS > 0 else []
+
+def render_job(job_id):
+    # 記録済みの途中結果を表示し、実行中であればJOB_POLL_INTERVAL秒後に再読み込みする
+    job = job_queue.get(job_id)
+    if job is None:
+        st.error(f"ジョブ {job_id} が見つかりません。")
+        return
+    st.markdown(f"## ジョブ: {job['title']}")
+    status = JOB_STATUS_LABELS[job["status"]]
+    if job["status"] == "queued":
+        status += f"（前に{job_queue.position(job_id)}件）"
+    st.progress(min(1.0, job["done"] / job["total"]) if job["total"] else 1.0, text=f"{status} / {job['done']}/{job['total']}人 / ID {job_id}")
+    if job["error"]:
+        st.error(job["error"])
+    if job["status"] in ("queued", "running") and st.button("このジョブを中止する"):
+        job_queue.cancel(job_id)
+        st.rerun()
+    
+    chart_placeholder = st.empty()
+    levels = {}
+    round_levels = []
+    variant_levels = {}
+    for _, record in job_queue.records(job_id):
+        if record["type"] == "duplicate":
+            st.warning(record["error"])
+        elif record["type"] == "error":
+            st.error(f"{record['index'] + 1}人目: {record['error']}")
+        elif record["type"] == "persona":
+            person_model = Character.model_validate(record["character"])
+            levels[record["index"]] = (person_model.name, record["opinion"]["want_level"])
+            render_character(person_model)
+            with st.expander("生成されたコメント", expanded=False):
+                st.success(record["comment"])
+            st.markdown(f"""
+                * サービスの需要レベル: {record['opinion']['want_level']}
+                * 理由: {record['opinion']['reason']}""")
+            st.write("------------")
+        elif record["type"] == "plan":
+            st.markdown("## サービス改良\n### 改良されたサービス要件")
+            st.markdown(record["revised_service_req"] or "")
+            round_levels.append(dict(levels))
+        elif record["type"] == "variant":
+            variant_levels.setdefault(record["variant"], {})[record["index"]] = (levels[record["index"]][0] if record["index"] in levels else "", record["opinion"]["want_level"])
+        elif record["type"] == "comparison":
+            st.markdown("## サービス要件の比較")
+            render_comparison([job["params"]["service_req"], *job["params"]["variants"]], {0: dict(levels), **variant_levels})
+        elif record["type"] == "round":
+            round_levels.append({row["index"]: (row["name"], row["opinion"]["want_level"]) for row in record["personas"]})
+            with st.expander(f"ラウンド{record['round']}のサービス要件と意見", expanded=False):
+                st.markdown(record["service_req"])
+                st.table([{"人物": f"{row['index'] + 1}. {row['name']}", "需要レベル": row["opinion"]["want_level"], "理由": row["opinion"]["reason"]} for row in record["personas"]])
+    if levels:
+        RenderDemandChart(chart_placeholder, levels)
+        st.caption(interval_text(MeanConfidenceInterval([level for _, level in levels.values()])))
+    if len(round_levels) > 1:
+        RenderRoundChart(st.empty(), round_levels)
+    
+    export_directory = JobExportDirectory(job_id)
+    for file_name, label, mime in (
+        ("persona_data.csv", "CSVファイルのダウンロード", "text/csv"),
+        ("persona_data.parquet", "Parquetファイルのダウンロード", "application/vnd.apache.parquet"),
+        ("persona_data.summary.json", "集計（JSON）のダウンロード", "application/json"),
+    ):
+        path = os.path.join(export_directory, file_name)
+        if job["status"] not in ("queued", "running") and os.path.exists(path):
+            with open(path, "rb") as f:
+                st.download_button(label=label, data=f, file_name=file_name, mime=mime, key=f"{job_id}-{file_name}")
     
-    # グラフをクリアして再描画
-    fig, ax = plt.subplots()
-    names, levels = zip(*graph_data)
-    ax.bar(names, levels)
-    ax.set_title("サービスの需要レベル", fontproperties=font_prop)
-    ax.set_xlabel("人物名", fontproperties=font_prop)
-    ax.set_ylabel("需要レベル", fontproperties=font_prop)
-    graph_placeholder.pyplot(fig)
+    if job["status"] in ("queued", "running"):
+        start_job_workers()
+        time.sleep(JOB_POLL_INTERVAL)
+        st.rerun()
+
+def render_downloads(exporter, export_directory):
+    # 結果は人物ごとに書き出し済みのため、ファイルをそのまま渡す
+    for key, label, file_name, mime in (
+        ("csv", "CSVファイルのダウンロード", "persona_data.csv", "text/csv"),
+        ("parquet", "Parquetファイルのダウンロード", "persona_data.parquet", "application/vnd.apache.parquet"),
+        ("summary", "集計（JSON）のダウンロード", "persona_data.summary.json", "application/json"),
+    ):
+        with open(exporter.paths[key], "rb") as f:
+            st.download_button(label=label, data=f, file_name=file_name, mime=mime)
+    st.caption(f"結果は {export_directory} にも保存されています。")
+
+def interval_value(interval, signed=False):
+    # 評価できた人物がいない場合は平均を求められない
+    if interval is None or interval["count"] == 0:
+        return "—"
+    mean = f"{interval['mean']:+.2f}" if signed else f"{interval['mean']:.2f}"
+    if interval["half_width"] is None:
+        return mean
+    return f"{mean} ± {interval['half_width']:.2f}"
+
+def interval_text(interval):
+    if interval["half_width"] is None:
+        return f"需要レベルの平均: {interval['mean']:.2f}（{interval['count']}人）"
+    return f"需要レベルの平均: {interval['mean']:.2f} ± {interval['half_width']:.2f}（{interval['confidence']:.0%}信頼区間 {interval['low']:.2f}〜{interval['high']:.2f}, {interval['count']}人）"
 
 st.set_page_config(page_title="ペルソナ生成", layout="centered")
 
@@ -84,6 +248,12 @@ example_service_req = """1. サービス概要
 with st.form("persona_form"):
     service_title = st.text_input("サービスタイトル", value="フラデリ")
     service_req = st.text_area("サービス要件", value=example_service_req, height=400)
+    comparison_reqs = st.text_area(
+        "比較するサービス要件（任意）",
+        value="",
+        height=150,
+        help="上のサービス要件を案Aとして、同じ人物で評価して比べます。「---」だけの行で区切ると複数の案を入力できます。"
+    )
     gender = st.selectbox("ターゲットの性別", ["男性", "女性", "その他", "男女どちらでも"])
     
     col1, col2 = st.columns([1, 1])
@@ -93,111 +263,375 @@ with st.form("persona_form"):
         age_range_end = st.selectbox("ターゲットの年代（終了）", [str(i) for i in range(10, 101, 10)])
         
     number_of_people = st.number_input("生成する人数", min_value=1, max_value=10, value=1)
+    adaptive = st.checkbox("需要レベルの平均が目標の精度に達したら生成を打ち切る（「生成する人数」の代わりに最大人数まで生成します）", value=False)
+    col3, col4 = st.columns([1, 1])
+    with col3:
+        target_half_width = st.number_input("目標とする信頼区間の幅（平均±）", min_value=0.1, max_value=5.0, value=0.5, step=0.1)
+    with col4:
+        max_people = st.number_input("打ち切る場合の最大人数", min_value=5, max_value=200, value=50)
+    duplicate_threshold = st.slider("ほぼ同じ人物とみなして作り直す類似度（1.0は完全一致のみ）", min_value=0.3, max_value=1.0, value=DUPLICATE_THRESHOLD, step=0.05)
+    use_library = st.checkbox(f"保存済みの人物を優先して使い、不足分のみ生成する（保存済み {persona_library.stats()['personas']}人）", value=False)
     use_local = st.checkbox("ローカルモデルを使用する", value=True)
+    use_cascade = st.checkbox("下書き・要約・抽出は小さいローカルモデルで行い、不十分な場合のみ大きいモデルでやり直す", value=stage_models.enabled)
+    cache_mode = st.selectbox(
+        "LLM応答のキャッシュ",
+        CACHE_MODES,
+        index=CACHE_MODES.index(response_cache.mode),
+        format_func={"on": "使用する", "off": "使用しない", "replay": "リプレイ（キャッシュのみ・モデルを呼び出さない）"}.get
+    )
+    concurrency = st.number_input("同時に生成する人数", min_value=1, max_value=10, value=1)
+    comment_mode = st.radio(
+        "コメントの生成方法",
+        COMMENT_MODES,
+        format_func={"debate": "肯定的・否定的な感想を統合する（3回呼び出し）", "single": "1回で生成する"}.get,
+        horizontal=True
+    )
+    persona_batch_size = st.number_input("1回の呼び出しで生成する人物の数", min_value=1, max_value=10, value=1)
+    fused = st.checkbox("コメントと需要レベルを同時に生成する（意見要約の呼び出しを省略）", value=False)
+    refinement_rounds = st.number_input("改良後のサービス要件を同じ人物で再評価する回数（人物は生成し直さない）", min_value=0, max_value=5, value=0)
+    show_metrics = st.checkbox("LLM呼び出しの内訳を表示する", value=False)
+    run_in_background = st.checkbox("バックグラウンドで実行する（画面を閉じたり再読み込みしても処理を続け、後から結果を開けます）", value=False)
     submitted = st.form_submit_button("ペルソナ生成")
     
     graph_placeholder = st.empty()
     
-if submitted:
-    people_list = []
-    persona_list = []
-    opinion_list = []
-    for i in range(number_of_people):
-        person_model = GenerateHumanModel(gender, age_range_start, age_range_end, use_local)
-        if person_model is None:
-            st.error("有効な人間モデルの生成に失敗しました。")
-            break
-        people_list.append(person_model)
-        with st.expander(f"生成された人間モデル: {person_model.name}", expanded=False):
-            st.markdown(f"""
-                * 名前: {person_model.name}
-                * 年齢: {person_model.age}歳
-                * 性別: {person_model.sex}
-                * 居住地: {person_model.residence}
-                * 住居情報: {person_model.housing}
-                * 職業・役職: {person_model.job}
-                * 会社規模: {person_model.company_size}
-                * 年収: {person_model.salary}
-                * 学歴: {person_model.educational_background}
-                * 家族構成: {person_model.family_structure}
-                * 価値観・人生観: {person_model.values}
-                * ライフスタイル: {person_model.lifestyle}
-                * 趣味・嗜好: {person_model.hobbies}
-                * 目標・理想: {person_model.goals}
-                * 購買行動: {person_model.purchasing_behavior}
-                * 情報収集方法: {person_model.information_sources}
-                * 使用デバイス: {person_model.devices}
-                * SNS利用状況: {person_model.sns_usage}
-                * 日課・タイムスケジュール: {person_model.daily_schedule}
-                * 悩み: {person_model.concerns}
-                * 解決したいこと: {person_model.needs}
-                * 好きなブランドや商品: {person_model.favorite_brands}
-                * よく見る映画・動画チャンネル: {person_model.favorite_media}
-                * 人間関係: {person_model.relationships}
-                * 最近の出来事やエピソード: {person_model.recent_events}
-            """
-            )
-        persona_data = GenerateComment(service_title, service_req, person_model, use_local)
-        persona_list.append(persona_data)
-        
-        with st.expander(f"生成されたコメント", expanded=False):
-            st.success(persona_data)
-        
-        opinion_data = OpinionSummerizer(service_title, person_model, persona_data, use_local)
+if "stage_memo" not in st.session_state:
+    # 入力が同じ評価・改良はやり直さない（同じ利用者が同じ条件で再実行した場合も含む）
+    st.session_state.stage_memo = StageMemo()
+if "demand_levels" not in st.session_state:
+    st.session_state.demand_levels = {}
+elif st.session_state.demand_levels and not submitted:
+    RenderDemandChart(graph_placeholder, st.session_state.demand_levels)
+
+with st.sidebar:
+    st.markdown("### バックグラウンドのジョブ")
+    for job in job_queue.list(limit=20):
+        if st.button(f"{job['title']}（{JOB_STATUS_LABELS[job['status']]} {job['done']}/{job['total']}人）", key=f"job-{job['id']}"):
+            st.query_params["job"] = job["id"]
+            st.rerun()
+
+if submitted and run_in_background:
+    start_job_workers()
+    job_id = job_queue.submit(service_title, {
+        "service_title": service_title,
+        "service_req": service_req,
+        "gender": gender,
+        "age_range_start": age_range_start,
+        "age_range_end": age_range_end,
+        "use_local": use_local,
+        "cache_mode": cache_mode,
+        "cascade": use_cascade,
+        "concurrency": concurrency,
+        "comment_mode": comment_mode,
+        "persona_batch_size": persona_batch_size,
+        "fused": fused,
+        "duplicate_threshold": duplicate_threshold,
+        "use_library": use_library,
+        "target_half_width": target_half_width if adaptive else None,
+        "rounds": refinement_rounds,
+        "variants": SplitVariants(comparison_reqs),
+    }, max_people if adaptive else number_of_people)
+    # URLにジョブIDを残し、再読み込みや別の端末からでも同じジョブを開けるようにする
+    st.query_params["job"] = job_id
+    
+if submitted and not run_in_background:
+    run_started_at = time.time()
+    # キャッシュのモードと段階的なモデルの使用は、他の利用者の実行に影響しないよう、この実行の呼び出しにだけ渡す
+    if adaptive:
+        number_of_people = max_people
+    st.session_state.demand_levels = {}
+    results = {}
+    result_slots = [st.container() for _ in range(number_of_people)]
+    waiting_bar = st.empty()
+    interval_placeholder = st.empty()
+    
+    # 需要レベルの平均の信頼区間が目標の幅に収まった時点で、新しい人物の投入を止める（実行中の人物は最後まで評価する）
+    stopper = AdaptiveStopper(target_half_width) if adaptive else None
+    persona_index = PersonaIndex(duplicate_threshold)
+    # 同じ利用者の実行では同じディレクトリに上書きし、実行のたびにディレクトリが増えないようにする
+    if "export_directory" not in st.session_state:
+        st.session_state.export_directory = NewExportDirectory()
+    export_directory = st.session_state.export_directory
+    exporter = StreamingExporter(export_directory)
+    library_characters = {}
+    if use_library:
+        drawn = persona_library.sample(gender, age_range_start, age_range_end, number_of_people)
+        library_characters = {index: character for index, (_, character) in enumerate(drawn)}
+        st.info(f"保存済みの人物から{len(library_characters)}人を使用し、{number_of_people - len(library_characters)}人を新たに生成します。")
+    
+    def show_rate_limit_wait():
+        # 固定のクールダウンではなく、レート制限で実際に待機している時間を表示する
+        if use_local:
+            return
+        status = gemini_rate_limiter.status()
+        if status["waiting"] == 0:
+            waiting_bar.empty()
+            return
+        total = status["elapsed"] + status["remaining"]
+        waiting_bar.progress(
+            min(1.0, status["elapsed"] / total) if total > 0 else 1.0,
+            text=f"APIのレート制限により待機中です... 残り{status['remaining']:.0f}秒（累計待機 {status['total_wait']:.0f}秒）"
+        )
+    
+    streaming_comments = {}
+    streaming_lock = threading.Lock()
+    streaming_placeholders = {}
+    
+    def collect_comment_token(index, chunk):
+        # ワーカースレッドから呼ばれるため、ここでは文字列を貯めるだけにして描画はメインスレッドで行う
+        with streaming_lock:
+            streaming_comments[index] = streaming_comments.get(index, "") + chunk
+    
+    def show_progress():
+        show_rate_limit_wait()
+        with streaming_lock:
+            comments = dict(streaming_comments)
+        for index, comment in comments.items():
+            if index not in streaming_placeholders:
+                streaming_placeholders[index] = result_slots[index].empty()
+            streaming_placeholders[index].info(comment + "▌")
+    
+    for result in RunPersonaPipelines(number_of_people, service_title, service_req, gender, age_range_start, age_range_end, use_local, max_workers=concurrency, on_wait=show_progress, poll_interval=0.2, comment_mode=comment_mode, fused=fused, persona_batch_size=persona_batch_size, on_token=collect_comment_token, characters=library_characters, persona_index=persona_index, stop_when=stopper.converged if stopper else None, cache_mode=cache_mode, cascade=use_cascade):
+        person_model = result.character
+        persona_data = result.comment
+        opinion_data = result.opinion
         
+        # 生成途中のコメントを消して、確定した結果に置き換える
+        with streaming_lock:
+            streaming_comments.pop(result.index, None)
+        if result.index in streaming_placeholders:
+            streaming_placeholders.pop(result.index).empty()
         if opinion_data is None:
-            st.error("有効なデータの生成に失敗しました。試行回数を変更し、再度実行してください。")
-            break
+            # 出力しない番号を知らせ、後ろの番号の行を待たせない
+            exporter.skip(result.index)
         
-        opinion_list.append(opinion_data)
-        st.markdown(f"""
-            ## 意見生成完了
-            ### 生成された意見
-        """
-        )
-        st.markdown(f"""
-            * サービスの需要レベル: {opinion_data.want_level}
-            * 理由: {opinion_data.reason}""")
-        update_graph(person_model, opinion_data)
-        st.write("------------")
-        if not use_local:
-            waiting_text = "I am preparing to work on..."
-            waiting_bar = st.progress(0, text=waiting_text)
+        with result_slots[result.index]:
+            if person_model is None:
+                if result.duplicate_of is not None:
+                    st.warning(result.error)
+                else:
+                    st.error(result.error)
+                continue
+            render_character(person_model)
             
-            percent_complete = 0.0
-            total_count = 30
+            if persona_data is None:
+                st.error(result.error)
+                continue
             
-            for _ in range(total_count):
-                percent_complete += 1 / total_count
-                if percent_complete <= 1:
-                    waiting_bar.progress(percent_complete, text=waiting_text)
-                time.sleep(1)
+            with st.expander(f"生成されたコメント", expanded=False):
+                st.success(persona_data)
+                timings = result.comment_timings
+                first_token = f"（最初の出力まで {timings['synthesize_ttft']:.1f}秒）" if "synthesize_ttft" in timings else ""
+                if "branches" in timings:
+                    st.caption(f"肯定的意見: {timings['positive']:.1f}秒 / 否定的意見: {timings['negative']:.1f}秒 / 並列区間: {timings['branches']:.1f}秒（重複 {timings['overlap']:.1f}秒） / 総合: {timings['synthesize']:.1f}秒{first_token}")
+                else:
+                    st.caption(f"生成: {timings['synthesize']:.1f}秒{first_token}")
             
-            waiting_bar.empty()
+            if opinion_data is None:
+                st.error(result.error)
+                continue
+            
+            results[result.index] = result
+            RememberEvaluation(st.session_state.stage_memo, result, service_title, service_req, use_local, comment_mode, fused, use_cascade)
+            exporter.add(result.index, person_model, persona_data, opinion_data)
+            if stopper is not None:
+                stopper.add(opinion_data.want_level)
+            interval_placeholder.caption(interval_text(MeanConfidenceInterval([result.opinion.want_level for result in results.values()])))
+            st.markdown(f"""
+                ## 意見生成完了
+                ### 生成された意見
+            """
+            )
+            st.markdown(f"""
+                * サービスの需要レベル: {opinion_data.want_level}
+                * 理由: {opinion_data.reason}""")
+            update_graph(result.index, person_model, opinion_data)
+            st.write("------------")
+    
+    waiting_bar.empty()
+    exporter.close()
+    
+    want_level_interval = MeanConfidenceInterval([result.opinion.want_level for result in results.values()])
+    if stopper is not None:
+        if stopper.converged():
+            st.info(f"需要レベルの平均の信頼区間が目標（±{target_half_width}）に収まったため、{len(results)}人で打ち切りました。")
+        else:
+            st.warning(f"最大人数（{max_people}人）まで生成しましたが、需要レベルの平均の信頼区間は目標（±{target_half_width}）に収まりませんでした。")
+    
+    diversity = persona_index.diversity()
+    if diversity["diversity"] is not None:
+        closest_a, closest_b = diversity["closest_pair"]
+        st.caption(f"人物の多様性: {diversity['diversity']:.2f}（最も似ている2人: {closest_a + 1}人目と{closest_b + 1}人目, 類似度 {diversity['closest_similarity']:.2f}） / 作り直し {persona_index.regenerated}人 / 除外 {persona_index.rejected}人")
+    run_summary = {
+        "want_level": want_level_interval,
+        "target_half_width": target_half_width if adaptive else None,
+        "max_people": number_of_people,
+        "stopped_early": stopper is not None and stopper.converged(),
+        "diversity": diversity["diversity"],
+        "regenerated": persona_index.regenerated,
+        "rejected": persona_index.rejected,
+    }
+    exporter.write_summary(run_summary)
+    
+    variants = [service_req, *SplitVariants(comparison_reqs)]
+    if len(variants) > 1 and results:
+        # 同じ人物のパネルで他の案を評価する（案Aの結果は上の評価を使い、人物は生成し直さない）
+        st.markdown("## サービス要件の比較")
+        panel = {index: result.character for index, result in results.items()}
+        variant_levels = {variant: {} for variant in range(len(variants))}
+        comparison_started = time.perf_counter()
+        memo_hits = st.session_state.stage_memo.hits
+        comparison_bar = st.progress(0.0, text=f"{len(variants)}案を{len(panel)}人で評価しています...")
+        evaluated = 0
+        for variant, result in CompareVariants(panel, service_title, variants, use_local, memo=st.session_state.stage_memo, max_workers=concurrency, comment_mode=comment_mode, fused=fused, on_wait=show_rate_limit_wait, poll_interval=0.2, cache_mode=cache_mode, cascade=use_cascade):
+            evaluated += 1
+            comparison_bar.progress(evaluated / (len(panel) * len(variants)), text=f"{len(variants)}案を{len(panel)}人で評価しています... {evaluated}/{len(panel) * len(variants)}")
+            if result.error is not None:
+                st.error(f"案{VariantLabel(variant)}の{result.index + 1}人目: {result.error}")
+                continue
+            variant_levels[variant][result.index] = (result.character.name, result.opinion.want_level)
+        comparison_bar.empty()
+        waiting_bar.empty()
+        run_summary["variants"] = render_comparison(variants, variant_levels)
+        st.caption(f"比較: {time.perf_counter() - comparison_started:.1f}秒 / 評価 {evaluated}組（うち入力が同じため省略 {st.session_state.stage_memo.hits - memo_hits}組）")
+        exporter.write_summary(run_summary)
+    
+    # 完了順に関わらず、出力は人物の番号順に揃える
+    ordered_results = [results[index] for index in sorted(results)]
+    people_list = [result.character for result in ordered_results]
+    persona_list = [result.comment for result in ordered_results]
+    opinion_list = [result.opinion for result in ordered_results]
                     
-    remake_survice_data = SuggestBusinessPlan(service_req, persona_list, use_local)
     st.markdown(f"""
-        ## サービス改良完了
+        ## サービス改良
         ### 改良されたサービス要件"""
     )
-    st.write(remake_survice_data)
+    plan_timings = {}
+    try:
+        with st.spinner("ユーザーの意見を要約しています..."):
+            plan_stream = SuggestBusinessPlanStream(service_req, persona_list, use_local, timings=plan_timings, cache_mode=cache_mode, cascade=use_cascade)
+            first_chunk = next(plan_stream, "")
+        remake_survice_data = st.write_stream(itertools.chain([first_chunk], plan_stream))
+    except (CacheMissError, BackendUnavailableError) as e:
+        st.error(str(e))
+        # サービス改良に失敗しても、人物ごとの結果は書き出し済みのためダウンロードできるようにする
+        render_downloads(exporter, export_directory)
+        st.stop()
+    if "remake" in plan_timings:
+        st.caption(f"意見の要約: {plan_timings['summarize']:.1f}秒（{plan_timings['summarize_levels']}段, {plan_timings['summarize_calls']}回） / サービスの改良: {plan_timings['remake']:.1f}秒（最初の出力まで {plan_timings['remake_ttft']:.1f}秒）")
     
-    st.write("------------")
+    if refinement_rounds and results and remake_survice_data:
+        # 改良後のサービス要件を、同じ人物のパネルでコメント生成・意見要約だけやり直して評価する
+        stage_memo = st.session_state.stage_memo
+        RememberRevision(stage_memo, service_req, persona_list, remake_survice_data, use_local, use_cascade)
+        st.markdown("## 改良後のサービス要件の再評価")
+        panel = {index: result.character for index, result in results.items()}
+        round_levels = [{index: (result.character.name, result.opinion.want_level) for index, result in results.items()}]
+        round_chart = st.empty()
+        round_service_req = remake_survice_data
+        round_rows = []
+        for round_number in range(1, refinement_rounds + 1):
+            round_started = time.perf_counter()
+            memo_hits = stage_memo.hits
+            round_results = {}
+            with st.spinner(f"ラウンド{round_number}: 改良後のサービス要件を{len(panel)}人で再評価しています..."):
+                for result in EvaluatePanel(panel, service_title, round_service_req, use_local, memo=stage_memo, max_workers=concurrency, comment_mode=comment_mode, fused=fused, on_wait=show_rate_limit_wait, poll_interval=0.2, cache_mode=cache_mode, cascade=use_cascade):
+                    if result.error is not None:
+                        st.error(f"ラウンド{round_number}の{result.index + 1}人目: {result.error}")
+                        continue
+                    round_results[result.index] = result
+            waiting_bar.empty()
+            previous_levels = round_levels[-1]
+            round_levels.append({index: (result.character.name, result.opinion.want_level) for index, result in round_results.items()})
+            RenderRoundChart(round_chart, round_levels)
+            with st.expander(f"ラウンド{round_number}のサービス要件と意見", expanded=False):
+                st.markdown(round_service_req)
+                st.table([{
+                    "人物": f"{index + 1}. {result.character.name}",
+                    "需要レベル": result.opinion.want_level,
+                    "前回からの変化": result.opinion.want_level - previous_levels[index][1] if index in previous_levels else None,
+                    "理由": result.opinion.reason,
+                } for index, result in sorted(round_results.items())])
+            st.caption(f"ラウンド{round_number}: {time.perf_counter() - round_started:.1f}秒 / 評価 {len(round_results)}人（うち入力が同じため省略 {stage_memo.hits - memo_hits}人）")
+            round_rows.append({
+                "round": round_number,
+                "service_req": round_service_req,
+                "want_level": MeanConfidenceInterval([result.opinion.want_level for result in round_results.values()]),
+                "want_levels": {index: result.opinion.want_level for index, result in sorted(round_results.items())},
+            })
+            if round_number == refinement_rounds or not round_results:
+                break
+            try:
+                with st.spinner(f"ラウンド{round_number}の意見からサービスを改良しています..."):
+                    round_service_req = RevisePlan(round_service_req, [round_results[index].comment for index in sorted(round_results)], use_local, memo=stage_memo, cache_mode=cache_mode, cascade=use_cascade)
+            except (CacheMissError, BackendUnavailableError) as e:
+                st.error(str(e))
+                break
+            if not round_service_req:
+                st.error("サービスの改良に失敗しました。")
+                break
+        run_summary["rounds"] = round_rows
+        exporter.write_summary(run_summary)
     
-    # データフレームの作成
-    data = []
-    for person, persona, opinion in zip(people_list, persona_list, opinion_list):
-        data.append([person.name, person.age, person.sex, person.residence, person.housing, person.job, person.company_size, person.salary, person.educational_background, person.family_structure, person.values, person.lifestyle, person.hobbies, person.goals, person.purchasing_behavior, person.information_sources, person.devices, person.sns_usage, person.daily_schedule, person.concerns, person.needs, person.favorite_brands, person.favorite_media, person.relationships, person.recent_events, persona, opinion.want_level, opinion.reason])
-        
-    df = pd.DataFrame(data, columns=["名前", "年齢", "性別", "居住地", "住居情報", "職業・役職", "会社規模", "年収", "学歴", "家族構成", "価値観・人生観", "ライフスタイル", "趣味・嗜好", "目標・理想", "購買行動", "情報収集方法", "使用デバイス", "SNS利用状況", "日課・タイムスケジュール", "悩み", "解決したいこと", "好きなブランドや商品", "よく見る映画・動画チャンネル", "人間関係", "最近の出来事やエピソード", "生成されたコメント", "サービスの需要レベル", "理由"])
-    
-    # CSVファイルの出力
-    csv_file = df.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
-    
-    # ダウンロードボタンの作成
-    st.download_button(
-        label="CSVファイルのダウンロード",
-        data=csv_file,
-        file_name="persona_data.csv",
-        mime="text/csv"
-    )
\ No newline at end of file
+    cache_stats = response_cache.stats()
+    output_stats = structured_output_stats.snapshot()
+    st.caption(f"構造化出力: パース失敗 {output_stats['parse_failures']}件（{output_stats['parse_failure_rate']:.0%}） / 修復 {output_stats['saved_calls']}件（手元で修正 {output_stats['repaired_locally']}件, 不足項目のみ再取得 {output_stats['repaired_by_reask']}件） / 修復不能 {output_stats['unrepaired']}件")
+    st.caption(f"LLMキャッシュ: ヒット {cache_stats['hits']}件 / ミス {cache_stats['misses']}件（保存件数 {cache_stats['entries']}件, {cache_stats['bytes'] / 1024:.0f}KB）")
+    
+    if METRICS_TEXTFILE:
+        run_metrics.write_prometheus(METRICS_TEXTFILE)
+    
+    if show_metrics:
+        # 同じプロセスで並行して実行された他の利用者の呼び出しも、開始時刻以降のものは含まれる
+        with st.expander("LLM呼び出しの内訳", expanded=True):
+            stage_rows = run_metrics.summary(since=run_started_at)
+            st.table([{
+                "ステージ": row["stage"],
+                "バックエンド": row["backend"],
+                "呼び出し": row["calls"],
+                "合計(秒)": round(row["latency_total"], 1),
+                "平均(秒)": round(row["latency_mean"], 2),
+                "p95(秒)": round(row["latency_p95"], 2),
+                "入力トークン": row["prompt_tokens"],
+                "出力トークン": row["completion_tokens"],
+                "再試行": row["retries"],
+                "パース失敗": row["parse_failures"],
+                "キャッシュヒット": row["cache_hits"],
+            } for row in stage_rows])
+            local_pool = model_registry.loaded("local")
+            if isinstance(local_pool, BackendPool):
+                # 接続先ごとの処理量（累計）。ハードウェアの増減の目安にする
+                st.table([{
+                    "接続先": row["name"],
+                    "モデル": row["model"],
+                    "予備": "○" if row["overflow"] else "",
+                    "状態": "稼働中" if row["healthy"] else "停止中",
+                    "呼び出し": row["calls"],
+                    "失敗": row["errors"],
+                    "切り替え": row["failovers"],
+                    "平均(秒)": round(row["latency_mean"], 2) if row["latency_mean"] is not None else None,
+                    "出力トークン/秒": round(row["tokens_per_second"], 1) if row["tokens_per_second"] is not None else None,
+                    "平均同時実行数": round(row["mean_concurrency"], 2) if row["mean_concurrency"] is not None else None,
+                } for row in local_pool.stats()])
+            cascade_rows = cascade_stats.snapshot()
+            if cascade_rows:
+                # 小さいモデルの出力を採用できず、大きいモデルでやり直した割合（累計）
+                st.table([{
+                    "ステージ": row["stage"],
+                    "小さいモデルで完了": row["accepted"],
+                    "大きいモデルでやり直し": row["escalated"],
+                    "やり直しの割合": f"{row['escalation_rate']:.0%}",
+                    "理由": ", ".join(f"{reason} {count}件" for reason, count in row["reasons"].items()),
+                } for row in cascade_rows])
+            st.download_button(
+                label="実行レポート（JSON）のダウンロード",
+                data=json.dumps(run_metrics.report(since=run_started_at), ensure_ascii=False, indent=2).encode("utf-8"),
+                file_name="run_report.json",
+                mime="application/json"
+            )
+    
+    st.write("------------")
+    render_downloads(exporter, export_directory)
+
+if not (submitted and not run_in_background) and "job" in st.query_params:
+    render_job(st.query_params["job"])
@@ -0,0 +1,59 @@
+import sys
+
+import pytest
+
+from dists.AdaptiveSampling import AdaptiveStopper, MeanConfidenceInterval, _TQuantile
+
+@pytest.fixture
+def without_scipy(monkeypatch):
+    # scipyがある環境でも、scipyを使わない計算をt分布表の値と比べる
+    monkeypatch.setitem(sys.modules, "scipy.stats", None)
+
+# t分布表の値（両側95% / 99%）
+@pytest.mark.parametrize("probability, degrees_of_freedom, expected", [
+    (0.975, 1, 12.706),
+    (0.975, 2, 4.303),
+    (0.975, 3, 3.182),
+    (0.975, 5, 2.571),
+    (0.975, 10, 2.228),
+    (0.975, 29, 2.045),
+    (0.975, 30, 2.042),
+    (0.975, 100, 1.984),
+    (0.995, 3, 5.841),
+    (0.995, 60, 2.660),
+])
+def test_t_quantile_matches_table(without_scipy, probability, degrees_of_freedom, expected):
+    assert _TQuantile(probability, degrees_of_freedom) == pytest.approx(expected, abs=0.001)
+
+def test_t_quantile_is_symmetric(without_scipy):
+    assert _TQuantile(0.025, 4) == pytest.approx(-_TQuantile(0.975, 4))
+    assert _TQuantile(0.5, 4) == pytest.approx(0.0)
+
+def test_interval_needs_two_values():
+    assert MeanConfidenceInterval([]) == {"count": 0, "mean": None, "half_width": None, "low": None, "high": None, "confidence": 0.95}
+    assert MeanConfidenceInterval([3])["half_width"] is None
+
+def test_interval_uses_t_quantile():
+    interval = MeanConfidenceInterval([4, 6])
+    # 標準偏差√2、自由度1: 12.706 × √2 / √2
+    assert interval["mean"] == 5
+    assert interval["half_width"] == pytest.approx(12.706, abs=0.001)
+    assert interval["low"] == pytest.approx(5 - interval["half_width"])
+
+def test_stopper_waits_for_min_count():
+    stopper = AdaptiveStopper(target_half_width=0.5, min_count=5)
+    for _ in range(4):
+        stopper.add(7)
+    assert not stopper.converged()
+    stopper.add(7)
+    assert stopper.converged()
+
+def test_stopper_waits_until_interval_is_narrow():
+    stopper = AdaptiveStopper(target_half_width=1.0, min_count=2)
+    for level in (0, 10, 0, 10):
+        stopper.add(level)
+    assert not stopper.converged()
+    for _ in range(40):
+        stopper.add(5)
+    assert stopper.converged()
+    assert stopper.interval()["half_width"] <= 1.0
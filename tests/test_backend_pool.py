@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from dists.BackendPool import BackendPool, PoolMember
+
+class FakeModel:
+    # failがTrueの間は接続エラーを返すモデル
+    def __init__(self, name, fail=False, error=ConnectionError):
+        self.name = name
+        self.fail = fail
+        self.error = error
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise self.error(f"{self.name}に接続できません")
+        return f"{self.name}の応答"
+
+    def stream(self, input, config=None, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise self.error(f"{self.name}に接続できません")
+        yield self.name
+        yield "の応答"
+
+def make_pool(*models, **kwargs):
+    members = [PoolMember(model.name, lambda model=model: model, "fake") for model in models]
+    return BackendPool(members, **kwargs), members
+
+def test_fails_over_to_another_member_on_connection_error():
+    first, second = FakeModel("a", fail=True), FakeModel("b")
+    pool, members = make_pool(first, second)
+    assert pool.invoke("質問") == "bの応答"
+    assert members[0].failovers == 1
+    assert members[0].down_until > time.monotonic()
+
+    # 停止中の接続先は、停止が明けるまで選ばれない
+    assert pool.invoke("質問") == "bの応答"
+    assert first.calls == 1
+
+def test_stream_fails_over_before_the_first_chunk():
+    pool, _ = make_pool(FakeModel("a", fail=True), FakeModel("b"))
+    assert "".join(pool.stream("質問")) == "bの応答"
+
+def test_fatal_errors_are_not_retried_on_other_members():
+    first, second = FakeModel("a", fail=True, error=ValueError), FakeModel("b")
+    pool, _ = make_pool(first, second)
+    with pytest.raises(ValueError):
+        pool.invoke("質問")
+    assert second.calls == 0
+
+def test_raises_when_every_member_fails():
+    pool, _ = make_pool(FakeModel("a", fail=True), FakeModel("b", fail=True))
+    with pytest.raises(ConnectionError):
+        pool.invoke("質問")
+
+def test_overflow_member_is_used_only_when_regular_members_are_down():
+    local, gemini = FakeModel("local", fail=True), FakeModel("gemini")
+    members = [PoolMember("local", lambda: local, "fake"), PoolMember("gemini", lambda: gemini, "gemini", overflow=True)]
+    pool = BackendPool(members)
+    assert pool.invoke("質問") == "geminiの応答"
+    local.fail = False
+    members[0].down_until = 0.0
+    assert pool.invoke("質問") == "localの応答"
@@ -0,0 +1,107 @@
+import json
+import sys
+
+import pytest
+
+import batch
+from dists.ModelCascade import stage_models
+from dists.ResponseCache import response_cache
+from dists.GeneratePersona import Character, Opinion
+from dists.PersonaPipeline import PersonaResult
+
+def make_character(index):
+    return Character(**{**{name: f"項目{index}" for name in Character.model_fields}, "age": 30})
+
+class FakePipelines:
+    # 指定した番号の人物だけ失敗させ、呼び出されたindicesを記録する
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+        self.options = []
+
+    def __call__(self, number_of_people, *args, indices=None, **kwargs):
+        indices = list(range(number_of_people)) if indices is None else list(indices)
+        self.calls.append(indices)
+        self.options.append((kwargs.get("cache_mode"), kwargs.get("cascade")))
+        for index in indices:
+            if index in self.fail:
+                yield PersonaResult(index=index, error="失敗")
+                continue
+            yield PersonaResult(
+                index=index, character=make_character(index), comment=f"コメント{index}",
+                comment_timings={}, opinion=Opinion(want_level=5, reason="理由")
+            )
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    jobs = tmp_path / "jobs.jsonl"
+    jobs.write_text(json.dumps({
+        "job_id": "job", "service_title": "サービス", "service_req": "要件",
+        "gender": "男性", "age_range": [20, 30], "count": 3,
+    }, ensure_ascii=False) + "\n", encoding="utf-8")
+    return jobs, tmp_path / "results.jsonl"
+
+def run_batch(monkeypatch, jobs, output, pipelines, *options):
+    plans = []
+    monkeypatch.setattr(batch, "RunPersonaPipelines", pipelines)
+    monkeypatch.setattr(batch, "SuggestBusinessPlan", lambda service_req, persona_list, *args, **kwargs: plans.append(persona_list) or "改良案")
+    monkeypatch.setattr(sys, "argv", ["batch.py", "--input", str(jobs), "--output", str(output), *options])
+    batch.main()
+    return plans
+
+def read_records(output):
+    return [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+
+def test_resume_only_runs_missing_personas(monkeypatch, paths):
+    jobs, output = paths
+    first = FakePipelines(fail={1})
+    assert run_batch(monkeypatch, jobs, output, first) == []
+    assert first.calls == [[0, 1, 2]]
+
+    second = FakePipelines()
+    plans = run_batch(monkeypatch, jobs, output, second)
+    assert second.calls == [[1]]
+    assert plans == [["コメント0", "コメント1", "コメント2"]]
+    assert [record["type"] for record in read_records(output)] == ["persona", "persona", "persona", "plan"]
+
+    third = FakePipelines()
+    assert run_batch(monkeypatch, jobs, output, third) == []
+    assert third.calls == []
+
+def test_resume_ignores_truncated_last_line(monkeypatch, paths):
+    jobs, output = paths
+    run_batch(monkeypatch, jobs, output, FakePipelines(fail={2}))
+    with open(output, "a", encoding="utf-8") as f:
+        f.write('{"type": "persona", "job_id": "job", "ind')
+
+    resumed = FakePipelines()
+    run_batch(monkeypatch, jobs, output, resumed)
+    assert resumed.calls == [[2]]
+    lines = output.read_text(encoding="utf-8").splitlines()
+    assert json.loads(lines[-1])["type"] == "plan"
+    assert json.loads(lines[-2])["index"] == 2
+
+def test_no_resume_starts_over(monkeypatch, paths):
+    jobs, output = paths
+    run_batch(monkeypatch, jobs, output, FakePipelines())
+    again = FakePipelines()
+    run_batch(monkeypatch, jobs, output, again, "--no-resume")
+    assert again.calls == [[0, 1, 2]]
+    assert len(read_records(output)) == 4
+
+def test_cache_mode_and_cascade_are_passed_per_run(monkeypatch, paths):
+    jobs, output = paths
+    monkeypatch.setattr(stage_models, "enabled", True)
+    monkeypatch.setattr(response_cache, "mode", "on")
+    pipelines = FakePipelines()
+    plans = []
+    monkeypatch.setattr(batch, "SuggestBusinessPlan", lambda *args, **kwargs: plans.append(kwargs) or "改良案")
+    monkeypatch.setattr(batch, "RunPersonaPipelines", pipelines)
+    monkeypatch.setattr(sys, "argv", ["batch.py", "--input", str(jobs), "--output", str(output), "--cache-mode", "off", "--no-cascade"])
+    batch.main()
+    assert pipelines.options == [("off", False)]
+    assert plans == [{"cache_mode": "off", "cascade": False}]
+    # 全体の設定は変えない
+    assert response_cache.mode == "on"
+    assert stage_models.enabled is True
@@ -0,0 +1,36 @@
+from dists.DemandChart import DemandSummary, RenderDemandChart
+
+class FakePlaceholder:
+    def __init__(self):
+        self.charts = []
+        self.captions = []
+
+    def container(self):
+        return self
+
+    def vega_lite_chart(self, spec, use_container_width=False):
+        self.charts.append(spec)
+
+    def caption(self, text):
+        self.captions.append(text)
+
+def test_summary_clamps_histogram_and_handles_empty_levels():
+    summary = DemandSummary({0: ("甲", 3), 1: ("乙", 7), 2: ("丙", 12)})
+    assert summary["count"] == 3
+    assert summary["mean"] == 22 / 3
+    assert summary["median"] == 7
+    assert summary["histogram"][3] == summary["histogram"][7] == summary["histogram"][10] == 1
+    assert DemandSummary({}) == {"count": 0, "mean": None, "median": None, "stdev": 0.0, "histogram": [0] * 11}
+
+def test_render_sends_levels_in_person_order():
+    placeholder = FakePlaceholder()
+    RenderDemandChart(placeholder, {2: ("丙", 5), 0: ("甲", 8)})
+    person_chart, histogram = placeholder.charts
+    assert [row["人物名"] for row in person_chart["data"]["values"]] == ["甲", "丙"]
+    assert sum(row["人数"] for row in histogram["data"]["values"]) == 2
+    assert placeholder.captions == ["2人 / 平均 6.50 / 中央値 6.5 / 標準偏差 2.12"]
+
+def test_render_without_levels_has_no_caption():
+    placeholder = FakePlaceholder()
+    RenderDemandChart(placeholder, {})
+    assert placeholder.captions == []
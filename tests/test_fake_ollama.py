@@ -0,0 +1,47 @@
+import json
+import urllib.request
+
+from benchmarks.fake_ollama import FakeOllamaServer, FakeSettings
+from dists.GeneratePersona import Character
+
+def test_same_prompt_and_seed_give_the_same_responses():
+    first = FakeOllamaServer(FakeSettings(seed=1))
+    second = FakeOllamaServer(FakeSettings(seed=1))
+    try:
+        responses = [first.respond({"prompt": "質問"}) for _ in range(2)]
+        assert responses == [second.respond({"prompt": "質問"}) for _ in range(2)]
+        assert responses[0] != responses[1]
+    finally:
+        first.stop()
+        second.stop()
+
+def test_schema_output_validates():
+    server = FakeOllamaServer(FakeSettings())
+    try:
+        status, text, _ = server.respond({"prompt": "人物", "format": Character.model_json_schema()})
+        assert status == 200
+        Character.model_validate_json(text)
+    finally:
+        server.stop()
+
+def test_error_rate_returns_server_errors():
+    server = FakeOllamaServer(FakeSettings(error_rate=1.0))
+    try:
+        assert server.respond({"prompt": "質問"})[0] == 500
+        assert server.errors == 1
+    finally:
+        server.stop()
+
+def test_streams_ndjson_over_http():
+    server = FakeOllamaServer(FakeSettings(latency=0, tokens_per_second=0, text_length=20)).start()
+    try:
+        request = urllib.request.Request(
+            f"{server.url}/api/generate", data=json.dumps({"model": "fake", "prompt": "質問"}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            chunks = [json.loads(line) for line in response.read().decode("utf-8").splitlines()]
+        assert chunks[-1]["done"] is True
+        assert len("".join(chunk["response"] for chunk in chunks)) == 20
+    finally:
+        server.stop()
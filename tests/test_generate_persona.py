@@ -0,0 +1,100 @@
+import json
+import threading
+
+import pytest
+
+from dists import GeneratePersona
+from dists.GeneratePersona import Character
+
+class FakeStageModels:
+    def __init__(self):
+        # 2つの分岐が同時に実行されていなければ、待ち合わせがタイムアウトする
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def chain(self, stage, backend, build, enabled=None):
+        models = self
+
+        class Chain:
+            def invoke(self, inputs, config=None):
+                models.barrier.wait()
+                return f"{stage}: {inputs['persona_prefix']}"
+
+        return Chain()
+
+def test_opinion_branches_run_in_parallel(monkeypatch):
+    monkeypatch.setattr(GeneratePersona, "stage_models", FakeStageModels())
+    timings = {}
+    output = GeneratePersona._GenerateOpinionBranches("プロフィール", "local", timings)
+    assert output == {"positive": "肯定的意見の生成: プロフィール", "negative": "否定的意見の生成: プロフィール"}
+    assert timings["overlap"] > 0
+    assert set(timings) == {"positive", "negative", "branches", "overlap"}
+
+def make_character(name):
+    return Character(**{**{field: "項目" for field in Character.model_fields}, "name": name, "age": 30})
+
+class FakeStream:
+    # 人物のJSONをchunksの区切りで返し、読まれたチャンク数と閉じられたかを記録する
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.read = 0
+        self.closed = False
+
+    def stream_text(self, input, config=None):
+        try:
+            for chunk in self.chunks:
+                self.read += 1
+                yield chunk
+        finally:
+            self.closed = True
+
+class FakeItemParser:
+    def __init__(self, **kwargs):
+        pass
+
+    def parse(self, text):
+        return Character.model_validate_json(text)
+
+@pytest.fixture
+def batch_stream(monkeypatch):
+    # GenerateHumanModelsの一括生成の呼び出しと、個別の生成し直しを差し替える
+    state = {"stream": None, "regenerated": [], "avoid": []}
+
+    def regenerate(*args, avoid=None, **kwargs):
+        state["avoid"].append([character.name for character in avoid])
+        return state["regenerated"].pop(0)
+
+    monkeypatch.setattr(GeneratePersona, "GetModel", lambda use_local: None)
+    monkeypatch.setattr(GeneratePersona, "StructuredLLM", lambda model, schema: None)
+    monkeypatch.setattr(GeneratePersona, "CachedChain", lambda *args, **kwargs: None)
+    monkeypatch.setattr(GeneratePersona, "RetryingChain", lambda *args: state["stream"])
+    monkeypatch.setattr(GeneratePersona, "RepairingOutputParser", FakeItemParser)
+    monkeypatch.setattr(GeneratePersona, "GenerateHumanModel", regenerate)
+    return state
+
+def item(name):
+    return json.dumps(make_character(name).model_dump(), ensure_ascii=False)
+
+def test_batch_reads_to_the_end_of_the_array(batch_stream):
+    batch_stream["stream"] = FakeStream(['{"characters": [', item("甲"), ",", item("乙"), "]", "}"])
+    characters = GeneratePersona.GenerateHumanModels("女性", "20", "30", 2, True)
+    # 呼び出し側（_ProduceCharacters）と同じく、count人を受け取ったら読むのをやめる
+    assert [character.name for _, character in zip(range(2), characters)] == ["甲", "乙"]
+    # 最後の人物を返す前に応答の最後まで読むため、応答はキャッシュに保存される
+    assert batch_stream["stream"].read == 6
+
+def test_batch_stops_reading_extra_personas(batch_stream):
+    extra = item("丙")
+    batch_stream["stream"] = FakeStream(['{"characters": [', item("甲"), ",", item("乙"), ",", extra[:10], extra[10:], "]}"])
+    characters = list(GeneratePersona.GenerateHumanModels("女性", "20", "30", 2, True))
+    assert [character.name for character in characters] == ["甲", "乙"]
+    assert batch_stream["stream"].read == 6
+    assert batch_stream["stream"].closed
+
+def test_regenerated_names_are_checked_for_duplicates(batch_stream):
+    # 1人目は形式不正のため「乙」として生成し直す。出力の2人目の「乙」は重複として生成し直す
+    batch_stream["stream"] = FakeStream(['{"characters": [', '{"name": 1}', ",", item("乙")])
+    batch_stream["regenerated"] = [make_character("乙"), make_character("丙"), make_character("丁")]
+    characters = list(GeneratePersona.GenerateHumanModels("女性", "20", "30", 3, True))
+    assert [character.name for character in characters] == ["乙", "丙", "丁"]
+    # 出力が途中で切れた分の生成にも、生成し直した人物を伝える
+    assert batch_stream["avoid"] == [[], ["乙"], ["乙", "丙"]]
@@ -0,0 +1,69 @@
+import threading
+
+from dists.JobQueue import JobQueue
+
+def test_claim_returns_oldest_queued_job(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    assert queue.claim("w1") is None
+    first = queue.submit("1件目", {"count": 1}, 1)
+    second = queue.submit("2件目", {"count": 2}, 2)
+    job = queue.claim("w1")
+    assert job["id"] == first
+    assert job["status"] == "running"
+    assert job["worker"] == "w1"
+    assert job["attempts"] == 1
+    assert job["params"] == {"count": 1}
+    assert queue.claim("w2")["id"] == second
+    assert queue.claim("w3") is None
+
+def test_each_job_is_claimed_once_across_workers(tmp_path):
+    # ワーカープロセスと同じく、接続を別々に持つ複数のJobQueueから同時に取り出す
+    path = str(tmp_path / "jobs.sqlite3")
+    submitted = {JobQueue(path).submit(f"{index}件目", {}, 1) for index in range(20)}
+    claimed = []
+    lock = threading.Lock()
+
+    def work(name):
+        queue = JobQueue(path)
+        while True:
+            job = queue.claim(name)
+            if job is None:
+                return
+            with lock:
+                claimed.append(job["id"])
+
+    threads = [threading.Thread(target=work, args=(f"w{index}",)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == sorted(submitted)
+
+def test_stale_running_job_is_claimed_again(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), stale_seconds=-1)
+    job_id = queue.submit("停止したジョブ", {}, 1)
+    queue.claim("w1")
+    queue.add_record(job_id, {"type": "persona", "index": 0}, done=1)
+    job = queue.claim("w2")
+    assert job["id"] == job_id
+    assert job["worker"] == "w2"
+    assert job["attempts"] == 2
+    assert job["done"] == 1
+    assert [record for _, record in queue.records(job_id)] == [{"type": "persona", "index": 0}]
+
+def test_live_running_job_is_not_claimed_again(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), stale_seconds=300)
+    queue.submit("実行中のジョブ", {}, 1)
+    queue.claim("w1")
+    assert queue.claim("w2") is None
+
+def test_cancelled_jobs_are_not_claimed(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    queued = queue.submit("待機中", {}, 1)
+    running = queue.submit("実行中", {}, 1)
+    queue.cancel(queued)
+    assert queue.get(queued)["status"] == "cancelled"
+    assert queue.claim("w1")["id"] == running
+    queue.cancel(running)
+    assert queue.heartbeat(running) is True
+    assert queue.get(running)["status"] == "running"
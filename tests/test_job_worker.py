@@ -0,0 +1,41 @@
+import csv
+import os
+
+from dists import JobWorker, ResponseCache
+from dists.GeneratePersona import Character, Opinion
+from dists.JobQueue import JobQueue
+from dists.PersonaPipeline import PersonaResult
+
+def make_character(index):
+    return Character(**{**{name: f"項目{index}" for name in Character.model_fields}, "name": f"人物{index}", "age": 30})
+
+def test_run_job_passes_cache_mode_per_job_and_exports_in_order(tmp_path, monkeypatch):
+    calls = []
+
+    def pipelines(total, *args, indices=None, cache_mode=None, **kwargs):
+        calls.append(cache_mode)
+        # 完了順は番号順と異なる
+        for index in reversed(indices):
+            if index == 1:
+                yield PersonaResult(index=index, error="失敗")
+                continue
+            yield PersonaResult(index=index, character=make_character(index), comment=f"コメント{index}", opinion=Opinion(want_level=index, reason="理由"))
+
+    monkeypatch.setattr(JobWorker, "EXPORT_DIR", str(tmp_path / "exports"))
+    monkeypatch.setattr(JobWorker, "RunPersonaPipelines", pipelines)
+    monkeypatch.setattr(JobWorker, "SuggestBusinessPlan", lambda service_req, comments, use_local, cache_mode=None, cascade=None: calls.append(cache_mode) or "改良案")
+
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    params = {
+        "use_local": True, "service_title": "サービス", "service_req": "要件", "gender": "女性",
+        "age_range_start": "20", "age_range_end": "30", "cache_mode": "replay",
+    }
+    queue.submit("ジョブ", params, 3)
+    job = queue.claim("w1")
+    JobWorker.RunJob(queue, job)
+
+    assert calls == ["replay", "replay"]
+    assert ResponseCache.response_cache.mode != "replay"
+    assert queue.get(job["id"])["status"] == "done"
+    with open(os.path.join(JobWorker.JobExportDirectory(job["id"]), "persona_data.csv"), encoding="utf-8-sig", newline="") as f:
+        assert [row[0] for row in list(csv.reader(f))[1:]] == ["人物0", "人物2"]
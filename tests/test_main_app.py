@@ -0,0 +1,49 @@
+import os
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+from dists import PersonaPipeline, PlanRevisons, ResultExport
+from dists.GeneratePersona import Character, Opinion
+from dists.PersonaPipeline import PersonaResult
+from dists.ResponseCache import CacheMissError
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+def make_character():
+    return Character(**{**{field: "項目" for field in Character.model_fields}, "age": 30})
+
+@pytest.fixture
+def exports(tmp_path, monkeypatch):
+    monkeypatch.setattr(ResultExport, "EXPORT_DIR", str(tmp_path / "exports"))
+    return tmp_path / "exports"
+
+@pytest.fixture
+def app(exports, monkeypatch):
+
+    def pipelines(number_of_people, *args, **kwargs):
+        for index in range(number_of_people):
+            yield PersonaResult(index=index, character=make_character(), comment="コメント", comment_timings={"synthesize": 1.0}, opinion=Opinion(want_level=5, reason="理由"))
+
+    monkeypatch.setattr(PersonaPipeline, "RunPersonaPipelines", pipelines)
+    return AppTest.from_file(MAIN, default_timeout=30)
+
+def test_downloads_are_shown_when_plan_revision_fails(app, monkeypatch):
+    def failing_plan(*args, **kwargs):
+        raise CacheMissError("キャッシュにありません")
+        yield
+
+    monkeypatch.setattr(PlanRevisons, "SuggestBusinessPlanStream", failing_plan)
+    app.run()
+    app.button[0].click().run()
+    assert [error.value for error in app.error] == ["キャッシュにありません"]
+    labels = [button.proto.label for button in app.get("download_button")]
+    assert labels == ["CSVファイルのダウンロード", "Parquetファイルのダウンロード", "集計（JSON）のダウンロード"]
+
+def test_session_reuses_one_export_directory(app, exports, monkeypatch):
+    monkeypatch.setattr(PlanRevisons, "SuggestBusinessPlanStream", lambda *args, **kwargs: iter(["改良案"]))
+    app.run()
+    app.button[0].click().run()
+    app.button[0].click().run()
+    assert not app.exception
+    assert len(list(exports.iterdir())) == 1
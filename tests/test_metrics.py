@@ -0,0 +1,51 @@
+import re
+
+from dists.Metrics import CallRecord, RunMetrics
+
+def make_record(stage="意見の統合", backend="local", latency=1.0, attempts=1, error=None):
+    record = CallRecord(stage, backend)
+    record.latency = latency
+    record.attempts = attempts
+    record.llm_calls = attempts
+    record.prompt_tokens = 10
+    record.completion_tokens = 5
+    record.error = error
+    return record
+
+def read_counter(path, name):
+    match = re.search(rf"^{name}\{{[^}}]*\}} (\S+)$", path.read_text(encoding="utf-8"), re.M)
+    return float(match.group(1))
+
+def test_summary_aggregates_by_stage_and_backend():
+    metrics = RunMetrics()
+    metrics.add(make_record(latency=1.0))
+    metrics.add(make_record(latency=3.0, attempts=3, error="失敗"))
+    metrics.add(make_record(backend="gemini"))
+
+    rows = {(row["stage"], row["backend"]): row for row in metrics.summary()}
+    local = rows[("意見の統合", "local")]
+    assert local["calls"] == 2
+    assert local["errors"] == 1
+    assert local["retries"] == 2
+    assert rows[("意見の統合", "gemini")]["calls"] == 1
+
+def test_counters_stay_monotonic_when_records_are_trimmed(tmp_path):
+    metrics = RunMetrics(max_records=2)
+    path = tmp_path / "metrics.prom"
+    previous = 0.0
+    for count in range(1, 6):
+        metrics.add(make_record())
+        metrics.write_prometheus(str(path))
+        calls = read_counter(path, "persona_llm_stage_calls_total")
+        assert calls == count
+        assert calls > previous
+        previous = calls
+    assert len(metrics.records()) == 2
+    assert read_counter(path, "persona_llm_stage_prompt_tokens_total") == 50
+
+def test_reset_clears_records_and_totals():
+    metrics = RunMetrics()
+    metrics.add(make_record())
+    metrics.reset()
+    assert metrics.records() == []
+    assert metrics.totals() == []
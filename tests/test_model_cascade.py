@@ -0,0 +1,41 @@
+from dists.ModelCascade import CascadeChain, CascadeStats, StageModels
+
+class FakeChain:
+    def __init__(self, output=None, error=None):
+        self.output = output
+        self.error = error
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+    def stream_text(self, input, config=None):
+        yield self.invoke(input, config)
+
+def test_tier_uses_run_setting_over_global():
+    models = StageModels(enabled=False)
+    assert models.tier("意見の要約", "local") == "large"
+    assert models.tier("意見の要約", "local", enabled=True) == "cascade"
+    assert models.tier("意見の要約", "gemini", enabled=True) == "large"
+    assert models.tier("人物の生成", "local", enabled=True) == "large"
+    assert models.enabled is False
+
+def test_cascade_accepts_long_enough_small_output():
+    stats = CascadeStats()
+    small = FakeChain("十分な長さの要約" * 30)
+    large = FakeChain("大きいモデル")
+    assert CascadeChain(small, large, "意見の要約", stats).invoke({}) == small.output
+    assert large.calls == 0
+    assert stats.snapshot()[0]["accepted"] == 1
+
+def test_cascade_escalates_on_error_and_short_output():
+    stats = CascadeStats()
+    large = FakeChain("大きいモデル")
+    assert CascadeChain(FakeChain(error=ValueError("形式不正")), large, "意見の要約", stats).invoke({}) == "大きいモデル"
+    assert "".join(CascadeChain(FakeChain("短い"), large, "意見の要約", stats).stream_text({})) == "大きいモデル"
+    row = stats.snapshot()[0]
+    assert row["escalated"] == 2
+    assert row["reasons"] == {"error": 1, "short": 1}
@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+import threading
+
+from dists.ModelRegistry import ModelRegistry
+
+def test_model_is_created_once_on_first_use():
+    created = []
+    registry = ModelRegistry({"local": lambda: created.append(object()) or created[-1]})
+    assert registry.loaded("local") is None
+    assert created == []
+
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(registry.get("local"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+    assert all(model is created[0] for model in models)
+
+def test_reset_recreates_model():
+    registry = ModelRegistry({"local": object})
+    first = registry.get("local")
+    registry.reset("local")
+    assert registry.get("local") is not first
+
+def test_import_does_not_load_model_clients():
+    code = "import sys, dists.ModelRegistry; print(sorted(name for name in ('google.generativeai', 'langchain_google_genai', 'langchain_ollama') if name in sys.modules))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=root).stdout
+    assert output.strip() == "[]"
@@ -0,0 +1,48 @@
+from dists import PanelRefinement
+from dists.GeneratePersona import Character, Opinion
+from dists.PanelRefinement import EvaluatePanel, RevisePlan, StageMemo
+from dists.PersonaPipeline import PersonaResult
+
+def make_character(index):
+    return Character(**{**{name: f"項目{index}" for name in Character.model_fields}, "age": 30})
+
+PANEL = {0: make_character(0), 1: make_character(1)}
+
+class FakePipelines:
+    # 評価した番号と、受け取ったキャッシュのモードを記録する
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, number_of_people, service_title, service_req, gender, age_range_start, age_range_end, use_local, indices=None, characters=None, cache_mode=None, **kwargs):
+        self.calls.append((list(indices), cache_mode))
+        for index in indices:
+            yield PersonaResult(index=index, character=characters[index], comment=f"{service_req}へのコメント{index}", opinion=Opinion(want_level=5, reason="理由"))
+
+def test_unchanged_panel_is_served_from_memo(monkeypatch):
+    pipelines = FakePipelines()
+    monkeypatch.setattr(PanelRefinement, "RunPersonaPipelines", pipelines)
+    memo = StageMemo()
+    first = list(EvaluatePanel(PANEL, "サービス", "要件", True, memo=memo, cache_mode="off"))
+    second = list(EvaluatePanel(PANEL, "サービス", "要件", True, memo=memo))
+    assert pipelines.calls == [([0, 1], "off")]
+    assert sorted(result.comment for result in second) == sorted(result.comment for result in first)
+
+    list(EvaluatePanel(PANEL, "サービス", "改良した要件", True, memo=memo))
+    assert pipelines.calls[-1] == ([0, 1], None)
+
+def test_memo_is_keyed_by_backend(monkeypatch):
+    pipelines = FakePipelines()
+    monkeypatch.setattr(PanelRefinement, "RunPersonaPipelines", pipelines)
+    memo = StageMemo()
+    list(EvaluatePanel(PANEL, "サービス", "要件", True, memo=memo))
+    list(EvaluatePanel(PANEL, "サービス", "要件", False, memo=memo))
+    assert len(pipelines.calls) == 2
+
+def test_revise_plan_runs_once_per_input_and_backend(monkeypatch):
+    calls = []
+    monkeypatch.setattr(PanelRefinement, "SuggestBusinessPlan", lambda service_req, comments, use_local, cache_mode=None, cascade=None: calls.append(use_local) or f"{service_req}の改良案")
+    memo = StageMemo()
+    assert RevisePlan("要件", ["意見"], True, memo=memo) == "要件の改良案"
+    assert RevisePlan("要件", ["意見"], True, memo=memo) == "要件の改良案"
+    RevisePlan("要件", ["意見"], False, memo=memo)
+    assert calls == [True, False]
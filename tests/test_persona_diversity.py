@@ -0,0 +1,72 @@
+import pytest
+
+from dists import PersonaDiversity
+from dists.GeneratePersona import Character
+from dists.PersonaDiversity import PersonaIndex, Profile, ProfileSimilarity
+
+def make_character(name, seed):
+    # seedごとに全項目の内容が異なる人物を作る
+    values = {field: f"{field}の説明{seed}{seed}{seed}です" for field in Character.model_fields}
+    values.update(name=name, age=30, sex="女性", job=f"職業{seed * 7}番の仕事", family_structure=f"家族{seed * 3}人暮らし")
+    return Character.model_validate(values)
+
+@pytest.fixture(autouse=True)
+def retries(monkeypatch):
+    monkeypatch.setattr(PersonaDiversity, "DUPLICATE_RETRIES", 2)
+
+def test_similarity_ignores_name():
+    a = make_character("佐藤 花子", 1)
+    b = make_character("鈴木 一郎", 1)
+    assert ProfileSimilarity(Profile(a), Profile(b)) == 1.0
+    assert ProfileSimilarity(Profile(a), Profile(make_character("佐藤 花子", 2))) < 0.6
+
+def test_add_if_novel_rejects_near_duplicates():
+    index = PersonaIndex(threshold=0.6)
+    assert index.add_if_novel(0, make_character("a", 1)) is None
+    similar_key, similarity = index.add_if_novel(1, make_character("b", 1))
+    assert similar_key == 0
+    assert similarity >= 0.6
+    assert index.add_if_novel(2, make_character("c", 2)) is None
+    assert index.character(1) is None
+
+def test_novel_regenerates_until_different():
+    index = PersonaIndex(threshold=0.6)
+    index.add(0, make_character("a", 1))
+    calls = []
+
+    def regenerate(attempt, similar):
+        calls.append((attempt, similar.name))
+        return make_character("c", 2)
+
+    character, duplicate_of = index.novel(1, make_character("b", 1), regenerate)
+    assert character.name == "c"
+    assert duplicate_of is None
+    assert calls == [(0, "a")]
+    assert index.regenerated == 1
+    assert index.rejected == 0
+
+def test_novel_rejects_after_retries():
+    index = PersonaIndex(threshold=0.6)
+    index.add(0, make_character("a", 1))
+    character, duplicate_of = index.novel(1, make_character("b", 1), lambda attempt, similar: make_character(f"b{attempt}", 1))
+    assert character is None
+    assert duplicate_of == 0
+    assert index.regenerated == 2
+    assert index.rejected == 1
+
+def test_novel_stops_when_regeneration_fails():
+    index = PersonaIndex(threshold=0.6)
+    index.add(0, make_character("a", 1))
+    assert index.novel(1, make_character("b", 1), lambda attempt, similar: None) == (None, None)
+
+def test_diversity_reports_closest_pair():
+    index = PersonaIndex()
+    assert index.diversity()["diversity"] is None
+    index.add(0, make_character("a", 1))
+    index.add(1, make_character("b", 2))
+    index.add(2, make_character("c", 1))
+    diversity = index.diversity()
+    assert diversity["count"] == 3
+    assert diversity["closest_pair"] == (0, 2)
+    assert diversity["closest_similarity"] == 1.0
+    assert 0.0 < diversity["diversity"] < 1.0
@@ -0,0 +1,38 @@
+from dists.GeneratePersona import Character
+from dists.PersonaLibrary import ANY_GENDER, PersonaLibrary
+
+def make_character(name, age):
+    return Character(**{**{field: "項目" for field in Character.model_fields}, "name": name, "age": age})
+
+def make_library(tmp_path, **kwargs):
+    return PersonaLibrary(str(tmp_path / "personas.sqlite3"), **kwargs)
+
+def test_same_character_is_saved_once(tmp_path):
+    library = make_library(tmp_path)
+    assert library.add(make_character("佐藤", 25), "女性")
+    assert not library.add(make_character("佐藤", 25), "女性")
+    assert library.stats()["personas"] == 1
+
+def test_filters_by_gender_and_age_bucket(tmp_path):
+    library = make_library(tmp_path)
+    library.add(make_character("佐藤", 25), "女性")
+    library.add(make_character("鈴木", 29), "男性")
+    library.add(make_character("高橋", 45), "女性")
+    assert library.count("女性", 20, 30) == 1
+    assert library.count(ANY_GENDER, 20, 30) == 2
+    assert [character.name for _, character in library.sample("女性", 40, 40, 5)] == ["高橋"]
+
+def test_sample_prefers_least_used_and_skips_excluded(tmp_path):
+    library = make_library(tmp_path)
+    for name in ("佐藤", "鈴木", "高橋"):
+        library.add(make_character(name, 30), "女性")
+    first = library.sample("女性", 30, 30, 2)
+    second = library.sample("女性", 30, 30, 1)
+    assert second[0][0] not in {persona_id for persona_id, _ in first}
+    assert library.sample("女性", 30, 30, 3, exclude=[persona_id for persona_id, _ in first + second]) == []
+    assert library.stats()["reuses"] == 3
+
+def test_does_not_save_when_disabled(tmp_path):
+    library = make_library(tmp_path, save=False)
+    assert not library.add(make_character("佐藤", 25), "女性")
+    assert library.count(ANY_GENDER, 0, 100) == 0
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from dists import PersonaPipeline, ResponseCache
+from dists.GeneratePersona import Character, OpinionSummerizer
+from dists.PersonaPipeline import EvaluateCharacter, PersonaResult
+from dists.ResponseCache import CacheMissError
+
+def make_character():
+    return Character(**{**{name: "項目" for name in Character.model_fields}, "age": 30})
+
+@pytest.fixture
+def empty_cache(tmp_path, monkeypatch):
+    cache = ResponseCache.ResponseCache(str(tmp_path / "responses.sqlite3"))
+    monkeypatch.setattr(ResponseCache, "response_cache", cache)
+    return cache
+
+def test_opinion_summerizer_raises_cache_miss_in_replay(empty_cache):
+    with pytest.raises(CacheMissError):
+        OpinionSummerizer("サービス", make_character(), "感想", True, service_data="要件", cache_mode="replay")
+
+def test_evaluate_character_reports_cache_miss_from_opinion_stage(monkeypatch):
+    def missing(*args, **kwargs):
+        raise CacheMissError("キャッシュにありません")
+
+    monkeypatch.setattr(PersonaPipeline, "GenerateComment", lambda *args, **kwargs: "コメント")
+    monkeypatch.setattr(PersonaPipeline, "OpinionSummerizer", missing)
+    result = EvaluateCharacter(0, make_character(), "サービス", "要件", True)
+    assert result.error == "キャッシュにありません"
+    assert result.comment == "コメント"
+    assert result.opinion is None
+
+def test_library_characters_skip_generation(monkeypatch):
+    evaluated = []
+    monkeypatch.setattr(PersonaPipeline, "EvaluateCharacter", lambda index, character, *args: evaluated.append(index) or PersonaResult(index=index, character=character))
+    monkeypatch.setattr(PersonaPipeline, "RunPersonaPipeline", lambda index, *args: PersonaResult(index=index, error="生成しました"))
+    results = list(PersonaPipeline.RunPersonaPipelines(
+        3, "サービス", "要件", "女性", "20", "30", True, stop_on_error=False, characters={0: make_character(), 2: make_character()}
+    ))
+    assert sorted(evaluated) == [0, 2]
+    assert {result.index: result.error for result in results} == {0: None, 1: "生成しました", 2: None}
+
+def test_pipelines_run_concurrently_up_to_max_workers(monkeypatch):
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def pipeline(index, *args):
+        with lock:
+            active.append(index)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(index)
+        return PersonaResult(index=index)
+
+    monkeypatch.setattr(PersonaPipeline, "RunPersonaPipeline", pipeline)
+    results = list(PersonaPipeline.RunPersonaPipelines(6, "サービス", "要件", "女性", "20", "30", True, max_workers=3))
+    assert sorted(result.index for result in results) == list(range(6))
+    assert max(peak) == 3
+
+def test_pipelines_stop_submitting_after_error(monkeypatch):
+    def pipeline(index, *args):
+        return PersonaResult(index=index, error="失敗しました" if index == 1 else None)
+
+    monkeypatch.setattr(PersonaPipeline, "RunPersonaPipeline", pipeline)
+    results = list(PersonaPipeline.RunPersonaPipelines(5, "サービス", "要件", "女性", "20", "30", True, max_workers=1))
+    assert [result.index for result in results] == [0, 1]
@@ -0,0 +1,19 @@
+from dists.PlanRevisons import _ChunkByBudget
+
+def test_short_texts_fit_in_one_chunk():
+    assert _ChunkByBudget(["あ" * 10, "い" * 10], 100) == [["あ" * 10, "い" * 10]]
+
+def test_chunks_stay_within_budget_and_keep_order():
+    texts = [str(index) * 30 for index in range(10)]
+    chunks = _ChunkByBudget(texts, 100)
+    assert [text for chunk in chunks for text in chunk] == texts
+    assert all(sum(len(text) for text in chunk) <= 100 for chunk in chunks)
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+
+def test_oversized_texts_are_still_paired():
+    # 1件でbudgetを超える場合も2件ずつまとめ、要約の段ごとに数が減るようにする
+    texts = ["あ" * 500] * 5
+    assert [len(chunk) for chunk in _ChunkByBudget(texts, 100)] == [2, 2, 1]
+
+def test_empty_input():
+    assert _ChunkByBudget([], 100) == []
@@ -0,0 +1,94 @@
+import httpx
+import pytest
+
+from dists import RateLimiter
+from dists.RateLimiter import IsRateLimitError, TokenBucketRateLimiter
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+class FakeClock:
+    # time.sleepで進む時計（実際には待たない）
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(RateLimiter, "time", clock)
+    return clock
+
+def test_acquire_within_capacity_does_not_wait(clock):
+    limiter = TokenBucketRateLimiter(requests_per_minute=3, tokens_per_minute=1000)
+    for _ in range(3):
+        assert limiter.acquire(10) == 0.0
+    assert clock.slept == 0.0
+
+def test_acquire_waits_for_request_bucket_refill(clock):
+    limiter = TokenBucketRateLimiter(requests_per_minute=60, tokens_per_minute=100000)
+    for _ in range(60):
+        limiter.acquire()
+    assert limiter.acquire() == pytest.approx(1.0)
+    assert limiter.status()["total_wait"] == pytest.approx(1.0)
+
+def test_acquire_waits_for_token_bucket_refill(clock):
+    limiter = TokenBucketRateLimiter(requests_per_minute=100, tokens_per_minute=600)
+    limiter.acquire(500)
+    # 残り100トークンに対して200トークン必要。毎秒10トークン補充されるため10秒待つ
+    assert limiter.acquire(200) == pytest.approx(10.0)
+
+def test_request_larger_than_bucket_passes_once_full(clock):
+    limiter = TokenBucketRateLimiter(requests_per_minute=100, tokens_per_minute=600)
+    assert limiter.acquire(5000) == 0.0
+    # 使った分は差し引かれるため、次は不足分（600 + 4400トークン）が補充されるまで待つ
+    assert limiter.acquire(5000) == pytest.approx(500.0)
+
+def test_recorded_response_tokens_delay_next_request(clock):
+    limiter = TokenBucketRateLimiter(requests_per_minute=100, tokens_per_minute=600)
+    limiter.acquire(100)
+    limiter.record_tokens(600)
+    assert limiter.acquire(100) == pytest.approx(20.0)
+
+def test_rate_limited_blocks_halves_rate_and_doubles_backoff(clock):
+    limiter = TokenBucketRateLimiter(requests_per_minute=600, tokens_per_minute=100000, initial_backoff=5.0, max_backoff=8.0)
+    limiter.report_rate_limited()
+    status = limiter.status()
+    assert status["rate_scale"] == 0.5
+    assert status["rate_limited_count"] == 1
+    assert limiter.acquire() == pytest.approx(5.0)
+    # 2回目は待機時間が倍になるが、max_backoffで頭打ちになる
+    limiter.report_rate_limited()
+    assert limiter.status()["rate_scale"] == 0.25
+    assert limiter.acquire() == pytest.approx(8.0)
+
+def test_rate_scale_has_a_floor_and_recovers_on_success(clock):
+    limiter = TokenBucketRateLimiter(requests_per_minute=60, tokens_per_minute=1000, min_rate_scale=0.1)
+    for _ in range(10):
+        limiter.report_rate_limited()
+    assert limiter.status()["rate_scale"] == 0.1
+    for _ in range(20):
+        limiter.report_success()
+    assert limiter.status()["rate_scale"] == 1.0
+
+@pytest.mark.parametrize("error, expected", [
+    (type("ResourceExhausted", (Exception,), {})("limit"), True),
+    (StatusError(429), True),
+    (httpx.HTTPStatusError("too many", request=httpx.Request("POST", "http://ollama"), response=httpx.Response(429)), True),
+    (StatusError(500), False),
+    # メッセージに「429」や「quota」を含んでいても、型とステータスが該当しなければレート制限ではない
+    (ValueError("年収は429万円です"), False),
+    (Exception("quota exceeded"), False),
+    (ConnectionError("connection refused"), False),
+])
+def test_is_rate_limit_error(error, expected):
+    assert IsRateLimitError(error) is expected
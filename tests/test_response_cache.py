@@ -0,0 +1,98 @@
+import pytest
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from dists import ResponseCache as ResponseCacheModule
+from dists.ResponseCache import CachedChain, CacheMissError, ResponseCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+class FakeModel:
+    # 呼び出された回数を数え、回数入りの応答を返すモデル
+    def __init__(self, model="fake", temperature=1):
+        self.model = model
+        self.temperature = temperature
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        return f"応答{self.calls}"
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ResponseCacheModule, "time", clock)
+    return clock
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return ResponseCache(str(tmp_path / "responses.sqlite3"), max_entries=2, max_age_days=1)
+
+PROMPT = ChatPromptTemplate.from_template("{text}について答えてください")
+
+def test_key_covers_model_prompt_parser_and_slot():
+    parser = StrOutputParser()
+    key = ResponseCache.make_key(FakeModel(), "質問", parser)
+    assert key == ResponseCache.make_key(FakeModel(), "質問", parser)
+    assert key != ResponseCache.make_key(FakeModel(model="other"), "質問", parser)
+    assert key != ResponseCache.make_key(FakeModel(temperature=0), "質問", parser)
+    assert key != ResponseCache.make_key(FakeModel(), "別の質問", parser)
+    assert key != ResponseCache.make_key(FakeModel(), "質問", parser, cache_slot=1)
+
+def test_evicts_least_recently_used_entry(cache, clock):
+    model = FakeModel()
+    cache.put("a", model, "A")
+    clock.now += 1
+    cache.put("b", model, "B")
+    clock.now += 1
+    assert cache.get("a") == "A"
+    clock.now += 1
+    cache.put("c", model, "C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert cache.stats()["entries"] == 2
+
+def test_expired_entries_are_not_returned(cache, clock):
+    cache.put("a", FakeModel(), "A")
+    clock.now += 2 * 86400
+    assert cache.get("a") is None
+
+def test_chain_serves_repeated_prompt_from_cache(cache):
+    model = FakeModel()
+    chain = CachedChain(PROMPT, model, StrOutputParser(), cache=cache)
+    assert chain.invoke({"text": "猫"}) == "応答1"
+    assert chain.invoke({"text": "猫"}) == "応答1"
+    assert model.calls == 1
+    assert cache.stats()["hits"] == 1
+
+def test_chain_mode_overrides_cache_mode(cache):
+    model = FakeModel()
+    CachedChain(PROMPT, model, StrOutputParser(), cache=cache, mode="off").invoke({"text": "猫"})
+    assert cache.stats()["entries"] == 0
+
+    with pytest.raises(CacheMissError):
+        CachedChain(PROMPT, model, StrOutputParser(), cache=cache, mode="replay").invoke({"text": "猫"})
+    assert model.calls == 1
+    assert cache.mode == "on"
+
+def test_chain_rejects_unknown_mode(cache):
+    with pytest.raises(ValueError):
+        CachedChain(PROMPT, FakeModel(), StrOutputParser(), cache=cache, mode="sometimes")
+
+def test_sampling_chain_only_reuses_responses_in_replay(cache):
+    model = FakeModel()
+    chain = CachedChain(PROMPT, model, StrOutputParser(), cache=cache, cache_slot=0, sampling=True)
+    # onモードでは再実行のたびに新しく生成し、最後の応答を保存する
+    assert chain.invoke({"text": "人物"}) == "応答1"
+    assert chain.invoke({"text": "人物"}) == "応答2"
+    assert model.calls == 2
+    replay = CachedChain(PROMPT, model, StrOutputParser(), cache=cache, cache_slot=0, mode="replay", sampling=True)
+    assert replay.invoke({"text": "人物"}) == "応答2"
+    assert model.calls == 2
@@ -0,0 +1,83 @@
+import csv
+import os
+import time
+
+import pyarrow.parquet as pq
+
+from dists.GeneratePersona import Character, Opinion
+from dists import ResultExport
+from dists.ResultExport import CSV_HEADERS, EXPORT_FIELDS, NewExportDirectory, PruneExportDirectories, StreamingExporter
+
+def make_character(index):
+    return Character(**{**{name: f"項目{index}" for name in Character.model_fields}, "name": f"人物{index}", "age": 20 + index})
+
+def add(exporter, index):
+    exporter.add(index, make_character(index), f"コメント{index}", Opinion(want_level=index, reason="理由"))
+
+def read_csv(path):
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        return list(csv.reader(f))
+
+def test_rows_are_written_in_index_order(tmp_path):
+    exporter = StreamingExporter(str(tmp_path), formats=("csv",))
+    add(exporter, 2)
+    add(exporter, 0)
+    assert exporter.rows == 1
+    exporter.skip(1)
+    assert exporter.rows == 2
+    add(exporter, 3)
+    exporter.close()
+
+    rows = read_csv(exporter.paths["csv"])
+    assert rows[0] == [CSV_HEADERS[name] for name in EXPORT_FIELDS]
+    assert [row[0] for row in rows[1:]] == ["人物0", "人物2", "人物3"]
+
+def test_close_writes_rows_still_waiting_for_earlier_indices(tmp_path):
+    with StreamingExporter(str(tmp_path), formats=("csv",)) as exporter:
+        add(exporter, 3)
+        add(exporter, 1)
+    assert [row[0] for row in read_csv(exporter.paths["csv"])[1:]] == ["人物1", "人物3"]
+
+def test_resume_appends_in_expected_order_and_rebuilds_parquet(tmp_path):
+    with StreamingExporter(str(tmp_path), stem="job") as exporter:
+        add(exporter, 0)
+        exporter.skip(1)
+        add(exporter, 2)
+
+    with StreamingExporter(str(tmp_path), stem="job", append=True) as exporter:
+        exporter.expect([1, 3])
+        add(exporter, 3)
+        add(exporter, 1)
+
+    rows = read_csv(tmp_path / "job.csv")
+    assert [row[0] for row in rows[1:]] == ["人物0", "人物2", "人物1", "人物3"]
+    table = pq.read_table(tmp_path / "job.parquet")
+    assert table.column("name").to_pylist() == ["人物0", "人物2", "人物1", "人物3"]
+    assert table.column("age").to_pylist() == [20, 22, 21, 23]
+    assert list(tmp_path.glob("*.parquet")) == [tmp_path / "job.parquet"]
+
+def test_parquet_only_removes_intermediate_rows(tmp_path):
+    with StreamingExporter(str(tmp_path), formats=("parquet",)) as exporter:
+        add(exporter, 0)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["persona_data.parquet"]
+    assert pq.read_table(exporter.paths["parquet"]).num_rows == 1
+
+def test_prune_removes_only_old_run_directories(tmp_path, monkeypatch):
+    monkeypatch.setattr(ResultExport, "EXPORT_DIR", str(tmp_path))
+    old = tmp_path / "20240101-000000-abcdef"
+    recent = tmp_path / "20240101-000000-123456"
+    for directory in (old, recent, tmp_path / "jobs", tmp_path / "keep"):
+        directory.mkdir()
+        (directory / "persona_data.csv").write_text("名前\n", encoding="utf-8")
+    ten_days_ago = time.time() - 10 * 86400
+    for path in (old, old / "persona_data.csv", tmp_path / "jobs", tmp_path / "keep"):
+        os.utime(path, (ten_days_ago, ten_days_ago))
+    # ディレクトリが古くても、中のファイルを最近上書きしていれば残す
+    os.utime(recent, (ten_days_ago, ten_days_ago))
+
+    assert PruneExportDirectories(max_age_days=7) == [str(old)]
+    assert sorted(os.listdir(tmp_path)) == ["20240101-000000-123456", "jobs", "keep"]
+
+    new = NewExportDirectory()
+    assert os.path.dirname(new) == str(tmp_path)
+    assert ResultExport.RUN_DIRECTORY_PATTERN.fullmatch(os.path.basename(new))
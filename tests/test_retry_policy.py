@@ -0,0 +1,135 @@
+import httpx
+import pytest
+from google.api_core import exceptions as google_exceptions
+from langchain_core.exceptions import OutputParserException
+
+from dists import RetryPolicy
+from dists.ResponseCache import CacheMissError
+from dists.RetryPolicy import FATAL, PARSE, RATE_LIMIT, TRANSIENT, BackendUnavailableError, CallWithRetry, CircuitBreaker, ClassifyError
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+@pytest.mark.parametrize("error, kind", [
+    (CacheMissError("miss"), FATAL),
+    (BackendUnavailableError("open"), FATAL),
+    (google_exceptions.ResourceExhausted("quota"), RATE_LIMIT),
+    (StatusError(429), RATE_LIMIT),
+    (OutputParserException("bad json"), PARSE),
+    # 出力に「429」を含む形式不正はレート制限として扱わない
+    (OutputParserException('{"salary": "429万円"'), PARSE),
+    (Exception("429 Too Many Requests"), TRANSIENT),
+    (google_exceptions.PermissionDenied("denied"), FATAL),
+    (google_exceptions.ServiceUnavailable("down"), TRANSIENT),
+    (httpx.ConnectError("refused"), TRANSIENT),
+    (TimeoutError(), TRANSIENT),
+    (StatusError(503), TRANSIENT),
+    (StatusError(404), FATAL),
+    (ValueError("bad argument"), FATAL),
+    (RuntimeError("unknown"), TRANSIENT),
+])
+def test_classify_error(error, kind):
+    assert ClassifyError(error) == kind
+
+def test_policy_delays():
+    policy = RetryPolicy.RetryPolicy(base_delay=1.0, max_delay=10.0)
+    assert policy.delay(PARSE, 3) == 0.0
+    assert all(0.0 <= policy.delay(TRANSIENT, 2) <= 4.0 for _ in range(100))
+    assert all(0.0 <= policy.delay(RATE_LIMIT, 5) <= 10.0 for _ in range(100))
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker("テスト", failure_threshold=2, reset_timeout=60.0)
+    monkeypatch.setitem(RetryPolicy.circuit_breakers, "local", breaker)
+    monkeypatch.setattr(RetryPolicy.time, "sleep", lambda seconds: None)
+    return breaker
+
+def failing(errors, result="ok"):
+    # errorsを順に送出し、尽きたらresultを返す
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return func, calls
+
+def test_call_with_retry_retries_until_success(breaker):
+    func, calls = failing([OutputParserException("bad"), OutputParserException("bad")])
+    assert CallWithRetry(func, "local", "テスト", RetryPolicy.RetryPolicy(base_delay=0.0)) == "ok"
+    assert len(calls) == 3
+
+def test_call_with_retry_stops_at_max_attempts_per_kind(breaker):
+    policy = RetryPolicy.RetryPolicy(max_attempts={TRANSIENT: 3, RATE_LIMIT: 6, PARSE: 2, FATAL: 1}, base_delay=0.0)
+    func, calls = failing([OutputParserException("bad")] * 5)
+    with pytest.raises(OutputParserException):
+        CallWithRetry(func, "local", "テスト", policy)
+    assert len(calls) == 2
+
+def test_call_with_retry_does_not_retry_fatal_errors(breaker):
+    func, calls = failing([CacheMissError("miss")])
+    with pytest.raises(CacheMissError):
+        CallWithRetry(func, "local", "テスト", RetryPolicy.RetryPolicy(base_delay=0.0))
+    assert len(calls) == 1
+
+def test_call_with_retry_gives_up_when_retry_budget_is_spent(breaker):
+    func, calls = failing([StatusError(429)] * 5)
+    with pytest.raises(StatusError):
+        CallWithRetry(func, "local", "テスト", RetryPolicy.RetryPolicy(base_delay=100.0, max_delay=100.0, retry_budget=0.0))
+    assert len(calls) == 1
+
+def test_retry_budget_counts_time_spent_in_calls(breaker, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(RetryPolicy.time, "monotonic", lambda: now[0])
+    calls = []
+
+    def slow_failure():
+        # 1回の呼び出しに40秒かかって失敗する
+        calls.append(None)
+        now[0] += 40.0
+        raise OutputParserException("bad")
+
+    with pytest.raises(OutputParserException):
+        CallWithRetry(slow_failure, "local", "テスト", RetryPolicy.RetryPolicy(max_attempts={TRANSIENT: 1, RATE_LIMIT: 1, PARSE: 10, FATAL: 1}, retry_budget=100.0))
+    # 80秒の時点では再試行するが、120秒の時点では予算を超えているため再試行しない
+    assert len(calls) == 3
+
+def test_breaker_opens_after_transient_failures_and_fails_fast(breaker):
+    func, calls = failing([ConnectionError("refused")] * 10)
+    # 2回目の失敗で停止するため、3回目の試行は呼び出さずに失敗する
+    with pytest.raises(BackendUnavailableError):
+        CallWithRetry(func, "local", "テスト", RetryPolicy.RetryPolicy(base_delay=0.0))
+    assert breaker.state == "open"
+    assert len(calls) == 2
+    with pytest.raises(BackendUnavailableError):
+        CallWithRetry(func, "local", "テスト", RetryPolicy.RetryPolicy(base_delay=0.0))
+    assert len(calls) == 2
+
+def test_breaker_ignores_parse_and_rate_limit_failures():
+    breaker = CircuitBreaker("テスト", failure_threshold=1)
+    breaker.record_failure(PARSE)
+    breaker.record_failure(RATE_LIMIT)
+    assert breaker.state == "closed"
+
+def test_breaker_half_open_probe(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(RetryPolicy.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("テスト", failure_threshold=1, reset_timeout=10.0)
+    breaker.record_failure(TRANSIENT)
+    assert breaker.state == "open"
+    now[0] = 11.0
+    assert breaker.state == "half_open"
+    # 停止時間の後は1件だけ試し、その間の他の呼び出しは止める
+    breaker.before_call()
+    with pytest.raises(BackendUnavailableError):
+        breaker.before_call()
+    # 試した呼び出しが失敗すると再び停止し、成功すると再開する
+    breaker.record_failure(TRANSIENT)
+    assert breaker.state == "open"
+    now[0] = 22.0
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
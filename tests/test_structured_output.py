@@ -0,0 +1,60 @@
+import json
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models import FakeListLLM
+
+from dists.GeneratePersona import Opinion
+from dists.StructuredOutput import JsonArrayItemExtractor, RepairingOutputParser, _LoadRepairedJson, _RepairJson
+
+def test_repair_json_closes_truncated_string_and_brackets():
+    assert json.loads(_RepairJson('{"a": [1, 2], "b": "途中で切')) == {"a": [1, 2], "b": "途中で切"}
+
+def test_repair_json_drops_trailing_commas_outside_strings():
+    assert json.loads(_RepairJson('{"a": [1, 2, ], "b": {"c": 3,},}')) == {"a": [1, 2], "b": {"c": 3}}
+
+def test_repair_json_keeps_commas_inside_strings():
+    assert json.loads(_RepairJson('{"a": "x, ]", "b": "y,}",}')) == {"a": "x, ]", "b": "y,}"}
+
+def test_repair_json_keeps_escaped_quotes():
+    assert json.loads(_RepairJson('{"a": "引用 \\"x, }\\" の後", "b": 1')) == {"a": '引用 "x, }" の後', "b": 1}
+
+def test_repair_json_ignores_text_after_closing_bracket():
+    assert json.loads(_RepairJson('{"a": 1} 以上です。{"b": 2}')) == {"a": 1}
+
+def test_load_repaired_json_drops_incomplete_last_item():
+    assert _LoadRepairedJson('{"a": 1, "b') == {"a": 1}
+
+def test_parser_accepts_valid_json():
+    assert RepairingOutputParser(pydantic_object=Opinion).parse('{"want_level": 7, "reason": "便利"}') == Opinion(want_level=7, reason="便利")
+
+def test_parser_repairs_fenced_truncated_json():
+    text = '結果です。\n```json\n{"want_level": 4, "reason": "高い, でも便利",\n```'
+    assert RepairingOutputParser(pydantic_object=Opinion).parse(text) == Opinion(want_level=4, reason="高い, でも便利")
+
+def test_parser_raises_without_json():
+    with pytest.raises(OutputParserException):
+        RepairingOutputParser(pydantic_object=Opinion).parse("評価できません")
+
+def test_parser_raises_for_invalid_fields_without_reask_model():
+    with pytest.raises(OutputParserException, match="want_level"):
+        RepairingOutputParser(pydantic_object=Opinion).parse('{"want_level": "高い", "reason": "便利"}')
+
+def test_parser_reasks_only_invalid_fields():
+    model = FakeListLLM(responses=['{"want_level": 8}'])
+    parser = RepairingOutputParser(pydantic_object=Opinion, reask_model=model, cache_mode="off")
+    assert parser.parse('{"want_level": "高い", "reason": "便利"}') == Opinion(want_level=8, reason="便利")
+
+def test_extractor_returns_items_as_they_close():
+    extractor = JsonArrayItemExtractor("characters")
+    assert extractor.feed('{"characters": [{"name": "a"}, {"na') == ['{"name": "a"}']
+    assert extractor.feed('me": "b"}') == ['{"name": "b"}']
+    assert not extractor.finished
+    assert extractor.feed("]}") == []
+    assert extractor.finished
+
+def test_extractor_ignores_brackets_and_escaped_quotes_in_strings():
+    extractor = JsonArrayItemExtractor("characters")
+    items = extractor.feed('{"characters": [{"name": "} ] \\" {"}, {"name": "b"}]}')
+    assert [json.loads(item) for item in items] == [{"name": '} ] " {'}, {"name": "b"}]
+    assert extractor.finished
@@ -0,0 +1,46 @@
+from dists import VariantComparison
+from dists.GeneratePersona import Character, Opinion
+from dists.PanelRefinement import StageMemo
+from dists.PersonaPipeline import PersonaResult
+from dists.VariantComparison import CompareVariants, PairedComparison, SplitVariants, VariantLabel
+
+def make_character(name):
+    return Character(**{**{field: "項目" for field in Character.model_fields}, "name": name, "age": 30})
+
+def make_opinion(want_level):
+    return Opinion(**{**{field: "理由の説明です。" for field in Opinion.model_fields}, "want_level": want_level})
+
+def test_split_variants_and_labels():
+    assert SplitVariants("案その1\n---\n案その2\n\n---\n") == ["案その1", "案その2"]
+    assert VariantLabel(0) == "A"
+    assert VariantLabel(25) == "Z"
+    assert VariantLabel(26) == "27"
+
+def test_paired_comparison_without_shared_personas():
+    rows = PairedComparison({0: {0: 5, 1: 7}, 1: {0: 6, 1: 9}, 2: {}})
+    assert rows[0]["difference"] is None
+    assert rows[1]["difference"]["mean"] == 1.5
+    assert (rows[1]["higher"], rows[1]["lower"], rows[1]["same"]) == (2, 0, 0)
+    assert rows[2]["want_level"]["count"] == 0
+    assert rows[2]["difference"] is None
+
+def test_compare_variants_evaluates_each_pair_once(monkeypatch):
+    calls = []
+
+    def evaluate(index, character, service_title, service_req, *args, **kwargs):
+        calls.append((character.name, service_req, kwargs.get("cascade")))
+        return PersonaResult(index=index, character=character, comment=service_req, opinion=make_opinion(len(calls)))
+
+    monkeypatch.setattr(VariantComparison, "EvaluateCharacter", evaluate)
+    panel = {3: make_character("甲"), 5: make_character("乙")}
+    memo = StageMemo()
+    results = list(CompareVariants(panel, "サービス", ["案A", "案B"], True, memo=memo, max_workers=2, cascade=True))
+    assert sorted((variant, result.index, result.comment) for variant, result in results) == [
+        (0, 3, "案A"), (0, 5, "案A"), (1, 3, "案B"), (1, 5, "案B")
+    ]
+    assert {call[2] for call in calls} == {True}
+
+    # 同じ入力の組は記録済みの結果を返し、呼び出さない
+    again = list(CompareVariants(panel, "サービス", ["案A", "案B"], True, memo=memo, cascade=True))
+    assert len(again) == 4
+    assert len(calls) == 4
@@ -0,0 +1,31 @@
+import argparse
+
+from dotenv import load_dotenv
+
+# dists以下のモジュールは読み込み時に環境変数から設定を読むため、先に.envを読み込む
+load_dotenv()
+
+from dists.JobQueue import job_queue
+from dists.JobWorker import JOB_POLL_INTERVAL, StartWorkers, WorkerLoop
+
+def main():
+    parser = argparse.ArgumentParser(description="画面から投入されたジョブを実行するワーカーを起動します。画面側で起動しない場合（JOB_WORKERS=0）に使います。")
+    parser.add_argument("--processes", type=int, default=1, help="起動するワーカープロセスの数（1つのプロセスは1件ずつジョブを実行する）")
+    parser.add_argument("--poll-interval", type=float, default=JOB_POLL_INTERVAL, help="待機中のジョブがない場合に、次に確認するまでの秒数")
+    args = parser.parse_args()
+
+    print(f"ジョブの保存先: {job_queue.path}")
+    if args.processes <= 1:
+        WorkerLoop(args.poll_interval)
+        return
+    processes = StartWorkers(args.processes, args.poll_interval)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # 実行中のジョブは、生存確認が途絶えた後に他のワーカーが記録済みの人物を飛ばして再開する
+        for process in processes:
+            process.terminate()
+
+if __name__ == "__main__":
+    main()